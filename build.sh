@@ -5,4 +5,6 @@ set -o errexit
 pip install -r requirements.txt
 
 python manage.py collectstatic --no-input
-python manage.py migrate
\ No newline at end of file
+python manage.py migrate
+# Fills the analytics summary tables once, after the migration that creates them.
+python manage.py rebuild_analytics --if-empty
@@ -49,14 +49,15 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware', 
+    # WhiteNoise, made async-capable: every middleware here runs natively under ASGI.
+    'health_app.middleware.StaticFilesMiddleware',
+    'health_app.middleware.PerformanceMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
 ]
 
 ROOT_URLCONF = 'config.urls'
@@ -96,6 +97,10 @@ DATABASES = {
         conn_max_age=600
     )
 }
+# SQLite fails a transaction that reads before it writes at once if another connection is
+# writing; taking the write lock up front makes it wait for up to `timeout` seconds instead.
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('OPTIONS', {}).update(transaction_mode='IMMEDIATE', timeout=20)
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -152,4 +157,154 @@ STATICFILES_DIRS = [
 ]
 STATIC_ROOT = BASE_DIR / 'staticfiles' # The folder where collectstatic will place files
 
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
\ No newline at end of file
+STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+# --- AI ANALYSIS ---
+# Which inference client services.py uses (see health_app/inference.py):
+# "huggingface" (production), "stub" (a deterministic in-process stand-in for tests and
+# development), "http" (an OpenAI-compatible server at AI_INFERENCE_URL, e.g.
+# `manage.py serve_inference_stub`), or the dotted path of a client factory.
+# The client is built on first use, so only the worker and the analysis views need the key.
+AI_INFERENCE_BACKEND = os.getenv('AI_INFERENCE_BACKEND', 'huggingface')
+HUGGING_FACE_API_KEY = os.getenv('HUGGING_FACE_API_KEY')
+AI_INFERENCE_URL = os.getenv('AI_INFERENCE_URL', 'http://127.0.0.1:8080/v1')
+AI_INFERENCE_API_KEY = os.getenv('AI_INFERENCE_API_KEY', '')
+
+# Simulated latency of the stub backend, for load tests: seconds before the first token,
+# plus seconds per generated token (between streamed chunks).
+AI_STUB_LATENCY = float(os.getenv('AI_STUB_LATENCY', '0'))
+AI_STUB_TOKEN_LATENCY = float(os.getenv('AI_STUB_TOKEN_LATENCY', '0'))
+
+# Model call timeouts and retries (see health_app/resilience.py). Each attempt times out
+# after AI_INFERENCE_TIMEOUT seconds. Timeouts, connection errors, 429s and 5xx responses
+# are retried, up to AI_RETRY_ATTEMPTS attempts in total, with jittered exponential backoff
+# (AI_RETRY_BASE_DELAY doubling up to AI_RETRY_MAX_DELAY), as long as the next attempt
+# still fits in AI_INFERENCE_BUDGET seconds.
+AI_INFERENCE_TIMEOUT = float(os.getenv('AI_INFERENCE_TIMEOUT', '60'))
+AI_INFERENCE_BUDGET = float(os.getenv('AI_INFERENCE_BUDGET', '150'))
+AI_RETRY_ATTEMPTS = int(os.getenv('AI_RETRY_ATTEMPTS', '3'))
+AI_RETRY_BASE_DELAY = float(os.getenv('AI_RETRY_BASE_DELAY', '1'))
+AI_RETRY_MAX_DELAY = float(os.getenv('AI_RETRY_MAX_DELAY', '10'))
+
+# After this many consecutive failed calls the circuit breaker opens: analyses fail fast
+# (queued jobs wait) for AI_BREAKER_RESET_TIMEOUT seconds, then one trial call is let through.
+# The state lives in the 'shared' cache (see CACHES), so every process sees the same circuit.
+AI_BREAKER_FAILURE_THRESHOLD = int(os.getenv('AI_BREAKER_FAILURE_THRESHOLD', '5'))
+AI_BREAKER_RESET_TIMEOUT = float(os.getenv('AI_BREAKER_RESET_TIMEOUT', '60'))
+
+# How often (in seconds) the `run_analysis_worker` command polls for queued jobs,
+# and after how long a RUNNING job is considered abandoned by a dead worker.
+AI_JOB_POLL_INTERVAL = float(os.getenv('AI_JOB_POLL_INTERVAL', '2'))
+AI_JOB_STALE_AFTER = int(os.getenv('AI_JOB_STALE_AFTER', '900'))
+
+# Upper bound on concurrent inference calls per worker process, and how many
+# finished reports are written per bulk INSERT.
+AI_ANALYSIS_CONCURRENCY = int(os.getenv('AI_ANALYSIS_CONCURRENCY', '4'))
+AI_ASSESSMENT_BATCH_SIZE = int(os.getenv('AI_ASSESSMENT_BATCH_SIZE', '50'))
+
+# The completion budget (max_tokens) of a report: a base for the summary and recommendations
+# plus an allowance per abnormal marker, capped at AI_MAX_TOKENS (see services.max_tokens_for).
+# Reasoning models count their thinking against it too; watch health_inference_truncated.
+AI_MAX_TOKENS = int(os.getenv('AI_MAX_TOKENS', '2048'))
+AI_MAX_TOKENS_BASE = int(os.getenv('AI_MAX_TOKENS_BASE', '768'))
+AI_MAX_TOKENS_PER_FINDING = int(os.getenv('AI_MAX_TOKENS_PER_FINDING', '128'))
+
+# Records analyzed per model call by the worker (see services.generate_risk_assessments_for_records).
+# Above 1, the shared instructions are sent once per batch; 1 sends one prompt per record.
+AI_BATCH_PROMPT_SIZE = int(os.getenv('AI_BATCH_PROMPT_SIZE', '1'))
+# A batch asks for its reports' max_tokens added up, but never more than this. Reports that
+# don't fit in the response are generated one by one.
+AI_BATCH_MAX_TOKENS = int(os.getenv('AI_BATCH_MAX_TOKENS', '8192'))
+
+# Content-addressed cache of generated reports (see health_app/report_cache.py).
+AI_REPORT_CACHE_ENABLED = os.getenv('AI_REPORT_CACHE_ENABLED', 'True') == 'True'
+AI_REPORT_CACHE_MAX_ENTRIES = int(os.getenv('AI_REPORT_CACHE_MAX_ENTRIES', '10000'))
+AI_REPORT_CACHE_MAX_AGE_DAYS = int(os.getenv('AI_REPORT_CACHE_MAX_AGE_DAYS', '30'))
+
+# --- CSV IMPORT ---
+# Rows validated and inserted per bulk INSERT when importing an uploaded CSV.
+CSV_IMPORT_BATCH_SIZE = int(os.getenv('CSV_IMPORT_BATCH_SIZE', '1000'))
+# At most this many per-row errors are stored on a failed upload job.
+CSV_IMPORT_MAX_ERRORS = int(os.getenv('CSV_IMPORT_MAX_ERRORS', '200'))
+
+# Uploaded CSV files are spooled here until the worker has imported them.
+# The web and worker processes must share this directory.
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', BASE_DIR / 'media')
+
+# --- EXPORTS ---
+# Rows fetched from the database per round trip when streaming the reviewed reports export.
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '2000'))
+
+# --- PAGINATION ---
+# The patient list and doctor worklist use keyset pagination and only count rows on
+# request (?count=1). The count stops at this many rows and is then shown as "N+".
+PAGINATION_COUNT_CAP = int(os.getenv('PAGINATION_COUNT_CAP', '1000'))
+
+# --- CACHING ---
+# The default is a per-process in-memory cache. Set CACHE_BACKEND/CACHE_LOCATION to a
+# shared backend (e.g. django.core.cache.backends.redis.RedisCache) so that cache
+# invalidation reaches every web and worker process.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'health-app'),
+    },
+    # State that every process must agree on: the inference circuit breaker (see
+    # health_app/resilience.py). The database cache needs no extra service (migration 0014
+    # creates its table); with a shared CACHE_BACKEND, point this at it too.
+    'shared': {
+        'BACKEND': os.getenv('SHARED_CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.getenv('SHARED_CACHE_LOCATION', 'health_app_shared_cache'),
+    },
+}
+
+# Seconds a hospital's doctor roster is cached (see health_app/roster.py). Saves and deletes
+# of users invalidate it immediately; the timeout bounds staleness in other processes.
+DOCTOR_ROSTER_CACHE_TIMEOUT = int(os.getenv('DOCTOR_ROSTER_CACHE_TIMEOUT', '300'))
+
+# --- PERFORMANCE INSTRUMENTATION ---
+# Per-request timings (see health_app/middleware.py): query count, database, model
+# inference, report rendering and total time.
+PERFORMANCE_INSTRUMENTATION = os.getenv('PERFORMANCE_INSTRUMENTATION', 'True') == 'True'
+# Sends the timings to clients as a Server-Timing header (visible in browser dev tools).
+PERFORMANCE_SERVER_TIMING = os.getenv('PERFORMANCE_SERVER_TIMING', 'True') == 'True'
+# Requests slower than this also log their SQL statements (at most ..._MAX_QUERIES of them).
+PERFORMANCE_SLOW_REQUEST_MS = float(os.getenv('PERFORMANCE_SLOW_REQUEST_MS', '1000'))
+PERFORMANCE_SLOW_REQUEST_MAX_QUERIES = int(os.getenv('PERFORMANCE_SLOW_REQUEST_MAX_QUERIES', '50'))
+
+# One JSON line per request on the 'health_app.performance' logger, to stderr.
+# Set PERFORMANCE_LOG_LEVEL=WARNING to log only slow requests.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '{message}', 'style': '{'},
+    },
+    'handlers': {
+        'performance': {'class': 'logging.StreamHandler', 'formatter': 'message'},
+    },
+    'loggers': {
+        'health_app.performance': {
+            'handlers': ['performance'],
+            'level': os.getenv('PERFORMANCE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# --- METRICS ---
+# Prometheus metrics at /metrics (see health_app/metrics.py). Scrapers send
+# `Authorization: Bearer <METRICS_TOKEN>`; without a token the endpoint is only served
+# with DEBUG on. With several gunicorn workers, also set PROMETHEUS_MULTIPROC_DIR.
+# Request latencies are recorded by the performance middleware above.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# --- ASGI ---
+# Serve the analysis endpoints with async views (see health_app/urls.py), which call the
+# model through the async inference client and hold no thread while they wait on it.
+# config/asgi.py turns this on, so it only needs setting to override that.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False') == 'True'
+if ASYNC_VIEWS:
+    # Each ASGI request runs its queries in a thread of its own, so a persistent connection
+    # would never be reused, just left open.
+    DATABASES['default']['CONN_MAX_AGE'] = 0
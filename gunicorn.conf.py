@@ -0,0 +1,24 @@
+# gunicorn.conf.py
+"""
+gunicorn loads this file from the working directory on start.
+
+It prepares PROMETHEUS_MULTIPROC_DIR for the web workers' shared metrics
+(see health_app/metrics.py).
+"""
+import glob
+import os
+
+
+def on_starting(server):
+    # Files left by a previous run would be added to this run's metrics.
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
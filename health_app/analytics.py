@@ -0,0 +1,381 @@
+# health_app/analytics.py
+"""
+Per-hospital analytics, kept up to date incrementally.
+
+The analytics dashboard shows distributions over all of a hospital's records and
+assessments: per-marker abnormal counts, means and percentiles, reviews per doctor
+and the age of the pending review backlog. Aggregating PatientRecord and
+RiskAssessment on every page load would cost more as the hospital grows, so three
+small summary tables hold the aggregates and every write applies its delta:
+
+- MarkerBucket: a fixed-width histogram per marker, with the count, sum and abnormal
+  count of each bucket. Counts and means are exact; percentiles are interpolated
+  within a bucket (there are BUCKETS_PER_THRESHOLD buckets below the marker's
+  first threshold).
+- ReviewDaily: reviews per doctor per day.
+- BacklogDaily: pending assessments per day their report was generated.
+
+A save or delete turns into "+1 on these summary rows, -1 on those". The deltas are
+applied by locking the affected rows in primary-key order, so concurrent writers
+neither lose updates nor deadlock. Bulk paths wrap their writes in `batch()`, which
+collects the deltas of the whole block and applies them in a few queries at the end.
+
+Writes that skip save() and the signals (QuerySet.update, raw SQL) are not tracked;
+`manage.py rebuild_analytics` recomputes the tables from scratch.
+"""
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from .models import BacklogDaily, MarkerBucket, PatientRecord, ReviewDaily, RiskAssessment
+from .thresholds import MARKER_FIELDS, MARKERS, match_rule
+
+BUCKETS_PER_THRESHOLD = 20
+
+# The fields that identify a row of each summary table.
+KEY_FIELDS = {
+    MarkerBucket: ('hospital_id', 'marker', 'bucket'),
+    ReviewDaily: ('hospital_id', 'doctor_id', 'day'),
+    BacklogDaily: ('hospital_id', 'day'),
+}
+
+# The RiskAssessment fields an assessment's contribution depends on.
+REVIEW_STATE_FIELDS = ('status', 'reviewed_by_id', 'reviewed_at', 'created_at')
+
+_batch = threading.local()
+
+
+# --- Contributions: the summary rows a record or an assessment counts toward ---
+
+def bucket_width(marker):
+    return marker.rules[0].threshold / BUCKETS_PER_THRESHOLD
+
+
+def bucket_for(marker, value):
+    return max(0, int(value // bucket_width(marker)))
+
+
+def record_contribution(hospital_id, markers):
+    """{(model, key): {field: amount}} for one record; `markers` is in MARKER_FIELDS order."""
+    contribution = {}
+    for marker, value in zip(MARKERS, markers):
+        if value is None:
+            continue
+        contribution[(MarkerBucket, (hospital_id, marker.field, bucket_for(marker, value)))] = {
+            'count': 1, 'value_sum': value, 'abnormal_count': int(match_rule(marker, value) is not None),
+        }
+    return contribution
+
+
+def assessment_contribution(hospital_id, status, reviewed_by_id, reviewed_at, created_at):
+    """{(model, key): {field: amount}} for one assessment in the given review state."""
+    if status == RiskAssessment.Status.PENDING_REVIEW:
+        return {(BacklogDaily, (hospital_id, timezone.localdate(created_at))): {'count': 1}}
+    if status == RiskAssessment.Status.REVIEWED and reviewed_by_id and reviewed_at:
+        return {(ReviewDaily, (hospital_id, reviewed_by_id, timezone.localdate(reviewed_at))): {'count': 1}}
+    return {}
+
+
+def _accumulate(deltas, contribution, sign):
+    for key, fields in contribution.items():
+        for field, amount in fields.items():
+            deltas[key][field] += sign * amount
+
+
+def _diff(old, new):
+    deltas = defaultdict(Counter)
+    _accumulate(deltas, old, -1)
+    _accumulate(deltas, new, 1)
+    return deltas
+
+
+# --- Applying deltas ---
+
+def apply_deltas(deltas):
+    """Adds {(model, key): {field: amount}} to the summary rows, creating the rows that gain a value."""
+    by_model = defaultdict(dict)
+    for (model, key), fields in deltas.items():
+        if any(fields.values()):
+            by_model[model][key] = fields
+    if not by_model:
+        return
+    # No savepoint: inside a caller's transaction, a failure here should fail the whole write.
+    with transaction.atomic(savepoint=False):
+        for model, model_deltas in by_model.items():
+            _apply_model_deltas(model, model_deltas)
+
+
+def _apply_model_deltas(model, deltas):
+    key_fields = KEY_FIELDS[model]
+    # Only keys that gain a value get a row; a decrement of a missing row is dropped. That also
+    # keeps the cascade of a hospital's deletion from re-creating rows for it.
+    model.objects.bulk_create(
+        [model(**dict(zip(key_fields, key))) for key, fields in deltas.items() if fields.get('count', 0) > 0],
+        ignore_conflicts=True,
+    )
+    # Lock a superset of the rows (each key field IN its values), always in pk order.
+    filters = {f"{field}__in": {key[i] for key in deltas} for i, field in enumerate(key_fields)}
+    changed, updated_fields = [], set()
+    for row in model.objects.select_for_update().filter(**filters).order_by('pk'):
+        fields = deltas.get(tuple(getattr(row, field) for field in key_fields))
+        if fields is None:
+            continue
+        for field, amount in fields.items():
+            setattr(row, field, getattr(row, field) + amount)
+        updated_fields.update(fields)
+        changed.append(row)
+    if changed:
+        model.objects.bulk_update(changed, sorted(updated_fields), batch_size=500)
+
+
+def submit(deltas):
+    """Applies the deltas now, or at the end of the enclosing `batch()`."""
+    pending = getattr(_batch, 'pending', None)
+    if pending is None:
+        apply_deltas(deltas)
+        return
+    for key, fields in deltas.items():
+        pending[key].update(fields)
+
+
+@contextmanager
+def batch():
+    """
+    Collects the deltas of every write inside the block and applies them together on exit,
+    e.g. around a bulk import or a queryset delete. Nested blocks join the outer one.
+    """
+    if getattr(_batch, 'pending', None) is not None:
+        yield
+        return
+    _batch.pending = defaultdict(Counter)
+    _batch.record_hospitals = {}
+    try:
+        yield
+        pending = _batch.pending
+    finally:
+        _batch.pending = None
+        _batch.record_hospitals = {}
+    apply_deltas(pending)
+
+
+# --- Hooks for saves, deletes and bulk writes ---
+
+def record_markers(record):
+    return tuple(getattr(record, field) for field in MARKER_FIELDS)
+
+
+def _review_state(assessment):
+    return tuple(getattr(assessment, field) for field in REVIEW_STATE_FIELDS)
+
+
+def _hospital_id(assessment):
+    # The record is usually already loaded: by select_related, or as the instance the assessment was created for.
+    if RiskAssessment.patient_record.is_cached(assessment):
+        return assessment.patient_record.hospital_id
+    # Records deleted in a batch, whose assessments are deleted by the cascade.
+    if assessment.patient_record_id in getattr(_batch, 'record_hospitals', {}):
+        return _batch.record_hospitals[assessment.patient_record_id]
+    return PatientRecord.objects.filter(pk=assessment.patient_record_id).values_list('hospital_id', flat=True).first()
+
+
+def load_previous_state(instance):
+    """Called before an update of an instance whose loaded values were not remembered (e.g. a deferred load)."""
+    if isinstance(instance, PatientRecord) and not hasattr(instance, '_loaded_markers'):
+        instance._loaded_markers = PatientRecord.objects.filter(pk=instance.pk).values_list(*MARKER_FIELDS).first()
+    elif isinstance(instance, RiskAssessment) and not hasattr(instance, '_loaded_review_state'):
+        instance._loaded_review_state = RiskAssessment.objects.filter(pk=instance.pk).values_list(*REVIEW_STATE_FIELDS).first()
+
+
+def record_saved(record, created):
+    old = None if created else getattr(record, '_loaded_markers', None)
+    new = record_markers(record)
+    if old != new:
+        submit(_diff(record_contribution(record.hospital_id, old) if old else {}, record_contribution(record.hospital_id, new)))
+    record._loaded_markers = new
+
+
+def record_deleting(record):
+    """Called before a record is deleted; in a batch, remembers its hospital for its cascaded assessment."""
+    if getattr(_batch, 'pending', None) is not None:
+        _batch.record_hospitals[record.pk] = record.hospital_id
+
+
+def record_deleted(record):
+    old = getattr(record, '_loaded_markers', None) or record_markers(record)
+    submit(_diff(record_contribution(record.hospital_id, old), {}))
+
+
+def records_changed(hospital_id, changes):
+    """For bulk writes, which send no signals: `changes` is (old markers or None, new markers) per record."""
+    deltas = defaultdict(Counter)
+    for old, new in changes:
+        if old:
+            _accumulate(deltas, record_contribution(hospital_id, old), -1)
+        _accumulate(deltas, record_contribution(hospital_id, new), 1)
+    submit(deltas)
+
+
+def assessment_saved(assessment, created):
+    old = None if created else getattr(assessment, '_loaded_review_state', None)
+    new = _review_state(assessment)
+    if old != new:
+        hospital_id = _hospital_id(assessment)
+        if hospital_id is not None:
+            submit(_diff(
+                assessment_contribution(hospital_id, *old) if old else {},
+                assessment_contribution(hospital_id, *new),
+            ))
+    assessment._loaded_review_state = new
+
+
+def assessment_deleted(assessment):
+    old = getattr(assessment, '_loaded_review_state', None) or _review_state(assessment)
+    hospital_id = _hospital_id(assessment)
+    if hospital_id is not None:
+        submit(_diff(assessment_contribution(hospital_id, *old), {}))
+
+
+def assessments_created(assessments):
+    """
+    For bulk_create, which sends no signals. The assessments' patient_record must be loaded.
+    Pass only the rows that were actually inserted.
+    """
+    deltas = defaultdict(Counter)
+    for assessment in assessments:
+        _accumulate(deltas, assessment_contribution(assessment.patient_record.hospital_id, *_review_state(assessment)), 1)
+    submit(deltas)
+
+
+def rebuild(hospital_ids=None):
+    """
+    Recomputes the summary tables from PatientRecord and RiskAssessment, for the given
+    hospitals or all of them. Returns the number of summary rows written.
+    """
+    records = PatientRecord.objects.all()
+    assessments = RiskAssessment.objects.all()
+    if hospital_ids is not None:
+        records = records.filter(hospital_id__in=hospital_ids)
+        assessments = assessments.filter(patient_record__hospital_id__in=hospital_ids)
+
+    deltas = defaultdict(Counter)
+    for hospital_id, *markers in records.values_list('hospital_id', *MARKER_FIELDS).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE):
+        _accumulate(deltas, record_contribution(hospital_id, markers), 1)
+    state_fields = ['patient_record__hospital_id', *REVIEW_STATE_FIELDS]
+    for hospital_id, *state in assessments.values_list(*state_fields).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE):
+        _accumulate(deltas, assessment_contribution(hospital_id, *state), 1)
+
+    rows = defaultdict(list)
+    for (model, key), fields in deltas.items():
+        rows[model].append(model(**dict(zip(KEY_FIELDS[model], key)), **fields))
+
+    with transaction.atomic():
+        for model in KEY_FIELDS:
+            existing = model.objects.all()
+            if hospital_ids is not None:
+                existing = existing.filter(hospital_id__in=hospital_ids)
+            existing.delete()
+            model.objects.bulk_create(rows[model], batch_size=1000)
+    return sum(len(model_rows) for model_rows in rows.values())
+
+
+# --- Reading the aggregates ---
+
+class MarkerStats(NamedTuple):
+    marker: object      # thresholds.Marker
+    count: int
+    abnormal_count: int
+    mean: float
+    p50: float
+    p90: float
+    p99: float
+
+    @property
+    def abnormal_percent(self):
+        return 100 * self.abnormal_count / self.count if self.count else 0
+
+
+class DoctorThroughput(NamedTuple):
+    doctor_id: int
+    last_7_days: int
+    total: int
+
+
+class BacklogAge(NamedTuple):
+    total: int
+    oldest_day: object  # date, or None when there is no backlog
+    bands: list         # (label, count) by age
+
+
+# (minimum age in days, label), youngest first
+BACKLOG_AGE_BANDS = ((0, "Today"), (1, "1-6 days"), (7, "1-4 weeks"), (30, "Over 30 days"))
+
+
+def percentile_from_buckets(buckets, width, q):
+    """The q-quantile (0 < q < 1) of a histogram given as sorted (bucket, count) pairs, interpolated within its bucket."""
+    target = q * sum(count for _, count in buckets)
+    cumulative = 0
+    for bucket, count in buckets:
+        if cumulative + count >= target:
+            return (bucket + (target - cumulative) / count) * width
+        cumulative += count
+    return (buckets[-1][0] + 1) * width
+
+
+def marker_stats(hospital_id):
+    """MarkerStats for every marker with at least one value, in MARKERS order."""
+    histograms = defaultdict(list)
+    rows = MarkerBucket.objects.filter(hospital_id=hospital_id, count__gt=0).order_by('marker', 'bucket')
+    for field, bucket, count, value_sum, abnormal_count in rows.values_list('marker', 'bucket', 'count', 'value_sum', 'abnormal_count'):
+        histograms[field].append((bucket, count, value_sum, abnormal_count))
+
+    stats = []
+    for marker in MARKERS:
+        histogram = histograms.get(marker.field)
+        if not histogram:
+            continue
+        buckets = [(bucket, count) for bucket, count, _, _ in histogram]
+        count = sum(count for _, count in buckets)
+        width = bucket_width(marker)
+        stats.append(MarkerStats(
+            marker=marker,
+            count=count,
+            abnormal_count=sum(row[3] for row in histogram),
+            mean=sum(row[2] for row in histogram) / count,
+            p50=percentile_from_buckets(buckets, width, 0.5),
+            p90=percentile_from_buckets(buckets, width, 0.9),
+            p99=percentile_from_buckets(buckets, width, 0.99),
+        ))
+    return stats
+
+
+def review_throughput(hospital_id, days=30):
+    """Reviews per doctor over the last `days` days (and the last 7), busiest first."""
+    today = timezone.localdate()
+    rows = ReviewDaily.objects.filter(
+        hospital_id=hospital_id, day__gt=today - timedelta(days=days),
+    ).values('doctor_id').annotate(
+        total=Sum('count'),
+        last_7_days=Sum('count', filter=Q(day__gt=today - timedelta(days=7))),
+    ).filter(total__gt=0).order_by('-total', 'doctor_id')
+    return [DoctorThroughput(row['doctor_id'], row['last_7_days'] or 0, row['total']) for row in rows]
+
+
+def backlog_age(hospital_id):
+    """The pending backlog, split into BACKLOG_AGE_BANDS by how long ago the reports were generated."""
+    today = timezone.localdate()
+    band_counts = [0] * len(BACKLOG_AGE_BANDS)
+    total, oldest_day = 0, None
+    for day, count in BacklogDaily.objects.filter(hospital_id=hospital_id, count__gt=0).values_list('day', 'count'):
+        age = (today - day).days
+        band = max(i for i, (minimum, _) in enumerate(BACKLOG_AGE_BANDS) if age >= minimum or i == 0)
+        band_counts[band] += count
+        total += count
+        oldest_day = day if oldest_day is None else min(oldest_day, day)
+    return BacklogAge(total, oldest_day, [(label, count) for (_, label), count in zip(BACKLOG_AGE_BANDS, band_counts)])
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class HealthAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'health_app'
+
+    def ready(self):
+        from . import signals  # noqa: F401  (connects the roster cache invalidation)
+        from . import inference  # noqa: F401  (registers the inference backend check)
+        from . import instrumentation  # noqa: F401  (times the queries of every connection)
@@ -0,0 +1,99 @@
+# health_app/benchmarking.py
+"""
+Shared helpers for the benchmark commands: latency percentiles, the JSON report
+header, a side-by-side comparison of two reports (e.g. from two commits), and an
+offline token count estimate.
+"""
+import math
+import platform
+import re
+import statistics
+import subprocess
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def percentile(values, q):
+    """The q-th percentile (0-100) of the values, by the nearest-rank method."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def latency_summary(seconds):
+    """p50/p95/p99/mean/max in milliseconds for a list of durations in seconds."""
+    if not seconds:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None, 'max': None}
+    ms = [s * 1000 for s in seconds]
+    return {
+        'p50': round(percentile(ms, 50), 2),
+        'p95': round(percentile(ms, 95), 2),
+        'p99': round(percentile(ms, 99), 2),
+        'mean': round(statistics.fmean(ms), 2),
+        'max': round(max(ms), 2),
+    }
+
+
+def git_revision():
+    """The short hash of the checked-out commit, with '-dirty' if there are local changes; None outside a git checkout."""
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{revision}-dirty" if dirty else revision
+
+
+def report_meta(**extra):
+    """The header of a benchmark report: where and when it ran, plus the benchmark's own parameters."""
+    return {
+        'git_revision': git_revision(),
+        'started_at': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'database': connection.vendor,
+        **extra,
+    }
+
+
+def _change(before, after, unit=""):
+    if before is None or after is None:
+        return f"{before} -> {after}{unit}"
+    if before == 0:
+        return f"{before:g} -> {after:g}{unit}"
+    return f"{before:g} -> {after:g}{unit} ({(after - before) / before:+.0%})"
+
+
+def compare_reports(baseline, current):
+    """Lines comparing the latency, throughput and query counts of the scenarios two reports share."""
+    lines = [f"Baseline {baseline['meta'].get('git_revision')} vs current {current['meta'].get('git_revision')}"]
+    for name, now in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            lines.append(f"{name}: new scenario")
+            continue
+        lines.append(
+            f"{name}: p50 {_change(before['latency_ms']['p50'], now['latency_ms']['p50'], ' ms')}, "
+            f"p95 {_change(before['latency_ms']['p95'], now['latency_ms']['p95'], ' ms')}, "
+            f"throughput {_change(before['throughput_rps'], now['throughput_rps'], ' req/s')}, "
+            f"queries {_change(before['queries']['p50'], now['queries']['p50'])}"
+        )
+    return lines
+
+
+def approximate_tokens(text):
+    """
+    An offline estimate of a text's token count: one per word and one per punctuation mark.
+    Close to what BPE tokenizers give for English prose and markdown; use a real
+    tokenizer when the exact count matters.
+    """
+    return len(_TOKEN_PATTERN.findall(text))
@@ -0,0 +1,271 @@
+# health_app/csv_import.py
+"""
+Streaming import of patient records from an uploaded CSV file.
+
+The file is decoded and parsed incrementally from its chunks, so memory stays
+bounded by the batch size. An import makes two passes over the (spooled) file:
+
+1. validate: every row is checked (identifier present and unique within the file,
+   numeric values, known columns) and each batch of identifiers is checked against
+   the database in one query. All per-row errors are collected.
+2. insert: only if validation found no errors, rows are inserted with `bulk_create`
+   in batches of CSV_IMPORT_BATCH_SIZE.
+
+Imports stay all-or-nothing: if the insert pass fails part-way, the records it
+already created are deleted again.
+
+In upsert mode, identifiers that already exist are not errors. Each batch's existing
+markers are read with one query, new rows are inserted and changed rows updated with a
+single `bulk_create(update_conflicts=True)` on the (hospital, patient_identifier)
+unique constraint, and unchanged rows are skipped. Each batch is committed on its own,
+so progress is visible while the file is imported and no lock is held for the whole
+file. Updates can't be undone by deleting, so if the pass fails part-way (after the
+file has validated, that takes a database error) the earlier batches stay applied.
+
+An updated record's existing assessment is kept, since a doctor may have reviewed it,
+but it is flagged with `markers_changed`: its report describes the old values.
+"""
+import codecs
+import csv
+
+from django.conf import settings
+from django.db import transaction
+
+from . import analytics
+from .models import PatientRecord, RiskAssessment
+from .thresholds import MARKER_FIELDS, risk_flags
+
+
+class CSVReadError(ValueError):
+    """The file could not be decoded or parsed as CSV, or had no data rows."""
+
+
+def iter_lines(uploaded_file, encoding='utf-8'):
+    """
+    Yields decoded lines (with their line endings) from the file's chunks.
+    Only one chunk plus a partial line is held in memory at a time.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    for chunk in uploaded_file.chunks():
+        pending += decoder.decode(chunk)
+        # The last piece may be an incomplete line; keep it for the next chunk.
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            yield line + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def iter_batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def clean_row(row):
+    """Converts one CSV row to PatientRecord keyword arguments."""
+    row = dict(row)
+    patient_identifier_val = row.pop('patient_identifier').strip()
+    cleaned_row = {k.lower().strip(): (float(v) if v and v.strip() else None) for k, v in row.items()}
+    cleaned_row['patient_identifier'] = patient_identifier_val
+    return cleaned_row
+
+
+class PatientCSVImporter:
+    """
+    Validates and imports one CSV file for a hospital, tracking progress and per-row errors.
+    `on_progress(importer)` is called after every batch so callers can publish the counters.
+    """
+
+    def __init__(self, hospital, uploaded_by, upload_job=None, upsert=False, batch_size=None, max_errors=None, on_progress=None):
+        self.hospital = hospital
+        self.uploaded_by = uploaded_by
+        self.upload_job = upload_job
+        self.upsert = upsert
+        self.batch_size = batch_size or settings.CSV_IMPORT_BATCH_SIZE
+        self.max_errors = max_errors or settings.CSV_IMPORT_MAX_ERRORS
+        self.on_progress = on_progress
+
+        self.rows_parsed = 0
+        self.rows_validated = 0
+        self.rows_inserted = 0
+        self.rows_updated = 0
+        self.rows_unchanged = 0
+        self.error_count = 0
+        self.errors = []
+        self.record_ids = []
+
+    def run(self, uploaded_file):
+        """Validates, then (if there were no errors) inserts. Returns True if the records were imported."""
+        if not self.validate(uploaded_file):
+            return False
+        if self.upsert:
+            self.upsert_rows(uploaded_file)
+        else:
+            self.insert(uploaded_file)
+        return True
+
+    def add_error(self, row_number, patient_identifier, message):
+        self.error_count += 1
+        # Only the first max_errors are kept, so a completely wrong file can't bloat the job row.
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': row_number, 'patient_identifier': patient_identifier, 'message': message})
+
+    def _report_progress(self):
+        if self.on_progress:
+            self.on_progress(self)
+
+    def _rows(self, uploaded_file):
+        """Yields (row_number, row) pairs. The header is row 1."""
+        try:
+            reader = csv.DictReader(iter_lines(uploaded_file))
+            for row_number, row in enumerate(reader, start=2):
+                yield row_number, row
+        except (UnicodeDecodeError, csv.Error) as e:
+            raise CSVReadError(str(e)) from e
+
+    def validate(self, uploaded_file):
+        """First pass: checks every row and collects errors. Returns True if the file is valid."""
+        first_seen_on_row = {}
+        for batch in iter_batches(self._rows(uploaded_file), self.batch_size):
+            if self.rows_parsed == 0:
+                self._validate_header(batch[0][1])
+
+            batch_rows = {}
+            for row_number, row in batch:
+                self.rows_parsed += 1
+                identifier = (row.get('patient_identifier') or '').strip()
+                if not identifier:
+                    self.add_error(row_number, None, "Missing patient_identifier.")
+                    continue
+                if identifier in first_seen_on_row:
+                    self.add_error(row_number, identifier, f"Duplicate patient_identifier (first seen on row {first_seen_on_row[identifier]}).")
+                    continue
+                first_seen_on_row[identifier] = row_number
+
+                try:
+                    clean_row(row)
+                except (ValueError, TypeError, AttributeError) as e:
+                    self.add_error(row_number, identifier, f"Invalid value: {e}.")
+                    continue
+                batch_rows[identifier] = row_number
+
+            # Check this batch for duplicates against the DATABASE (one query per batch).
+            # In upsert mode existing identifiers are expected and will be updated.
+            if not self.upsert:
+                existing = PatientRecord.objects.filter(
+                    hospital=self.hospital,
+                    patient_identifier__in=list(batch_rows)
+                ).values_list('patient_identifier', flat=True)
+                for identifier in existing:
+                    self.add_error(batch_rows.pop(identifier), identifier, "This patient identifier already exists in your hospital.")
+
+            self.rows_validated += len(batch_rows)
+            self._report_progress()
+
+        if self.rows_parsed == 0:
+            raise CSVReadError("The CSV file is empty.")
+        return self.error_count == 0
+
+    def _validate_header(self, first_row):
+        unknown = [
+            column for column in first_row
+            if column is not None and column != 'patient_identifier' and column.lower().strip() not in MARKER_FIELDS
+        ]
+        if 'patient_identifier' not in first_row:
+            self.add_error(1, None, "The header has no patient_identifier column.")
+        if unknown:
+            self.add_error(1, None, f"Unknown column(s): {', '.join(unknown)}.")
+
+    def insert(self, uploaded_file):
+        """Second pass: bulk-inserts the validated rows. Undoes its own inserts if anything fails."""
+        try:
+            for batch in iter_batches(self._rows(uploaded_file), self.batch_size):
+                records = [
+                    PatientRecord(hospital=self.hospital, uploaded_by=self.uploaded_by, upload_job=self.upload_job, **clean_row(row))
+                    for _, row in batch
+                ]
+                for record in records:
+                    record.risk_flags = risk_flags(record)  # bulk_create skips PatientRecord.save()
+                with transaction.atomic():
+                    new_records = PatientRecord.objects.bulk_create(records)
+                    # bulk_create sends no post_save, so count the batch into the analytics summary here.
+                    analytics.records_changed(self.hospital.pk, ((None, analytics.record_markers(record)) for record in new_records))
+                self.record_ids.extend(record.pk for record in new_records)
+                self.rows_inserted += len(new_records)
+                self._report_progress()
+        except Exception:
+            # Keep the import all-or-nothing. Batches are committed one by one so that
+            # progress is visible to other processes, so roll back by deleting.
+            with analytics.batch():
+                PatientRecord.objects.filter(pk__in=self.record_ids).delete()
+            self.record_ids = []
+            self.rows_inserted = 0
+            raise
+        return self.record_ids
+
+    def upsert_rows(self, uploaded_file):
+        """
+        Second pass in upsert mode: inserts new rows and updates the markers of existing ones.
+        Uses one SELECT and one INSERT ... ON CONFLICT DO UPDATE per batch (plus one UPDATE to
+        flag the updated records' assessments), never a query per row.
+        """
+        for batch in iter_batches(self._rows(uploaded_file), self.batch_size):
+            with transaction.atomic(), analytics.batch():
+                cleaned_rows = [clean_row(row) for _, row in batch]
+
+                existing_markers = {
+                    identifier: tuple(markers)
+                    for identifier, *markers in PatientRecord.objects.filter(
+                        hospital=self.hospital,
+                        patient_identifier__in=[row['patient_identifier'] for row in cleaned_rows]
+                    ).values_list('patient_identifier', *MARKER_FIELDS)
+                }
+
+                to_write = []
+                changes = []  # (old markers or None, new markers), for the analytics summary
+                updated = []
+                new_count = 0
+                for row in cleaned_rows:
+                    identifier = row['patient_identifier']
+                    if identifier in existing_markers:
+                        if existing_markers[identifier] == tuple(row.get(field) for field in MARKER_FIELDS):
+                            self.rows_unchanged += 1
+                            continue
+                        updated.append(identifier)
+                    else:
+                        new_count += 1
+                    # Columns missing from the file are written as empty, like a plain import.
+                    markers = {field: row.get(field) for field in MARKER_FIELDS}
+                    record = PatientRecord(
+                        hospital=self.hospital, uploaded_by=self.uploaded_by, upload_job=self.upload_job,
+                        patient_identifier=identifier, **markers
+                    )
+                    record.risk_flags = risk_flags(record)
+                    to_write.append(record)
+                    changes.append((existing_markers.get(identifier), tuple(markers.values())))
+
+                if to_write:
+                    PatientRecord.objects.bulk_create(
+                        to_write,
+                        update_conflicts=True,
+                        unique_fields=['hospital', 'patient_identifier'],
+                        # Existing records keep their uploader and upload job; only the markers change.
+                        update_fields=MARKER_FIELDS + ['risk_flags', 'updated_at'],
+                    )
+                    analytics.records_changed(self.hospital.pk, changes)
+                if updated:
+                    RiskAssessment.objects.filter(
+                        patient_record__hospital=self.hospital, patient_record__patient_identifier__in=updated,
+                    ).update(markers_changed=True)
+            # Counted once the batch is committed, so the published progress matches the database.
+            self.rows_inserted += new_count
+            self.rows_updated += len(updated)
+            self._report_progress()
@@ -0,0 +1,201 @@
+# health_app/exports.py
+"""
+Streaming export of reviewed risk assessments.
+
+Rows are read as flat tuples with `values_list(...).iterator()`, so no model
+instances are built and only one chunk of rows is held in memory. The encoders
+turn the rows into byte chunks for a `StreamingHttpResponse`, so the download
+starts with the first chunk and can be consumed while it is still generated.
+
+Formats:
+- csv: the original spreadsheet-friendly layout.
+- ndjson: one JSON object per line, with ISO 8601 timestamps.
+- csv.gz: the CSV layout, gzip-compressed as it is streamed.
+
+Incremental export: rows are ordered by (reviewed_at, id), and every export
+returns a cursor for its last row. Passing that cursor (or a `since` timestamp)
+back returns only the assessments reviewed after it, so a nightly sync reads
+only new reviews through the `assessment_status_reviewed` index.
+
+Reviewed assessments without a `reviewed_at` are left out, since they have no
+place in that order. The review view always sets it; migration 0015 backfilled
+the older rows that lacked it.
+"""
+import base64
+import binascii
+import csv
+import io
+import json
+import zlib
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import RiskAssessment
+from .thresholds import MARKER_FIELDS
+
+CSV_HEADER = [
+    'Patient Identifier', 'Glucose', 'HbA1c', 'Total Cholesterol', 'LDL', 'HDL',
+    'Triglycerides', 'ALT', 'AST', 'Creatinine', 'Urea', 'CRP', 'WBC',
+    'AI Generated Report', 'Doctor Comments', 'Reviewed By (Doctor)', 'Reviewed At'
+]
+
+EXPORT_FIELDS = (
+    ['patient_record__patient_identifier']
+    + [f'patient_record__{field}' for field in MARKER_FIELDS]
+    + ['ai_generated_report', 'doctor_comments', 'reviewed_by_id', 'reviewed_by__first_name', 'reviewed_by__last_name', 'reviewed_at']
+)
+
+
+class InvalidCursor(ValueError):
+    """The `since` timestamp or cursor token could not be parsed."""
+
+
+def encode_cursor(reviewed_at, pk):
+    """An opaque, URL-safe token for the position (reviewed_at, pk)."""
+    payload = json.dumps({'t': reviewed_at.isoformat(), 'id': pk}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        reviewed_at = parse_datetime(payload['t'])
+        pk = int(payload['id'])
+    except (binascii.Error, ValueError, TypeError, KeyError) as e:
+        raise InvalidCursor("Invalid cursor.") from e
+    if reviewed_at is None:
+        raise InvalidCursor("Invalid cursor.")
+    return reviewed_at, pk
+
+
+def parse_since(value):
+    """Parses an ISO 8601 `since` timestamp; naive values are in the server's time zone."""
+    try:
+        since = parse_datetime(value)
+    except ValueError:
+        since = None
+    if since is None:
+        raise InvalidCursor("Invalid since timestamp. Use ISO 8601, e.g. 2026-01-31T00:00:00Z.")
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def reviewed_assessments(hospital, since=None, cursor=None):
+    """
+    The hospital's reviewed assessments in (reviewed_at, id) order, without those missing a reviewed_at.
+    `since` keeps those reviewed after a timestamp; `cursor` (a decoded token) those after that position.
+    """
+    queryset = RiskAssessment.objects.filter(
+        status=RiskAssessment.Status.REVIEWED,
+        patient_record__hospital=hospital,
+        reviewed_at__isnull=False,
+    )
+    if since is not None:
+        queryset = queryset.filter(reviewed_at__gt=since)
+    if cursor is not None:
+        reviewed_at, pk = cursor
+        queryset = queryset.filter(Q(reviewed_at__gt=reviewed_at) | Q(reviewed_at=reviewed_at, pk__gt=pk))
+    return queryset.order_by('reviewed_at', 'pk')
+
+
+def bound_to_watermark(queryset):
+    """
+    Fixes the end of an export before it starts streaming.
+    Returns the queryset limited to rows up to the current last row, plus the cursor for that row
+    (None if there are no rows). Reviews that land while streaming are left for the next sync.
+    """
+    # PostgreSQL sorts NULLs first in descending order; a NULL watermark would match no rows.
+    last = queryset.order_by(F('reviewed_at').desc(nulls_last=True), '-pk').values_list('reviewed_at', 'pk').first()
+    if last is None:
+        return queryset.none(), None
+    reviewed_at, pk = last
+    bounded = queryset.filter(Q(reviewed_at__lt=reviewed_at) | Q(reviewed_at=reviewed_at, pk__lte=pk))
+    return bounded, encode_cursor(reviewed_at, pk)
+
+
+def iter_export_rows(queryset, chunk_size=None):
+    """
+    Yields one dict per assessment, built from flat tuples.
+    The keys are the NDJSON field names; `reviewed_by` is the doctor's full name, or None.
+    """
+    rows = queryset.values_list(*EXPORT_FIELDS).iterator(chunk_size=chunk_size or settings.EXPORT_CHUNK_SIZE)
+    for identifier, *values in rows:
+        markers = values[:len(MARKER_FIELDS)]
+        report, comments, reviewed_by_id, first_name, last_name, reviewed_at = values[len(MARKER_FIELDS):]
+        yield {
+            'patient_identifier': identifier,
+            **dict(zip(MARKER_FIELDS, markers)),
+            'ai_generated_report': report,
+            'doctor_comments': comments,
+            # Same as User.get_full_name(), without loading the user.
+            'reviewed_by': f"{first_name} {last_name}".strip() if reviewed_by_id else None,
+            'reviewed_at': reviewed_at,
+        }
+
+
+def _buffered(rows, write_row, rows_per_chunk):
+    """Writes rows into a text buffer and yields it as one UTF-8 chunk every rows_per_chunk rows."""
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        write_row(buffer, row)
+        count += 1
+        if count % rows_per_chunk == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def encode_csv(rows, rows_per_chunk=500):
+    writer = None
+
+    def write_row(buffer, row):
+        nonlocal writer
+        if writer is None:
+            writer = csv.writer(buffer)
+        writer.writerow([
+            row['patient_identifier'],
+            *(row[field] for field in MARKER_FIELDS),
+            row['ai_generated_report'],
+            row['doctor_comments'],
+            row['reviewed_by'] if row['reviewed_by'] is not None else 'N/A',
+            row['reviewed_at'].strftime("%Y-%m-%d %H:%M") if row['reviewed_at'] else 'N/A',
+        ])
+
+    header = io.StringIO()
+    csv.writer(header).writerow(CSV_HEADER)
+    yield header.getvalue().encode('utf-8')
+    yield from _buffered(rows, write_row, rows_per_chunk)
+
+
+def encode_ndjson(rows, rows_per_chunk=500):
+    def write_row(buffer, row):
+        row = dict(row, reviewed_at=row['reviewed_at'].isoformat() if row['reviewed_at'] else None)
+        buffer.write(json.dumps(row, ensure_ascii=False))
+        buffer.write('\n')
+
+    yield from _buffered(rows, write_row, rows_per_chunk)
+
+
+def gzip_chunks(chunks):
+    """Gzip-compresses a stream of byte chunks as they are produced."""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # 16+: write a gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+# format -> (content type, file extension, encoder)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv', encode_csv),
+    'ndjson': ('application/x-ndjson', 'ndjson', encode_ndjson),
+    'csv.gz': ('application/gzip', 'csv.gz', lambda rows: gzip_chunks(encode_csv(rows))),
+}
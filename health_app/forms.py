@@ -1,6 +1,8 @@
 # health_app/forms.py
 from django import forms
+from django.db.models import F
 from .models import User,PatientRecord, RiskAssessment
+from .thresholds import MARKERS, marker_bit
 
 class HospitalRegistrationForm(forms.Form):
     hospital_name = forms.CharField(max_length=200, required=True, widget=forms.TextInput(attrs={'placeholder': 'General Hospital'}))
@@ -47,6 +49,12 @@ class CSVUploadForm(forms.Form):
         help_text="File must be in CSV format with specific headers.",
         widget=forms.ClearableFileInput(attrs={'class': 'form-control', 'accept': '.csv'})
     )
+    upsert = forms.BooleanField(
+        required=False,
+        label="Update existing patients",
+        help_text="Use this for cumulative lab files: patients that already exist get their markers updated instead of the upload being rejected.",
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
 
     def clean_csv_file(self):
         file = self.cleaned_data.get('csv_file')
@@ -106,4 +114,53 @@ class DoctorReviewForm(forms.ModelForm):
         }
         labels = {
             'doctor_comments': "Doctor's Final Review and Comments"
-        }
\ No newline at end of file
+        }
+class PatientSearchForm(forms.Form):
+    """
+    Cohort search on the patient list, read from GET parameters:
+    - q: patient identifier prefix (case-sensitive),
+    - flagged: markers that must all be abnormal per the rule table (uses PatientRecord.risk_flags),
+    - <marker>__gt / __gte / __lt / __lte: numeric range predicates on any marker,
+      e.g. ?hba1c__gte=6.5&ldl__gt=130. The form shows __gte and __lte as min/max.
+    """
+    RANGE_LOOKUPS = ('gt', 'gte', 'lt', 'lte')
+
+    q = forms.CharField(
+        required=False, max_length=100, label="Patient ID starts with",
+        widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'e.g., P00'})
+    )
+    flagged = forms.MultipleChoiceField(
+        required=False, label="Abnormal markers",
+        choices=[(marker.field, marker.name) for marker in MARKERS],
+        widget=forms.CheckboxSelectMultiple
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for marker in MARKERS:
+            for lookup in self.RANGE_LOOKUPS:
+                self.fields[f"{marker.field}__{lookup}"] = forms.FloatField(
+                    required=False, label=f"{marker.name} ({lookup})",
+                    widget=forms.NumberInput(attrs={'class': 'form-control form-control-sm', 'step': 'any'})
+                )
+
+    def marker_ranges(self):
+        """(marker, min field, max field) for the template's min/max grid."""
+        return [(marker, self[f"{marker.field}__gte"], self[f"{marker.field}__lte"]) for marker in MARKERS]
+
+    def has_filters(self):
+        return self.is_bound and self.is_valid() and any(value not in (None, '', []) for value in self.cleaned_data.values())
+
+    def filter(self, queryset):
+        """Applies the search to a PatientRecord queryset. Call only on a valid form."""
+        data = self.cleaned_data
+        if data['q']:
+            queryset = queryset.filter(patient_identifier__startswith=data['q'])
+        if data['flagged']:
+            mask = sum(marker_bit(field) for field in data['flagged'])
+            queryset = queryset.alias(selected_flags=F('risk_flags').bitand(mask)).filter(selected_flags=mask)
+        ranges = {
+            name: value for name, value in data.items()
+            if '__' in name and value is not None
+        }
+        return queryset.filter(**ranges)
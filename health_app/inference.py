@@ -0,0 +1,373 @@
+# health_app/inference.py
+"""
+Inference backends used by `services.py`.
+
+AI_INFERENCE_BACKEND selects one:
+- "huggingface": `huggingface_hub.InferenceClient`, for production; needs HUGGING_FACE_API_KEY.
+- "stub": `StubInferenceClient`, deterministic and in-process, for tests and development.
+  Its latency is configurable (AI_STUB_LATENCY, AI_STUB_TOKEN_LATENCY), so load tests see
+  realistic timings.
+- "http": `HTTPInferenceClient`, which calls any OpenAI-compatible chat completions server
+  at AI_INFERENCE_URL, e.g. `manage.py serve_inference_stub`, llama.cpp or vLLM.
+- Or the dotted path of a callable that returns a client.
+
+Every client has a `chat_completion(messages, model=None, max_tokens=None, stream=False)`
+that returns objects shaped like huggingface_hub's: `.choices[0].message.content` and
+`.usage`, or, for streams, an iterator of chunks with `.choices[0].delta.content`.
+
+`get_inference_client()` builds the client on first use and reuses it. Neither
+huggingface_hub nor requests is imported until then. So web workers and management
+commands start without them, and without needing an API key.
+
+`get_async_inference_client()` is the same for the async views of an ASGI worker
+(see config/asgi.py): the backend's client from ASYNC_BACKENDS, whose
+`chat_completion` is a coroutine and whose streams are async iterators. For
+"huggingface" that is `huggingface_hub.AsyncInferenceClient`. The async clients hold
+aiohttp sessions, which belong to one event loop, so one client is kept per loop.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+import weakref
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+BACKENDS = {
+    'huggingface': 'health_app.inference.huggingface_client',
+    'stub': 'health_app.inference.StubInferenceClient',
+    'http': 'health_app.inference.HTTPInferenceClient',
+}
+
+ASYNC_BACKENDS = {
+    'huggingface': 'health_app.inference.huggingface_async_client',
+    'stub': 'health_app.inference.AsyncStubInferenceClient',
+    'http': 'health_app.inference.AsyncHTTPInferenceClient',
+}
+
+# The per-patient header of a batched prompt (services.BATCH_PATIENT_HEADER), for the stub.
+BATCH_PATIENT_PATTERN = re.compile(r"^\s*=== PATIENT (\d+) ===\s*$", re.MULTILINE)
+
+_clients = {}
+_clients_lock = threading.Lock()
+# {event loop: {backend: client}}
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_inference_client():
+    """Returns the client of the AI_INFERENCE_BACKEND setting, building it on first use."""
+    backend = settings.AI_INFERENCE_BACKEND
+    client = _clients.get(backend)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(backend)
+            if client is None:
+                client = _clients[backend] = import_string(BACKENDS.get(backend, backend))()
+    return client
+
+
+def get_async_inference_client():
+    """Returns the async client of the AI_INFERENCE_BACKEND setting for the running event loop, building it on first use."""
+    backend = settings.AI_INFERENCE_BACKEND
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(backend)
+    if client is None:
+        client = clients[backend] = import_string(ASYNC_BACKENDS.get(backend, backend))()
+    return client
+
+
+@receiver(setting_changed)
+def reset_inference_clients(*, setting, **kwargs):
+    # Tests override the backend settings; the next call must build a client from the new values.
+    if setting.startswith('AI_INFERENCE') or setting == 'HUGGING_FACE_API_KEY':
+        _clients.clear()
+        _async_clients.clear()
+
+
+@checks.register()
+def check_inference_backend(app_configs, **kwargs):
+    # A warning, not an error: migrations and other commands don't need the key.
+    if settings.AI_INFERENCE_BACKEND == 'huggingface' and not settings.HUGGING_FACE_API_KEY:
+        return [checks.Warning(
+            "HUGGING_FACE_API_KEY is not set, so AI analyses will fail.",
+            hint="Set HUGGING_FACE_API_KEY, or AI_INFERENCE_BACKEND=stub for local development.",
+            id='health_app.W001',
+        )]
+    return []
+
+
+def huggingface_client():
+    if not settings.HUGGING_FACE_API_KEY:
+        raise ImproperlyConfigured("HUGGING_FACE_API_KEY is not set; it is required by the 'huggingface' inference backend.")
+    from huggingface_hub import InferenceClient
+    return InferenceClient(token=settings.HUGGING_FACE_API_KEY, timeout=settings.AI_INFERENCE_TIMEOUT)
+
+
+def huggingface_async_client():
+    if not settings.HUGGING_FACE_API_KEY:
+        raise ImproperlyConfigured("HUGGING_FACE_API_KEY is not set; it is required by the 'huggingface' inference backend.")
+    from huggingface_hub import AsyncInferenceClient
+    return AsyncInferenceClient(token=settings.HUGGING_FACE_API_KEY, timeout=settings.AI_INFERENCE_TIMEOUT)
+
+
+class StubInferenceClient:
+    """
+    A deterministic, in-process stand-in for `InferenceClient.chat_completion`.
+    It needs no network access or API key.
+    The report depends only on the prompt, so identical inputs give identical output.
+
+    `latency` is the delay before the first token and `token_latency` the delay per
+    generated token, in seconds; when None they are read from the settings on each call.
+    """
+
+    def __init__(self, latency=None, token_latency=None):
+        self.latency = latency
+        self.token_latency = token_latency
+
+    def _latencies(self):
+        return (
+            settings.AI_STUB_LATENCY if self.latency is None else self.latency,
+            settings.AI_STUB_TOKEN_LATENCY if self.token_latency is None else self.token_latency,
+        )
+
+    def chat_completion(self, messages, model=None, max_tokens=None, stream=False, **kwargs):
+        prompt = messages[-1]["content"]
+        content = self._report_for(prompt)
+        if stream:
+            return self._stream(content, model, prompt)
+
+        latency, token_latency = self._latencies()
+        if latency or token_latency:
+            self._sleep(latency + token_latency * len(content.split()))
+        return self._response(content, model, prompt)
+
+    def _response(self, content, model, prompt):
+        prompt_tokens = len(prompt.split())
+        completion_tokens = len(content.split())
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(index=0, finish_reason="stop", message=SimpleNamespace(role="assistant", content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+
+    def _stream(self, content, model, prompt):
+        """Yields the report word by word, shaped like `ChatCompletionStreamOutput` chunks."""
+        latency, token_latency = self._latencies()
+        if latency:
+            self._sleep(latency)
+        chunks = self._chunks(content, model, prompt)
+        for i, chunk in enumerate(chunks):
+            if token_latency and 0 < i < len(chunks) - 2:
+                time.sleep(token_latency)
+            yield chunk
+
+    def _chunks(self, content, model, prompt):
+        """One chunk per word, then the "stop" chunk and the usage chunk."""
+        words = content.split(" ")
+        chunks = [
+            SimpleNamespace(
+                model=model,
+                choices=[SimpleNamespace(index=0, finish_reason=None, delta=SimpleNamespace(role="assistant", content=word if i == 0 else " " + word))],
+            )
+            for i, word in enumerate(words)
+        ]
+        chunks.append(SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(index=0, finish_reason="stop", delta=SimpleNamespace(role="assistant", content=None))],
+        ))
+        # Like OpenAI-compatible providers with stream_options={"include_usage": True}.
+        chunks.append(SimpleNamespace(model=model, choices=[], usage=SimpleNamespace(
+            prompt_tokens=len(prompt.split()), completion_tokens=len(words), total_tokens=len(prompt.split()) + len(words),
+        )))
+        return chunks
+
+    def _sleep(self, seconds):
+        # A real client gives up after AI_INFERENCE_TIMEOUT; so does the stub, to simulate a slow provider.
+        if seconds > settings.AI_INFERENCE_TIMEOUT:
+            time.sleep(settings.AI_INFERENCE_TIMEOUT)
+            raise TimeoutError(f"The stub backend timed out after {settings.AI_INFERENCE_TIMEOUT}s.")
+        time.sleep(seconds)
+
+    def _report_for(self, prompt):
+        # A batched prompt (see services.build_batch_prompt) gets one numbered report per patient.
+        patients = BATCH_PATIENT_PATTERN.split(prompt)
+        if len(patients) > 1:
+            return "\n\n".join(
+                f"=== REPORT {number} ===\n" + self._single_report(section).removesuffix("```")
+                for number, section in zip(patients[1::2], patients[2::2])
+            ) + "```"
+        return self._single_report(prompt)
+
+    def _single_report(self, prompt):
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+        # Prefix some chatter before the anchor, like the real model sometimes does,
+        # so the report cleaning logic in services.py is exercised as well.
+        return (
+            "Sure, here is the assessment.\n\n"
+            "### Overall Risk Summary\n"
+            f"Stub assessment generated locally (ref {digest}). No model was called.\n\n"
+            "### Markers of Concern\n"
+            "- Not evaluated by the stub backend.\n\n"
+            "### Recommendations for Reviewer\n"
+            "- Review the raw marker values directly.\n"
+            "```"
+        )
+
+
+class AsyncStubInferenceClient(StubInferenceClient):
+    """`StubInferenceClient` for async callers: the same output, with the latency spent in `asyncio.sleep`."""
+
+    async def chat_completion(self, messages, model=None, max_tokens=None, stream=False, **kwargs):
+        prompt = messages[-1]["content"]
+        content = self._report_for(prompt)
+        if stream:
+            return self._astream(content, model, prompt)
+
+        latency, token_latency = self._latencies()
+        if latency or token_latency:
+            await self._asleep(latency + token_latency * len(content.split()))
+        return self._response(content, model, prompt)
+
+    async def _astream(self, content, model, prompt):
+        latency, token_latency = self._latencies()
+        if latency:
+            await self._asleep(latency)
+        chunks = self._chunks(content, model, prompt)
+        for i, chunk in enumerate(chunks):
+            if token_latency and 0 < i < len(chunks) - 2:
+                await asyncio.sleep(token_latency)
+            yield chunk
+
+    async def _asleep(self, seconds):
+        if seconds > settings.AI_INFERENCE_TIMEOUT:
+            await asyncio.sleep(settings.AI_INFERENCE_TIMEOUT)
+            raise TimeoutError(f"The stub backend timed out after {settings.AI_INFERENCE_TIMEOUT}s.")
+        await asyncio.sleep(seconds)
+
+
+class _Payload(SimpleNamespace):
+    """A JSON object with attribute access. Absent fields read as None, as on huggingface_hub's dataclasses."""
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+
+def _from_json(value):
+    if isinstance(value, dict):
+        return _Payload(**{key: _from_json(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_from_json(item) for item in value]
+    return value
+
+
+def to_json(value):
+    """The JSON-serializable form of a response or chunk (SimpleNamespace trees), as sent over HTTP."""
+    if isinstance(value, SimpleNamespace):
+        return {key: to_json(item) for key, item in vars(value).items()}
+    if isinstance(value, list):
+        return [to_json(item) for item in value]
+    return value
+
+
+class HTTPInferenceClient:
+    """
+    Calls an OpenAI-compatible `POST {AI_INFERENCE_URL}/chat/completions` endpoint.
+    Streams are read as server-sent events, ending with `data: [DONE]`.
+    Each thread keeps its own HTTP session, so connections are reused by the worker's thread pool.
+    """
+
+    def __init__(self, base_url=None, api_key=None, timeout=None):
+        self.base_url = (base_url or settings.AI_INFERENCE_URL).rstrip('/')
+        self.api_key = api_key if api_key is not None else settings.AI_INFERENCE_API_KEY
+        self.timeout = timeout or settings.AI_INFERENCE_TIMEOUT
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+            if self.api_key:
+                session.headers['Authorization'] = f"Bearer {self.api_key}"
+        return session
+
+    def chat_completion(self, messages, model=None, max_tokens=None, stream=False, **kwargs):
+        payload = {'model': model, 'messages': messages, 'max_tokens': max_tokens, 'stream': stream, **kwargs}
+        response = self._session().post(f"{self.base_url}/chat/completions", json=payload, stream=stream, timeout=self.timeout)
+        response.raise_for_status()
+        if stream:
+            return self._events(response)
+        return _from_json(response.json())
+
+    def _events(self, response):
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    return
+                yield _from_json(json.loads(data))
+
+
+class AsyncHTTPInferenceClient(HTTPInferenceClient):
+    """`HTTPInferenceClient` for async callers, over one aiohttp session (per event loop, see `get_async_inference_client`)."""
+
+    def __init__(self, base_url=None, api_key=None, timeout=None):
+        super().__init__(base_url, api_key, timeout)
+        self._aiohttp_session = None
+
+    def _async_session(self):
+        if self._aiohttp_session is None:
+            import aiohttp
+            headers = {'Authorization': f"Bearer {self.api_key}"} if self.api_key else None
+            self._aiohttp_session = aiohttp.ClientSession(
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                # The default limit of 100 connections would cap the calls an ASGI worker has in flight.
+                connector=aiohttp.TCPConnector(limit=0),
+            )
+        return self._aiohttp_session
+
+    async def aclose(self):
+        """Closes the HTTP session. An ASGI worker's session lives as long as its event loop, i.e. the process."""
+        if self._aiohttp_session is not None:
+            await self._aiohttp_session.close()
+            self._aiohttp_session = None
+
+    async def chat_completion(self, messages, model=None, max_tokens=None, stream=False, **kwargs):
+        payload = {'model': model, 'messages': messages, 'max_tokens': max_tokens, 'stream': stream, **kwargs}
+        response = await self._async_session().post(f"{self.base_url}/chat/completions", json=payload)
+        if response.status >= 400:
+            response.release()
+        response.raise_for_status()
+        if stream:
+            return self._aevents(response)
+        async with response:
+            return _from_json(await response.json())
+
+    async def _aevents(self, response):
+        async with response:
+            async for line in response.content:
+                line = line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    return
+                yield _from_json(json.loads(data))
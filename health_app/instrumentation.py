@@ -0,0 +1,157 @@
+# health_app/instrumentation.py
+"""
+Per-request timings: where a slow page spent its time.
+
+`PerformanceMiddleware` (middleware.py) starts a `RequestTimings` for every request
+and makes it current. While it is current:
+- every SQL query is timed and counted by a database execute wrapper, which is
+  installed on each connection as it is opened,
+- code wrapped in `timed(category)` adds its duration to that category. The model
+  call in services.py is timed as "inference", and markdown rendering in rendering.py
+  as "render".
+
+Outside a request (the job worker, management commands) `timed` does nothing.
+The state lives in a context variable, so concurrent requests in threads or async
+tasks don't mix their timings. asgiref copies it into the threads that run an async
+view's ORM calls, so their queries are counted too.
+"""
+import contextvars
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    def __init__(self, max_queries_kept=50):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.durations = defaultdict(float)  # category -> seconds
+        self.counts = Counter()              # category -> number of timed calls
+        self.queries = []                    # (sql, seconds), at most max_queries_kept
+        self.max_queries_kept = max_queries_kept
+
+    def add(self, category, seconds):
+        self.durations[category] += seconds
+        self.counts[category] += 1
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """A `connection.execute_wrapper` that times and keeps each query (without its parameters)."""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.add('db', elapsed)
+            if len(self.queries) < self.max_queries_kept:
+                self.queries.append((sql, elapsed))
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    @property
+    def total(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def milliseconds(self, category):
+        return round(self.durations.get(category, 0.0) * 1000, 2)
+
+    def server_timing(self):
+        """The Server-Timing header value, shown per request in the browser's network panel."""
+        return ", ".join([
+            f'db;dur={self.milliseconds("db")};desc="{self.counts["db"]} queries"',
+            f'inference;dur={self.milliseconds("inference")}',
+            f'render;dur={self.milliseconds("render")}',
+            f'total;dur={round(self.total * 1000, 2)}',
+        ])
+
+    def as_dict(self):
+        return {
+            'total_ms': round(self.total * 1000, 2),
+            'db_ms': self.milliseconds('db'),
+            'queries': self.counts['db'],
+            'inference_ms': self.milliseconds('inference'),
+            'inference_calls': self.counts['inference'],
+            'render_ms': self.milliseconds('render'),
+        }
+
+
+def activate(timings):
+    """Makes `timings` current; returns a token for `deactivate`."""
+    return _current.set(timings)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def current_timings():
+    return _current.get()
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    """Times the query for the current request, if there is one."""
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    return timings.execute_wrapper(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_execute_wrapper(sender, connection, **kwargs):
+    # Fires again when a closed connection reconnects; the wrapper list outlives the connection.
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(execute_wrapper)
+
+
+@contextmanager
+def timed(category):
+    """Adds the duration of the block to `category` of the current request, if there is one."""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(category, time.perf_counter() - started)
+
+
+def timed_iter(iterable, category):
+    """
+    Yields from `iterable`, adding only the time spent producing each item to `category`,
+    e.g. a token stream, whose consumer does other work between the tokens.
+    """
+    timings = _current.get()
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            if timings is not None:
+                timings.durations[category] += time.perf_counter() - started
+        yield item
+
+
+async def timed_aiter(aiterable, category):
+    """`timed_iter` for async iterables, e.g. the token stream of an async inference client."""
+    timings = _current.get()
+    iterator = aiter(aiterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = await anext(iterator)
+        except StopAsyncIteration:
+            return
+        finally:
+            if timings is not None:
+                timings.durations[category] += time.perf_counter() - started
+        yield item
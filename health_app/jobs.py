@@ -0,0 +1,397 @@
+# health_app/jobs.py
+"""
+A small database-backed job queue for AI analysis and CSV imports.
+
+The web process only inserts `AnalysisJob` / `UploadJob` rows; the slow work (the
+`chat_completion` round trip, importing a large file) happens in a separate worker
+process (`manage.py run_analysis_worker`), so gunicorn workers are never held for
+the duration of an LLM call or hit their timeout on a big upload.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from . import analytics
+from .csv_import import CSVReadError, PatientCSVImporter
+from .models import AnalysisJob, PatientRecord, RiskAssessment, UploadJob
+from .resilience import CircuitBreaker, InferenceUnavailable, inference_breaker
+from .services import generate_risk_assessment_for_record, generate_risk_assessments_for_records, report_prompt_version
+from .thresholds import annotate_risk, evaluate_record, templated_normal_report
+
+# The result of an analysis that was not attempted because the circuit breaker was open.
+DEFERRED = object()
+
+
+def enqueue_analysis(patient_record, requested_by=None):
+    """
+    Queues an analysis job for the record and returns it.
+    If a job for this record is already queued or running, that job is returned instead.
+    """
+    while True:
+        active_job = AnalysisJob.objects.filter(
+            patient_record=patient_record,
+            status__in=[AnalysisJob.Status.QUEUED, AnalysisJob.Status.RUNNING],
+        ).first()
+        if active_job:
+            return active_job
+        try:
+            with transaction.atomic():
+                return AnalysisJob.objects.create(patient_record=patient_record, requested_by=requested_by)
+        except IntegrityError:
+            # A concurrent request queued one after our check (analysisjob_one_active_per_record).
+            continue
+
+
+def enqueue_bulk_analysis(patient_records, requested_by=None):
+    """
+    Queues one job per record in a single INSERT, skipping records that are already
+    analyzed or already have a queued/running job. Returns the number of jobs created
+    (a record queued by a concurrent request meanwhile is skipped, but still counted).
+    """
+    active_jobs = AnalysisJob.objects.filter(
+        patient_record=OuterRef('pk'),
+        status__in=[AnalysisJob.Status.QUEUED, AnalysisJob.Status.RUNNING],
+    )
+    record_ids = patient_records.filter(assessment__isnull=True).exclude(
+        Exists(active_jobs)
+    ).order_by('created_at').values_list('pk', flat=True)
+
+    jobs = [AnalysisJob(patient_record_id=pk, requested_by=requested_by) for pk in record_ids]
+    AnalysisJob.objects.bulk_create(jobs, batch_size=settings.AI_ASSESSMENT_BATCH_SIZE, ignore_conflicts=True)
+    return len(jobs)
+
+
+def assess_normal_records(patient_records):
+    """
+    Writes templated reports for every unanalyzed record whose markers are all normal.
+    The records are scored in one SQL query and need no LLM call, so this is cheap
+    enough to run inside the request. Returns the number of assessments created.
+    """
+    normal_records = annotate_risk(patient_records.filter(assessment__isnull=True)).filter(risk_level=0)
+    assessments = []
+    for record in normal_records.iterator(chunk_size=settings.AI_ASSESSMENT_BATCH_SIZE):
+        assessment = RiskAssessment(patient_record=record, ai_generated_report=templated_normal_report(evaluate_record(record)))
+        assessment.render_html()  # bulk_create skips save(), which would render it
+        assessments.append(assessment)
+    return len(_create_assessments(assessments))
+
+
+def enqueue_upload(uploaded_file, hospital, uploaded_by, upsert=False):
+    """Spools the uploaded CSV to disk (chunk by chunk) and queues an import job for it."""
+    job = UploadJob(hospital=hospital, uploaded_by=uploaded_by, original_name=uploaded_file.name, upsert=upsert)
+    job.csv_file.save(uploaded_file.name, uploaded_file, save=False)
+    job.save()
+    return job
+
+
+def requeue_stale_jobs():
+    """
+    Puts RUNNING jobs that have not finished within AI_JOB_STALE_AFTER seconds back in the queue.
+    This recovers jobs whose worker died mid-call. A stale import first has its partial records removed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.AI_JOB_STALE_AFTER)
+    requeued = AnalysisJob.objects.filter(
+        status=AnalysisJob.Status.RUNNING,
+        started_at__lt=cutoff,
+    ).update(status=AnalysisJob.Status.QUEUED, started_at=None)
+
+    stale_uploads = UploadJob.objects.filter(status=UploadJob.Status.RUNNING, started_at__lt=cutoff)
+    with analytics.batch():
+        PatientRecord.objects.filter(upload_job__in=stale_uploads).delete()
+    requeued += stale_uploads.update(
+        status=UploadJob.Status.QUEUED, started_at=None,
+        rows_parsed=0, rows_validated=0, rows_inserted=0, rows_updated=0, rows_unchanged=0, error_count=0, errors=[],
+    )
+    return requeued
+
+
+def claim_next_job(model=AnalysisJob):
+    """
+    Atomically moves the oldest QUEUED job of `model` (AnalysisJob or UploadJob) to RUNNING
+    and returns it, or None if the queue is empty.
+    The conditional UPDATE acts as a compare-and-set, so several workers can poll safely.
+    """
+    while True:
+        job = model.objects.filter(status=model.Status.QUEUED).order_by('created_at').first()
+        if job is None:
+            return None
+
+        now = timezone.now()
+        claimed = model.objects.filter(pk=job.pk, status=model.Status.QUEUED).update(
+            status=model.Status.RUNNING,
+            started_at=now,
+            attempts=job.attempts + 1,
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+        # Another worker took this job between our SELECT and UPDATE; try the next one.
+
+
+def run_upload_job(job):
+    """
+    Runs a claimed import job. Progress counters are written to the job after every batch,
+    so the progress endpoint can report them while the import is running.
+    """
+    def publish_progress(importer):
+        UploadJob.objects.filter(pk=job.pk).update(
+            rows_parsed=importer.rows_parsed,
+            rows_validated=importer.rows_validated,
+            rows_inserted=importer.rows_inserted,
+            rows_updated=importer.rows_updated,
+            rows_unchanged=importer.rows_unchanged,
+            error_count=importer.error_count,
+        )
+
+    importer = PatientCSVImporter(job.hospital, job.uploaded_by, upload_job=job, upsert=job.upsert, on_progress=publish_progress)
+    try:
+        with job.csv_file.open('rb') as csv_file:
+            imported = importer.run(csv_file)
+        job.status = UploadJob.Status.DONE if imported else UploadJob.Status.FAILED
+    except CSVReadError:
+        importer.add_error(None, None, "Error reading file. Ensure it is a valid UTF-8 encoded CSV.")
+        job.status = UploadJob.Status.FAILED
+    except Exception as e:
+        importer.add_error(None, None, f"An unexpected error occurred: {e}. The upload has been cancelled.")
+        job.status = UploadJob.Status.FAILED
+
+    job.rows_parsed = importer.rows_parsed
+    job.rows_validated = importer.rows_validated
+    job.rows_inserted = importer.rows_inserted
+    job.rows_updated = importer.rows_updated
+    job.rows_unchanged = importer.rows_unchanged
+    job.error_count = importer.error_count
+    job.errors = importer.errors
+    job.finished_at = timezone.now()
+    # The spooled file is no longer needed either way.
+    job.csv_file.delete(save=False)
+    job.save()
+    return job
+
+
+def run_analysis_job(job):
+    """
+    Runs a claimed job: calls the AI service and stores the resulting RiskAssessment.
+    The job ends up DONE or FAILED; exceptions are recorded on the job rather than raised.
+    While the circuit breaker is open, the job goes back to the queue instead.
+    """
+    patient_record = job.patient_record
+    try:
+        if RiskAssessment.objects.filter(patient_record=patient_record).exists():
+            # Nothing to do; the record was analyzed by an earlier job.
+            _finish_job(job, AnalysisJob.Status.DONE)
+            return job
+
+        try:
+            ai_report = generate_risk_assessment_for_record(patient_record)
+        except InferenceUnavailable:
+            _defer_job(job)
+            return job
+        if ai_report.startswith("Error:"):
+            _finish_job(job, AnalysisJob.Status.FAILED, error=ai_report)
+            return job
+
+        RiskAssessment.objects.get_or_create(
+            patient_record=patient_record,
+            defaults={'ai_generated_report': ai_report, 'prompt_version': report_prompt_version(patient_record)},
+        )
+        _finish_job(job, AnalysisJob.Status.DONE)
+    except Exception as e:
+        _finish_job(job, AnalysisJob.Status.FAILED, error=f"Error: {e}")
+    return job
+
+
+def jobs_per_claim(concurrency):
+    """
+    How many jobs a worker running `concurrency` threads claims at a time: a few rounds of
+    batched prompts (AI_BATCH_PROMPT_SIZE records each) per thread, so the pool stays busy.
+    """
+    return (concurrency * 4 if concurrency > 1 else 1) * settings.AI_BATCH_PROMPT_SIZE
+
+
+def claim_jobs(limit):
+    """Claims up to `limit` queued jobs. Returns a (possibly empty) list."""
+    jobs = []
+    while len(jobs) < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def analyze_records_concurrently(patient_records, max_workers=None, batch_size=None, prompt_batch_size=None):
+    """
+    Generates reports for many records at once.
+
+    The `generate_risk_assessment_for_record` calls are spread over a thread pool of at most
+    `max_workers` threads (AI_ANALYSIS_CONCURRENCY by default), so wall-clock time grows with
+    len(records) / max_workers rather than with len(records). Successful reports are written
+    with `bulk_create` every `batch_size` results (AI_ASSESSMENT_BATCH_SIZE by default).
+    With `prompt_batch_size` (AI_BATCH_PROMPT_SIZE by default) above 1, each thread analyzes
+    that many records per model call instead (see `generate_risk_assessments_for_records`).
+
+    Returns a dict mapping each record's pk to None on success, to the error message, or
+    to DEFERRED if the circuit breaker was open.
+    """
+    max_workers = max_workers or settings.AI_ANALYSIS_CONCURRENCY
+    batch_size = batch_size or settings.AI_ASSESSMENT_BATCH_SIZE
+    prompt_batch_size = prompt_batch_size or settings.AI_BATCH_PROMPT_SIZE
+    patient_records = list(patient_records)
+    chunks = [patient_records[i:i + prompt_batch_size] for i in range(0, len(patient_records), prompt_batch_size)]
+    results = {}
+    pending_assessments = []
+
+    def flush():
+        _create_assessments(pending_assessments)
+        pending_assessments.clear()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_generate_in_thread, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                reports = future.result()
+            except InferenceUnavailable:
+                results.update(dict.fromkeys((record.pk for record in chunk), DEFERRED))
+                continue
+            except Exception as e:
+                reports = {record.pk: f"Error: {e}" for record in chunk}
+
+            for record in chunk:
+                ai_report = reports[record.pk]
+                if ai_report.startswith("Error:"):
+                    results[record.pk] = ai_report
+                    continue
+
+                results[record.pk] = None
+                assessment = RiskAssessment(
+                    patient_record=record, ai_generated_report=ai_report, prompt_version=report_prompt_version(record),
+                )
+                assessment.render_html()  # bulk_create skips save(), which would render it
+                pending_assessments.append(assessment)
+                if len(pending_assessments) >= batch_size:
+                    flush()
+
+    if pending_assessments:
+        flush()
+    return results
+
+
+def run_analysis_jobs_concurrently(jobs, max_workers=None, batch_size=None):
+    """Runs a list of claimed jobs through `analyze_records_concurrently` and records each outcome."""
+    already_done = set(RiskAssessment.objects.filter(
+        patient_record__in=[job.patient_record_id for job in jobs]
+    ).values_list('patient_record_id', flat=True))
+
+    to_analyze = [job.patient_record for job in jobs if job.patient_record_id not in already_done]
+    errors = analyze_records_concurrently(to_analyze, max_workers=max_workers, batch_size=batch_size)
+
+    now = timezone.now()
+    for job in jobs:
+        error = errors.get(job.patient_record_id)
+        if error is DEFERRED:
+            job.status, job.error, job.started_at, job.finished_at = AnalysisJob.Status.QUEUED, "", None, None
+            continue
+        job.status = AnalysisJob.Status.FAILED if error else AnalysisJob.Status.DONE
+        job.error = error or ""
+        job.finished_at = now
+    AnalysisJob.objects.bulk_update(
+        jobs, ['status', 'error', 'started_at', 'finished_at'], batch_size=batch_size or settings.AI_ASSESSMENT_BATCH_SIZE,
+    )
+    return jobs
+
+
+def run_pending_jobs(max_jobs=None, concurrency=1):
+    """
+    Claims and runs queued jobs until the queue is empty, max_jobs is reached or the circuit
+    breaker opens. Returns the number run (deferred jobs included).
+    With concurrency > 1, jobs are claimed in groups and analyzed over a thread pool of that size.
+    With AI_BATCH_PROMPT_SIZE above 1, each thread gets that many jobs per model call.
+    """
+    processed = 0
+    while max_jobs is None or processed < max_jobs:
+        if inference_circuit_open():
+            break  # The jobs would only be deferred again
+        limit = jobs_per_claim(concurrency)
+        if max_jobs is not None:
+            limit = min(limit, max_jobs - processed)
+        jobs = claim_jobs(limit)
+        if not jobs:
+            break
+
+        if len(jobs) == 1:
+            run_analysis_job(jobs[0])
+        else:
+            run_analysis_jobs_concurrently(jobs, max_workers=concurrency)
+        processed += len(jobs)
+    return processed
+
+
+def run_pending_uploads():
+    """Runs queued import jobs until there are none left. Returns the number run."""
+    processed = 0
+    while (job := claim_next_job(UploadJob)) is not None:
+        run_upload_job(job)
+        processed += 1
+    return processed
+
+
+def _generate_in_thread(patient_records):
+    """Generates reports for a chunk of records (see `analyze_records_concurrently`); returns {pk: report}."""
+    try:
+        if len(patient_records) == 1:
+            return {patient_records[0].pk: generate_risk_assessment_for_record(patient_records[0])}
+        return generate_risk_assessments_for_records(patient_records, batch_size=len(patient_records))
+    finally:
+        # Each thread gets its own database connection; don't leave it open.
+        connections.close_all()
+
+
+def _create_assessments(assessments):
+    """
+    Inserts the assessments and adds them to the analytics tables; returns the ones inserted.
+    A record may have been given an assessment meanwhile (by a live analysis, say). Then the
+    batch is inserted row by row instead, and the rows that conflict are skipped, so the summary
+    tables count only what was written.
+    """
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                RiskAssessment.objects.bulk_create(assessments, batch_size=settings.AI_ASSESSMENT_BATCH_SIZE)
+            created = list(assessments)
+        except IntegrityError:
+            created = []
+            for assessment in assessments:
+                assessment.pk = None  # It may have been set by a batch that was rolled back
+                try:
+                    with transaction.atomic():
+                        RiskAssessment.objects.bulk_create([assessment])
+                except IntegrityError:
+                    continue
+                created.append(assessment)
+        analytics.assessments_created(created)
+    return created
+
+
+def inference_circuit_open():
+    """Whether the circuit breaker currently rejects model calls, so analysis jobs should wait in the queue."""
+    return inference_breaker().state() == CircuitBreaker.OPEN
+
+
+def _defer_job(job):
+    job.status = AnalysisJob.Status.QUEUED
+    job.error = ""
+    job.started_at = None
+    job.save(update_fields=['status', 'error', 'started_at'])
+
+
+def _finish_job(job, status, error=""):
+    job.status = status
+    job.error = error
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished_at'])
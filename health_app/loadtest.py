@@ -0,0 +1,230 @@
+# health_app/loadtest.py
+"""
+A scripted load driver for the application's pages.
+
+Each scenario drives one URL of `health_app/urls.py` as a logged-in admin or doctor
+(or anonymously, for the login itself) against a synthetic hospital (see synthetic.py).
+Requests go through Django's test client, so the full middleware, view and template
+stack runs in-process and every request's SQL queries can be counted, without a web
+server. With concurrency > 1, each thread has its own client and database connection.
+
+Every scenario reports its p50/p95/p99 latency, throughput and query counts. The
+`worker` section measures the analysis job worker against the stub backend, whose
+latency is configurable (AI_STUB_LATENCY, AI_STUB_TOKEN_LATENCY).
+
+Writes made by the run (queued jobs, uploads, generated reports) are deleted again
+at the end, so repeated runs see the same data.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, NamedTuple
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.models import Max, Q
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import analytics
+from .benchmarking import latency_summary, percentile
+from .jobs import enqueue_bulk_analysis, run_pending_jobs
+from .models import AnalysisJob, PatientRecord, ReportCacheEntry, RiskAssessment, UploadJob, User
+from .synthetic import SYNTHETIC_PASSWORD
+from .thresholds import MARKER_FIELDS
+
+
+class LoadTestError(RuntimeError):
+    """The synthetic data can't support the requested run (e.g. too few unanalyzed records)."""
+
+
+class Scenario(NamedTuple):
+    name: str
+    role: str                 # 'admin', 'doctor', or '' for an anonymous client
+    expected_status: int
+    send: Callable            # (LoadContext, Client) -> HttpResponse
+
+
+class LoadContext:
+    """The synthetic hospital's users and the ids the scenarios pick from. Thread-safe."""
+
+    def __init__(self, hospital, seed=0):
+        self.hospital = hospital
+        self.admin = User.objects.filter(hospital=hospital, role=User.Role.HOSPITAL_ADMIN).order_by('pk').first()
+        self.doctor = User.objects.filter(hospital=hospital, role=User.Role.DOCTOR).order_by('pk').first()
+        if self.admin is None or self.doctor is None:
+            raise LoadTestError(f"{hospital.name} needs an admin and a doctor.")
+        # Reports assigned to another doctor redirect the doctor away, so only pick viewable ones.
+        self.assessment_ids = list(RiskAssessment.objects.filter(
+            Q(assigned_doctor__isnull=True) | Q(assigned_doctor=self.doctor), patient_record__hospital=hospital,
+        ).values_list('pk', flat=True)[:5000])
+        self.unanalyzed_ids = list(PatientRecord.objects.filter(
+            hospital=hospital, assessment__isnull=True, analysis_jobs__isnull=True).values_list('pk', flat=True))
+        # Everything with a larger pk than these was written by the run, and is deleted afterwards.
+        self.high_water = {
+            model: model.objects.aggregate(last=Max('pk'))['last'] or 0
+            for model in (AnalysisJob, UploadJob, RiskAssessment, ReportCacheEntry)
+        }
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._uploads = 0
+
+    def user_for(self, role):
+        return {'admin': self.admin, 'doctor': self.doctor}.get(role)
+
+    def random_assessment(self):
+        if not self.assessment_ids:
+            raise LoadTestError(f"{self.hospital.name} has no assessments.")
+        with self._lock:
+            return self.rng.choice(self.assessment_ids)
+
+    def next_unanalyzed(self):
+        with self._lock:
+            if not self.unanalyzed_ids:
+                raise LoadTestError(f"{self.hospital.name} has run out of unanalyzed records; seed more records.")
+            return self.unanalyzed_ids.pop()
+
+    def csv_upload(self, rows=100):
+        with self._lock:
+            self._uploads += 1
+            number = self._uploads
+        header = "patient_identifier," + ",".join(MARKER_FIELDS) + "\n"
+        body = "".join(f"LOAD-{number:05}-{i:04}," + ",".join(["100"] * len(MARKER_FIELDS)) + "\n" for i in range(rows))
+        return SimpleUploadedFile(f"load-{number}.csv", (header + body).encode())
+
+    def clean_up(self):
+        """Deletes what the run wrote: queued jobs, uploads (and their files), reports and cache entries."""
+        for upload in UploadJob.objects.filter(pk__gt=self.high_water[UploadJob]):
+            if upload.csv_file:
+                upload.csv_file.delete(save=False)
+        with analytics.batch():
+            for model, last_pk in self.high_water.items():
+                model.objects.filter(pk__gt=last_pk).delete()
+
+
+def _login(ctx, client):
+    # Start without a session every time; a logged-in client would just be redirected.
+    client.cookies.clear()
+    return client.post(reverse('login'), {'username': ctx.admin.username, 'password': SYNTHETIC_PASSWORD})
+
+
+SCENARIOS = [
+    Scenario('login', '', 302, _login),
+    Scenario('admin_dashboard', 'admin', 200, lambda ctx, client: client.get(reverse('admin_dashboard'))),
+    Scenario('patient_list', 'admin', 200, lambda ctx, client: client.get(reverse('patient_list'))),
+    Scenario('patient_search', 'admin', 200, lambda ctx, client: client.get(
+        reverse('patient_list'), {'hba1c__gte': 6.5, 'flagged': 'ldl'})),
+    Scenario('doctor_dashboard', 'doctor', 200, lambda ctx, client: client.get(reverse('doctor_dashboard'))),
+    Scenario('assessment_detail', 'doctor', 200, lambda ctx, client: client.get(
+        reverse('view_assessment', kwargs={'pk': ctx.random_assessment()}))),
+    Scenario('analytics', 'admin', 200, lambda ctx, client: client.get(reverse('analytics_dashboard'))),
+    Scenario('upload', 'admin', 302, lambda ctx, client: client.post(
+        reverse('upload_csv'), {'csv_file': ctx.csv_upload()})),
+    Scenario('analyze', 'admin', 302, lambda ctx, client: client.post(
+        reverse('analyze_record', kwargs={'pk': ctx.next_unanalyzed()}))),
+    Scenario('analyze_live', 'admin', 200, lambda ctx, client: client.post(
+        reverse('analyze_record_live', kwargs={'pk': ctx.next_unanalyzed()}), HTTP_ACCEPT='text/event-stream')),
+    Scenario('export', 'admin', 200, lambda ctx, client: client.get(reverse('export_reports_csv'))),
+]
+
+SCENARIO_NAMES = [scenario.name for scenario in SCENARIOS]
+
+
+def _drive(ctx, scenario, count, host):
+    """Sends `count` requests of one scenario from one client. Returns (durations, query counts, errors)."""
+    client = Client(HTTP_HOST=host)
+    user = ctx.user_for(scenario.role)
+    if user is not None:
+        client.force_login(user)
+
+    durations, query_counts, errors = [], [], []
+    for _ in range(count):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            try:
+                response = scenario.send(ctx, client)
+                if response.streaming:
+                    # The time and queries of a streamed response include producing the whole body.
+                    b"".join(response.streaming_content)
+                if response.status_code != scenario.expected_status:
+                    errors.append(f"HTTP {response.status_code}")
+            except LoadTestError:
+                raise
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+            durations.append(time.perf_counter() - started)
+        query_counts.append(len(queries))
+    return durations, query_counts, errors
+
+
+def run_scenario(ctx, scenario, requests, concurrency=1, host='localhost'):
+    """Runs one scenario with `requests` requests spread over `concurrency` clients, and summarizes it."""
+    shares = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    shares = [share for share in shares if share]
+
+    started = time.perf_counter()
+    if len(shares) == 1:
+        results = [_drive(ctx, scenario, shares[0], host)]
+    else:
+        def drive_in_thread(count):
+            try:
+                return _drive(ctx, scenario, count, host)
+            finally:
+                connection.close()  # Each thread has its own connection
+
+        with ThreadPoolExecutor(max_workers=len(shares)) as executor:
+            results = list(executor.map(drive_in_thread, shares))
+    elapsed = time.perf_counter() - started
+
+    durations = [d for result in results for d in result[0]]
+    query_counts = [q for result in results for q in result[1]]
+    errors = [e for result in results for e in result[2]]
+    return {
+        'requests': len(durations),
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'throughput_rps': round(len(durations) / elapsed, 2) if elapsed else None,
+        'latency_ms': latency_summary(durations),
+        'queries': {'p50': percentile(query_counts, 50), 'max': max(query_counts, default=None)},
+    }
+
+
+def run_worker(ctx, jobs, concurrency=1):
+    """Queues `jobs` analyses and times the job worker through them with the stub backend."""
+    record_ids = [ctx.next_unanalyzed() for _ in range(jobs)]
+    enqueue_bulk_analysis(PatientRecord.objects.filter(pk__in=record_ids))
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        processed = run_pending_jobs(max_jobs=jobs, concurrency=concurrency)
+        elapsed = time.perf_counter() - started
+    return {
+        'jobs': processed,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'jobs_per_second': round(processed / elapsed, 2) if elapsed else None,
+        'queries': len(queries),
+    }
+
+
+def run_load_test(hospital, scenarios=None, requests=50, concurrency=1, worker_jobs=0, worker_concurrency=1, host='localhost', log=None):
+    """Runs the scenarios (all by default) and the worker benchmark. Returns the 'scenarios' and 'worker' report sections."""
+    ctx = LoadContext(hospital)
+    selected = [scenario for scenario in SCENARIOS if scenarios is None or scenario.name in scenarios]
+    report = {'scenarios': {}, 'worker': None}
+    try:
+        for scenario in selected:
+            report['scenarios'][scenario.name] = result = run_scenario(ctx, scenario, requests, concurrency, host)
+            if log:
+                log(f"{scenario.name}: p50 {result['latency_ms']['p50']} ms, {result['throughput_rps']} req/s, "
+                    f"{result['queries']['p50']} queries, {result['errors']} error(s)")
+        if worker_jobs:
+            # Jobs queued by the 'analyze' scenario must not be counted as worker throughput.
+            AnalysisJob.objects.filter(pk__gt=ctx.high_water[AnalysisJob], status=AnalysisJob.Status.QUEUED).delete()
+            report['worker'] = run_worker(ctx, worker_jobs, worker_concurrency)
+            if log:
+                log(f"worker: {report['worker']['jobs_per_second']} jobs/s")
+    finally:
+        ctx.clean_up()
+    return report
@@ -0,0 +1,35 @@
+# health_app/management/commands/backfill_report_html.py
+from django.core.management.base import BaseCommand
+
+from health_app.models import RiskAssessment
+from health_app.rendering import REPORT_RENDERER_VERSION, render_report_html
+
+
+class Command(BaseCommand):
+    help = "Renders the stored HTML of reports that have none yet, or were rendered by an older renderer version."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Reports rendered and written per UPDATE batch (default: 500).")
+        parser.add_argument('--all', action='store_true', help="Re-render every report, not only the stale ones.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        stale = RiskAssessment.objects.all() if options['all'] else RiskAssessment.objects.exclude(html_report_version=REPORT_RENDERER_VERSION)
+        total = stale.count()
+        self.stdout.write(f"Rendering {total} report(s) with renderer version {REPORT_RENDERER_VERSION}...")
+
+        # Walk by primary key rather than re-querying "stale" rows, so rows are never visited twice.
+        rendered, last_pk = 0, 0
+        while True:
+            batch = list(stale.filter(pk__gt=last_pk).order_by('pk').only('pk', 'ai_generated_report')[:batch_size])
+            if not batch:
+                break
+            for assessment in batch:
+                assessment.html_report = render_report_html(assessment.ai_generated_report)
+                assessment.html_report_version = REPORT_RENDERER_VERSION
+            RiskAssessment.objects.bulk_update(batch, ['html_report', 'html_report_version'])
+            rendered += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write(f"  {rendered}/{total}")
+
+        self.stdout.write(self.style.SUCCESS(f"Rendered {rendered} report(s)."))
@@ -0,0 +1,280 @@
+# health_app/management/commands/benchmark_asgi.py
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.middleware.csrf import CSRF_ALLOWED_CHARS, CSRF_SECRET_LENGTH
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+
+from health_app.benchmarking import _change, latency_summary, report_meta
+from health_app.loadtest import LoadContext, LoadTestError
+from health_app.synthetic import synthetic_hospitals
+
+MODES = ['wsgi', 'asgi']
+
+
+class Command(BaseCommand):
+    help = (
+        "Starts the application under gunicorn (WSGI, threaded workers) and under uvicorn (ASGI, async views) "
+        "with the stub inference backend, streams many live analyses through each at once, and compares "
+        "throughput, latency and the server's peak thread count. Needs gunicorn, uvicorn and aiohttp, and a "
+        "synthetic hospital (see `seed_synthetic_data`) with enough unanalyzed records."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Analyses per mode (default: 200).")
+        parser.add_argument('--concurrency', type=int, default=200, help="Analyses in flight at once (default: 200).")
+        parser.add_argument('--mode', action='append', choices=MODES, dest='modes', help="Only run this mode. Can be repeated.")
+        parser.add_argument('--workers', type=int, default=1, help="Server worker processes in both modes (default: 1).")
+        parser.add_argument('--threads', type=int, default=32, help="Threads per gunicorn worker (default: 32).")
+        parser.add_argument('--stub-latency', type=float, default=2.0, help="Stub backend delay before the first token, in seconds (default: 2.0).")
+        parser.add_argument('--stub-token-latency', type=float, default=0.02, help="Stub backend delay per token, in seconds (default: 0.02).")
+        parser.add_argument('--port', type=int, default=8765, help="Port the servers listen on, on 127.0.0.1 (default: 8765).")
+        parser.add_argument('--host', default=settings.ALLOWED_HOSTS[0], help="Host header to send (default: the first of ALLOWED_HOSTS).")
+        parser.add_argument('--hospital', help="Name of the synthetic hospital to use (default: the first one).")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+        parser.add_argument('--compare', help="A previous JSON report to compare the results with.")
+        parser.add_argument('--force', action='store_true', help="Run even though DEBUG is off.")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError("This command writes to the database. Use --force to run it with DEBUG off.")
+        try:
+            import aiohttp  # noqa: F401
+        except ImportError:
+            raise CommandError("This command needs aiohttp: pip install aiohttp")
+
+        hospitals = synthetic_hospitals().order_by('pk')
+        if options['hospital']:
+            hospitals = hospitals.filter(name=options['hospital'])
+        hospital = hospitals.first()
+        if hospital is None:
+            raise CommandError("No synthetic hospital found. Run `manage.py seed_synthetic_data` first.")
+
+        modes = options['modes'] or MODES
+        log_stream = self.stderr if not options['output'] else self.stdout
+        server_env = {
+            **os.environ,
+            'AI_INFERENCE_BACKEND': 'stub',
+            'AI_STUB_LATENCY': str(options['stub_latency']),
+            'AI_STUB_TOKEN_LATENCY': str(options['stub_token_latency']),
+            # Every analysis has to call the model.
+            'AI_REPORT_CACHE_ENABLED': 'False',
+            # One log line per request would slow both servers down.
+            'PERFORMANCE_LOG_LEVEL': 'WARNING',
+        }
+        report = {
+            'meta': report_meta(
+                hospital=hospital.name,
+                requests=options['requests'],
+                concurrency=options['concurrency'],
+                workers=options['workers'],
+                wsgi_threads=options['threads'],
+                ai_stub_latency=options['stub_latency'],
+                ai_stub_token_latency=options['stub_token_latency'],
+            ),
+            'modes': {},
+        }
+
+        try:
+            ctx = LoadContext(hospital)
+        except LoadTestError as e:
+            raise CommandError(str(e))
+        session = self.admin_session(ctx.admin)
+        try:
+            for mode in modes:
+                try:
+                    record_ids = [ctx.next_unanalyzed() for _ in range(options['requests'])]
+                except LoadTestError as e:
+                    raise CommandError(str(e))
+                with self.server(mode, options, server_env) as process:
+                    report['modes'][mode] = result = asyncio.run(self.drive(process, record_ids, session, options))
+                log_stream.write(
+                    f"{mode}: {result['analyses_per_second']} analyses/s, p50 {result['latency_ms']['p50']} ms, "
+                    f"p95 {result['latency_ms']['p95']} ms, first byte p95 {result['first_byte_ms']['p95']} ms, "
+                    f"peak threads {result['peak_threads']}, {result['errors']} errors"
+                )
+        finally:
+            session.delete()
+            ctx.clean_up()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}."))
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            log_stream.write(f"Baseline {baseline['meta'].get('git_revision')} vs current {report['meta'].get('git_revision')}")
+            for mode, now in report['modes'].items():
+                before = baseline['modes'].get(mode)
+                if before is not None:
+                    log_stream.write(
+                        f"{mode}: analyses/s {_change(before['analyses_per_second'], now['analyses_per_second'])}, "
+                        f"p95 {_change(before['latency_ms']['p95'], now['latency_ms']['p95'], ' ms')}"
+                    )
+
+    def admin_session(self, user):
+        """A logged-in session for the user, as `login()` would create it, without going through the login form."""
+        session = SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        return session
+
+    def server(self, mode, options, env):
+        address = f"127.0.0.1:{options['port']}"
+        if mode == 'wsgi':
+            command = [
+                sys.executable, '-m', 'gunicorn', 'config.wsgi:application', '--bind', address,
+                '--workers', str(options['workers']), '--worker-class', 'gthread', '--threads', str(options['threads']),
+            ]
+        else:
+            command = [
+                sys.executable, '-m', 'uvicorn', 'config.asgi:application', '--host', '127.0.0.1',
+                '--port', str(options['port']), '--workers', str(options['workers']), '--no-access-log',
+            ]
+        return _Server(command, {**env, 'ASYNC_VIEWS': str(mode == 'asgi')}, f"http://{address}", options['host'])
+
+    async def drive(self, server, record_ids, session, options):
+        import aiohttp
+
+        csrf_token = get_random_string(CSRF_SECRET_LENGTH, CSRF_ALLOWED_CHARS)
+        headers = {
+            'Host': options['host'],
+            'Accept': 'text/event-stream',
+            'Cookie': f"{settings.SESSION_COOKIE_NAME}={session.session_key}; {settings.CSRF_COOKIE_NAME}={csrf_token}",
+            'X-CSRFToken': csrf_token,
+        }
+        in_flight = asyncio.Semaphore(options['concurrency'])
+        latencies, first_bytes, errors = [], [], []
+
+        async def analyze(client, pk):
+            async with in_flight:
+                started = time.perf_counter()
+                first_byte = None
+                body = b''
+                try:
+                    async with client.post(reverse('analyze_record_live', kwargs={'pk': pk})) as response:
+                        async for chunk in response.content.iter_any():
+                            if first_byte is None:
+                                first_byte = time.perf_counter() - started
+                            body += chunk
+                except aiohttp.ClientError as e:
+                    errors.append(f"{pk}: {e!r}")
+                    return
+                if response.status != 200 or b"event: done" not in body:
+                    errors.append(f"{pk}: HTTP {response.status} {body[-200:].decode(errors='replace')}")
+                    return
+                latencies.append(time.perf_counter() - started)
+                first_bytes.append(first_byte)
+
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=300)
+        async with aiohttp.ClientSession(server.url, headers=headers, connector=connector, timeout=timeout) as client:
+            sampler = asyncio.create_task(server.sample_threads())
+            started = time.perf_counter()
+            await asyncio.gather(*(analyze(client, pk) for pk in record_ids))
+            elapsed = time.perf_counter() - started
+            sampler.cancel()
+
+        if errors:
+            self.stderr.write(f"{len(errors)} analyses failed, e.g. {errors[0]}")
+        return {
+            'seconds': round(elapsed, 2),
+            'analyses_per_second': round(len(latencies) / elapsed, 2),
+            'latency_ms': latency_summary(latencies),
+            'first_byte_ms': latency_summary(first_bytes),
+            # Under ASGI, Django runs each request's ORM calls in a thread of its own, which stays idle while the model streams.
+            'peak_threads': server.peak_threads,
+            'errors': len(errors),
+        }
+
+
+class _Server:
+    """A server subprocess, started on enter once it answers requests and stopped on exit."""
+
+    def __init__(self, command, env, url, host):
+        self.command, self.env, self.url, self.host = command, env, url, host
+        self.peak_threads = None
+
+    def __enter__(self):
+        self.log = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            self.command, cwd=settings.BASE_DIR, env=self.env, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + 30
+        while not self._answers():
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                self.__exit__()
+                self.log.seek(0)
+                raise CommandError(f"`{' '.join(self.command[2:])}` did not start:\n{self.log.read().decode(errors='replace')}")
+            time.sleep(0.2)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+    def _answers(self):
+        from urllib.error import HTTPError, URLError
+        from urllib.request import Request, urlopen
+
+        try:
+            urlopen(Request(self.url + reverse('login'), headers={'Host': self.host}), timeout=1).close()
+        except HTTPError:
+            return True
+        except (URLError, OSError):
+            return False
+        return True
+
+    async def sample_threads(self):
+        """Records the most threads the server's processes had at once. Reads /proc, so Linux only."""
+        if not Path('/proc').is_dir():
+            return
+        while True:
+            threads = sum(self._threads(pid) for pid in self._process_tree())
+            self.peak_threads = max(self.peak_threads or 0, threads)
+            await asyncio.sleep(0.1)
+
+    def _process_tree(self):
+        parents = {}
+        for stat in Path('/proc').glob('[0-9]*/stat'):
+            try:
+                # The command name in parentheses may contain spaces; the parent pid follows it.
+                fields = stat.read_text().rsplit(')', 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            parents.setdefault(int(fields[1]), []).append(int(stat.parent.name))
+        tree, pending = [], [self.process.pid]
+        while pending:
+            pid = pending.pop()
+            tree.append(pid)
+            pending.extend(parents.get(pid, []))
+        return tree
+
+    def _threads(self, pid):
+        try:
+            return len(list(Path(f'/proc/{pid}/task').iterdir()))
+        except OSError:
+            return 0
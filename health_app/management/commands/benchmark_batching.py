@@ -0,0 +1,115 @@
+# health_app/management/commands/benchmark_batching.py
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from health_app import metrics
+from health_app.benchmarking import _change, report_meta
+from health_app.services import MODEL_NAME, generate_risk_assessments_for_records
+from health_app.synthetic import unsaved_records
+from health_app.thresholds import evaluate_record
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates reports for the same synthetic records with one record per model call and with "
+        "batched multi-patient prompts, and compares reports per minute, tokens per report and how "
+        "often a batch response could not be split up. Nothing is written to the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=48, help="Records to analyze per batch size (default: 48).")
+        parser.add_argument('--batch-size', type=int, action='append', dest='batch_sizes', help="A batch size to measure. Can be repeated (default: 1, 4 and 8).")
+        parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic marker values (default: 0).")
+        parser.add_argument('--backend', default='stub', help="AI_INFERENCE_BACKEND to measure (default: stub).")
+        parser.add_argument('--stub-latency', type=float, default=1.0, help="Stub backend delay before the first token, in seconds (default: 1.0).")
+        parser.add_argument('--stub-token-latency', type=float, default=0.005, help="Stub backend delay per token, in seconds (default: 0.005).")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+        parser.add_argument('--compare', help="A previous JSON report to compare the results with.")
+
+    def handle(self, *args, **options):
+        log_stream = self.stderr if not options['output'] else self.stdout
+        batch_sizes = options['batch_sizes'] or [1, 4, 8]
+        records = self.synthetic_records(options['records'], options['seed'])
+        backend_settings = {
+            'AI_INFERENCE_BACKEND': options['backend'],
+            'AI_STUB_LATENCY': options['stub_latency'],
+            'AI_STUB_TOKEN_LATENCY': options['stub_token_latency'],
+            # Every batch size has to call the model for every record.
+            'AI_REPORT_CACHE_ENABLED': False,
+        }
+
+        report = {
+            'meta': report_meta(
+                records=len(records),
+                seed=options['seed'],
+                model=MODEL_NAME,
+                **{name.lower(): value for name, value in backend_settings.items()},
+            ),
+            'batch_sizes': {},
+        }
+        with override_settings(**backend_settings):
+            for batch_size in batch_sizes:
+                report['batch_sizes'][str(batch_size)] = result = self.measure(records, batch_size)
+                log_stream.write(
+                    f"batch size {batch_size}: {result['reports_per_minute']} reports/min, "
+                    f"{result['prompt_tokens_per_report']} prompt + {result['completion_tokens_per_report']} completion "
+                    f"tokens per report, {result['model_calls']} model calls, {result['fallbacks']} fallbacks, {result['errors']} errors"
+                )
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}."))
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            log_stream.write(f"Baseline {baseline['meta'].get('git_revision')} vs current {report['meta'].get('git_revision')}")
+            for batch_size, now in report['batch_sizes'].items():
+                before = baseline['batch_sizes'].get(batch_size)
+                if before is not None:
+                    log_stream.write(
+                        f"batch size {batch_size}: reports/min {_change(before['reports_per_minute'], now['reports_per_minute'])}, "
+                        f"prompt tokens/report {_change(before['prompt_tokens_per_report'], now['prompt_tokens_per_report'])}"
+                    )
+
+    def synthetic_records(self, count, seed):
+        """Unsaved records that each need a model call (at least one abnormal marker)."""
+        records = [record for record in unsaved_records(count * 2, seed) if evaluate_record(record).risk_level > 0]
+        return records[:count]
+
+    def measure(self, records, batch_size):
+        before = self.samples()
+        started = time.perf_counter()
+        reports = generate_risk_assessments_for_records(records, batch_size=batch_size)
+        elapsed = time.perf_counter() - started
+        after = self.samples()
+        used = {name: after[name] - before[name] for name in after}
+
+        return {
+            'seconds': round(elapsed, 2),
+            'reports_per_minute': round(len(reports) / elapsed * 60, 1),
+            'model_calls': int(used['calls']),
+            'prompt_tokens_per_report': round(used['prompt_tokens'] / len(records), 1),
+            'completion_tokens_per_report': round(used['completion_tokens'] / len(records), 1),
+            'fallbacks': int(used['fallbacks']),
+            'errors': sum(report.startswith("Error:") for report in reports.values()),
+        }
+
+    def samples(self):
+        """This process's inference counters (see metrics.py), to tell what one run used."""
+        def sample(name, **labels):
+            return metrics.registry.get_sample_value(name, {'model': MODEL_NAME, **labels}) or 0
+
+        return {
+            'calls': sum(sample('health_inference_latency_seconds_count', mode=mode) for mode in ('complete', 'batch')),
+            'prompt_tokens': sample('health_inference_tokens_total', kind='prompt'),
+            'completion_tokens': sample('health_inference_tokens_total', kind='completion'),
+            'fallbacks': sample('health_inference_batch_reports_total', outcome='fallback'),
+        }
@@ -0,0 +1,103 @@
+# health_app/management/commands/benchmark_prompt_tokens.py
+import json
+import statistics
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from health_app.benchmarking import _change, approximate_tokens, percentile, report_meta
+from health_app.services import PROMPT_VERSION, build_batch_prompt, build_prompt, max_tokens_for
+from health_app.synthetic import unsaved_records
+from health_app.thresholds import evaluate_record
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the prompts for a synthetic record corpus without calling the model, and reports "
+        "the prompt tokens and the max_tokens budget per report. Compare two runs (e.g. from two "
+        "commits) to see what a prompt change costs or saves."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=1000, help="Synthetic records in the corpus (default: 1000).")
+        parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic marker values (default: 0).")
+        parser.add_argument('--batch-size', type=int, default=settings.AI_BATCH_PROMPT_SIZE, help="Also measure batched prompts of this size (default: AI_BATCH_PROMPT_SIZE).")
+        parser.add_argument(
+            '--tokenizer',
+            help="Count with this Hugging Face tokenizer (e.g. the model's repo id); needs the `tokenizers` package. "
+                 "By default tokens are estimated offline.",
+        )
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+        parser.add_argument('--compare', help="A previous JSON report to compare the results with.")
+
+    def handle(self, *args, **options):
+        log_stream = self.stderr if not options['output'] else self.stdout
+        count_tokens = self.token_counter(options['tokenizer'])
+
+        records = unsaved_records(options['records'], options['seed'])
+        pairs = [(record, evaluation) for record in records if (evaluation := evaluate_record(record)).risk_level > 0]
+        if not pairs:
+            raise CommandError("No record in the corpus needs a model call; use more --records.")
+
+        prompt_tokens = [count_tokens(build_prompt(record, evaluation)) for record, evaluation in pairs]
+        max_tokens = [max_tokens_for(evaluation) for _, evaluation in pairs]
+        report = {
+            'meta': report_meta(
+                records=len(records),
+                seed=options['seed'],
+                prompt_version=PROMPT_VERSION,
+                tokenizer=options['tokenizer'] or 'approximate',
+            ),
+            'corpus': {'records': len(records), 'model_calls': len(pairs), 'templated': len(records) - len(pairs)},
+            'prompt_tokens': self.summary(prompt_tokens),
+            'max_tokens': self.summary(max_tokens),
+        }
+
+        batch_size = options['batch_size']
+        if batch_size > 1:
+            batched = [
+                count_tokens(build_batch_prompt(pairs[i:i + batch_size])) for i in range(0, len(pairs), batch_size)
+            ]
+            report['batched'] = {'batch_size': batch_size, 'prompt_tokens_per_report': round(sum(batched) / len(pairs), 1)}
+
+        log_stream.write(
+            f"{len(pairs)} of {len(records)} records need a model call. Per report: prompt tokens mean "
+            f"{report['prompt_tokens']['mean']} (p95 {report['prompt_tokens']['p95']}), "
+            f"max_tokens mean {report['max_tokens']['mean']} (max {report['max_tokens']['max']})"
+        )
+        if 'batched' in report:
+            log_stream.write(f"Batches of {batch_size}: {report['batched']['prompt_tokens_per_report']} prompt tokens per report")
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}."))
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            log_stream.write(f"Baseline {baseline['meta'].get('git_revision')} vs current {report['meta'].get('git_revision')}")
+            for name in ('prompt_tokens', 'max_tokens'):
+                before, now = baseline[name], report[name]
+                log_stream.write(f"{name}: mean {_change(before['mean'], now['mean'])}, p95 {_change(before['p95'], now['p95'])}")
+
+    def token_counter(self, tokenizer_name):
+        if not tokenizer_name:
+            return approximate_tokens
+        try:
+            from tokenizers import Tokenizer
+        except ImportError:
+            raise CommandError("--tokenizer needs the `tokenizers` package: pip install tokenizers")
+        tokenizer = Tokenizer.from_pretrained(tokenizer_name)
+        return lambda text: len(tokenizer.encode(text).ids)
+
+    def summary(self, values):
+        return {
+            'mean': round(statistics.fmean(values), 1),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'max': max(values),
+        }
@@ -0,0 +1,173 @@
+# health_app/management/commands/benchmark_queries.py
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Case, Exists, IntegerField, OuterRef, Q, Value, When
+
+from health_app import analytics
+from health_app.exports import bound_to_watermark, reviewed_assessments
+from health_app.models import AnalysisJob, Hospital, PatientRecord, RiskAssessment, User
+from health_app.forms import PatientSearchForm
+from health_app.thresholds import MARKER_FIELDS, risk_flags
+
+# The indexes added for the hot query shapes below. The baseline run drops them.
+BENCHMARK_INDEXES = [
+    (PatientRecord, 'patient_hospital_created'),
+    (RiskAssessment, 'assessment_status_reviewed'),
+    (RiskAssessment, 'assessment_status_doctor'),
+]
+
+BENCHMARK_HOSPITAL = "Benchmark Hospital"
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a large synthetic hospital and prints EXPLAIN plans and timings of the hot queries, "
+        "without and with the composite indexes. Meant for a development or staging database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=100_000, help="Patient records to seed (default: 100000).")
+        parser.add_argument('--repeat', type=int, default=5, help="Runs per query; the median is reported (default: 5).")
+        parser.add_argument('--skip-baseline', action='store_true', help="Only measure with the current indexes (no DROP/CREATE INDEX).")
+        parser.add_argument('--keep', action='store_true', help="Keep the seeded hospital instead of deleting it at the end.")
+        parser.add_argument('--force', action='store_true', help="Run even though DEBUG is off.")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError("This command writes a large dataset and drops indexes. Use --force to run it with DEBUG off.")
+
+        hospital = Hospital.objects.filter(name=BENCHMARK_HOSPITAL).first()
+        if hospital is None:
+            hospital = self.seed(options['records'])
+        else:
+            self.stdout.write(f"Reusing the existing {BENCHMARK_HOSPITAL} ({hospital.patient_records.count()} records).")
+        self.analyze_tables()
+
+        try:
+            queries = self.query_shapes(hospital)
+            if not options['skip_baseline']:
+                self.stdout.write(self.style.MIGRATE_HEADING("\n=== Without the composite indexes ==="))
+                self.toggle_indexes(create=False)
+                try:
+                    self.run_queries(queries, options['repeat'])
+                finally:
+                    self.toggle_indexes(create=True)
+            self.stdout.write(self.style.MIGRATE_HEADING("\n=== With the indexes ==="))
+            self.run_queries(queries, options['repeat'])
+        finally:
+            if not options['keep']:
+                # One batch, so the cascade doesn't update the analytics summary once per record.
+                with analytics.batch():
+                    User.objects.filter(hospital=hospital).delete()
+                    hospital.delete()
+
+    def seed(self, count):
+        self.stdout.write(f"Seeding {count} records on {connection.vendor}...")
+        rng = random.Random(42)
+        hospital = Hospital.objects.create(name=BENCHMARK_HOSPITAL)
+        doctors = [
+            User.objects.create_user(username=f"benchmark-doctor-{i}@example.com", role=User.Role.DOCTOR, hospital=hospital)
+            for i in range(10)
+        ]
+
+        batch_size = 5000
+        for start in range(0, count, batch_size):
+            records = [
+                PatientRecord(
+                    hospital=hospital, patient_identifier=f"BM{i:08}",
+                    **{field: round(rng.uniform(1, 200), 1) for field in MARKER_FIELDS}
+                )
+                for i in range(start, min(start + batch_size, count))
+            ]
+            for record in records:
+                record.risk_flags = risk_flags(record)
+            PatientRecord.objects.bulk_create(records)
+            # Most records have a report; about a third of those are reviewed, some are assigned.
+            assessments = []
+            for record in records:
+                roll = rng.random()
+                if roll < 0.2:
+                    continue
+                reviewed = roll > 0.7
+                assessments.append(RiskAssessment(
+                    patient_record=record, ai_generated_report="Benchmark report",
+                    status=RiskAssessment.Status.REVIEWED if reviewed else RiskAssessment.Status.PENDING_REVIEW,
+                    reviewed_by=rng.choice(doctors) if reviewed else None,
+                    reviewed_at=record.created_at if reviewed else None,
+                    assigned_doctor=rng.choice(doctors) if rng.random() < 0.3 else None,
+                ))
+            RiskAssessment.objects.bulk_create(assessments)
+        analytics.rebuild([hospital.pk])
+        return hospital
+
+    def analyze_tables(self):
+        # Refresh the planner statistics so the plans reflect the seeded data.
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def query_shapes(self, hospital):
+        """The querysets behind the hot pages, in the same shape as the views build them."""
+        doctor = User.objects.filter(hospital=hospital, role=User.Role.DOCTOR).first()
+        active_jobs = AnalysisJob.objects.filter(
+            patient_record=OuterRef('pk'), status__in=[AnalysisJob.Status.QUEUED, AnalysisJob.Status.RUNNING],
+        )
+        patient_list = PatientRecord.objects.filter(hospital=hospital).select_related(
+            'assessment__reviewed_by', 'assessment__assigned_doctor'
+        ).annotate(has_active_job=Exists(active_jobs)).order_by('-created_at', '-pk')
+        middle = patient_list.values_list('created_at', 'pk')[patient_list.count() // 2]
+
+        worklist = RiskAssessment.objects.filter(
+            Q(assigned_doctor=doctor) | Q(assigned_doctor__isnull=True),
+            status=RiskAssessment.Status.PENDING_REVIEW,
+            patient_record__hospital=hospital,
+        ).select_related('patient_record', 'assigned_doctor').annotate(
+            is_unassigned=Case(When(assigned_doctor__isnull=True, then=Value(1)), default=Value(0), output_field=IntegerField())
+        ).order_by('is_unassigned', '-patient_record__created_at', '-pk')
+
+        export, _ = bound_to_watermark(reviewed_assessments(hospital))
+
+        cohort = PatientSearchForm({'hba1c__gte': 6.5, 'ldl__gt': 130, 'flagged': ['crp']})
+        cohort.is_valid()
+        prefix = PatientSearchForm({'q': 'BM0001'})
+        prefix.is_valid()
+
+        return [
+            # (name, queryset, count only); pages fetch one row more than they show, like KeysetPaginator.
+            ("Patient list, first page", patient_list[:16], False),
+            ("Patient list, keyset page in the middle", patient_list.filter(
+                Q(created_at__lt=middle[0]) | Q(created_at=middle[0], pk__lt=middle[1]))[:16], False),
+            ("Doctor worklist, first page", worklist[:11], False),
+            ("Reviewed reports export", export, False),
+            ("Cohort search (ranges + abnormal flag), first page", cohort.filter(patient_list)[:16], False),
+            ("Identifier prefix search, first page", prefix.filter(patient_list)[:16], False),
+            ("Pending review count", RiskAssessment.objects.filter(
+                status=RiskAssessment.Status.PENDING_REVIEW, patient_record__hospital=hospital), True),
+        ]
+
+    def toggle_indexes(self, create):
+        with connection.schema_editor() as schema_editor:
+            for model, name in BENCHMARK_INDEXES:
+                index = next(index for index in model._meta.indexes if index.name == name)
+                if create:
+                    schema_editor.add_index(model, index)
+                else:
+                    schema_editor.remove_index(model, index)
+        self.analyze_tables()
+
+    def run_queries(self, queries, repeat):
+        for name, queryset, count_only in queries:
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                # .all() gives a fresh clone, so no run is served from the previous run's result cache.
+                queryset.all().count() if count_only else list(queryset.all())
+                timings.append((time.perf_counter() - started) * 1000)
+
+            self.stdout.write(self.style.SUCCESS(f"\n{name}: {statistics.median(timings):.2f} ms (median of {repeat})"))
+            # For the count this is the plan of the filtered SELECT, which uses the same access path.
+            self.stdout.write(queryset.explain(**({'analyze': True} if connection.vendor == 'postgresql' else {})))
@@ -0,0 +1,104 @@
+# health_app/management/commands/benchmark_startup.py
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from health_app.benchmarking import _change, report_meta
+
+# What a fresh process runs before it can do useful work.
+TARGETS = {
+    # A gunicorn worker: the WSGI application plus the URLconf, which imports every view.
+    'web_worker': "import config.wsgi, config.urls",
+    # A management command: setup plus the system checks that `migrate`, `runserver` etc. run first.
+    'manage_check': (
+        "import django; django.setup(); "
+        "from django.core.management import call_command; call_command('check', verbosity=0)"
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the startup time of fresh Python processes: a web worker loading the WSGI app "
+        "and URLconf, and a management command running the system checks. Lists the slowest imports."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=7, help="Processes started per target; the median is reported (default: 7).")
+        parser.add_argument('--top', type=int, default=10, help="Slowest packages to list per target (default: 10).")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+        parser.add_argument('--compare', help="A previous JSON report to compare the results with.")
+
+    def handle(self, *args, **options):
+        # The child processes run with this process's settings module and environment.
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'config.settings')}
+        log_stream = self.stderr if not options['output'] else self.stdout
+
+        report = {'meta': report_meta(repeat=options['repeat'], inference_backend=settings.AI_INFERENCE_BACKEND), 'targets': {}}
+        for name, code in TARGETS.items():
+            report['targets'][name] = result = self.measure(code, env, options['repeat'], options['top'])
+            log_stream.write(
+                f"{name}: median {result['median_ms']} ms, min {result['min_ms']} ms, "
+                f"{result['modules']} modules imported; huggingface_hub imported: {result['huggingface_hub_imported']}"
+            )
+            for module, ms in result['slowest_imports'].items():
+                log_stream.write(f"    {ms:8.1f} ms  {module}")
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}."))
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            log_stream.write(f"Baseline {baseline['meta'].get('git_revision')} vs current {report['meta'].get('git_revision')}")
+            for name, now in report['targets'].items():
+                before = baseline['targets'].get(name)
+                if before is not None:
+                    log_stream.write(
+                        f"{name}: median {_change(before['median_ms'], now['median_ms'], ' ms')}, "
+                        f"modules {_change(before['modules'], now['modules'])}"
+                    )
+
+    def measure(self, code, env, repeat, top):
+        durations = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=settings.BASE_DIR, env=env, check=True, capture_output=True)
+            durations.append((time.perf_counter() - started) * 1000)
+
+        # One more run with -X importtime, which slows the process down a little, for the breakdown.
+        importtime = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code], cwd=settings.BASE_DIR, env=env, check=True,
+            capture_output=True, text=True,
+        ).stderr
+        modules, by_package = set(), {}
+        for line in importtime.splitlines():
+            # "import time: self [us] | cumulative | imported package"
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            self_us, _, module = line[len('import time:'):].split('|')
+            module = module.strip()
+            modules.add(module)
+            # Each module's own time, added up per top-level package: what importing that package costs.
+            package = module.split('.')[0]
+            by_package[package] = by_package.get(package, 0) + int(self_us) / 1000
+        slowest = sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:top]
+
+        return {
+            'median_ms': round(statistics.median(durations), 1),
+            'min_ms': round(min(durations), 1),
+            'modules': len(modules),
+            'huggingface_hub_imported': 'huggingface_hub' in modules,
+            'slowest_imports': {module: round(ms, 1) for module, ms in slowest},
+        }
@@ -0,0 +1,91 @@
+# health_app/management/commands/load_test.py
+import json
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from health_app.benchmarking import compare_reports, report_meta
+from health_app.loadtest import SCENARIO_NAMES, LoadTestError, run_load_test
+from health_app.synthetic import synthetic_hospitals
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives the application's pages against a synthetic hospital (see `seed_synthetic_data`) with the stub "
+        "inference backend, and writes p50/p95/p99 latency, throughput and query counts per page as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help="Requests per scenario (default: 50).")
+        parser.add_argument('--concurrency', type=int, default=1, help="Concurrent clients per scenario (default: 1).")
+        parser.add_argument('--scenario', action='append', choices=SCENARIO_NAMES, dest='scenarios', help="Only run this scenario. Can be repeated.")
+        parser.add_argument('--worker-jobs', type=int, default=20, help="Analysis jobs for the worker benchmark; 0 skips it (default: 20).")
+        parser.add_argument('--worker-concurrency', type=int, default=settings.AI_ANALYSIS_CONCURRENCY, help="Worker thread pool size (default: AI_ANALYSIS_CONCURRENCY).")
+        parser.add_argument('--stub-latency', type=float, default=settings.AI_STUB_LATENCY, help="Stub backend delay before the first token, in seconds.")
+        parser.add_argument('--stub-token-latency', type=float, default=settings.AI_STUB_TOKEN_LATENCY, help="Stub backend delay per token, in seconds.")
+        parser.add_argument('--hospital', help="Name of the synthetic hospital to use (default: the first one).")
+        parser.add_argument('--host', default='localhost', help="Host header to send (default: localhost).")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+        parser.add_argument('--compare', help="A previous JSON report to compare the results with.")
+        parser.add_argument('--force', action='store_true', help="Run even though DEBUG is off.")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError("This command writes to the database. Use --force to run it with DEBUG off.")
+
+        hospitals = synthetic_hospitals().order_by('pk')
+        if options['hospital']:
+            hospitals = hospitals.filter(name=options['hospital'])
+        hospital = hospitals.first()
+        if hospital is None:
+            raise CommandError("No synthetic hospital found. Run `manage.py seed_synthetic_data` first.")
+
+        # Progress goes to stderr when the report itself is written to stdout.
+        log_stream = self.stderr if not options['output'] else self.stdout
+        stub_settings = {
+            'AI_INFERENCE_BACKEND': 'stub',
+            'AI_STUB_LATENCY': options['stub_latency'],
+            'AI_STUB_TOKEN_LATENCY': options['stub_token_latency'],
+        }
+        meta = report_meta(
+            hospital=hospital.name,
+            records=hospital.patient_records.count(),
+            requests_per_scenario=options['requests'],
+            concurrency=options['concurrency'],
+            **{name.lower(): value for name, value in stub_settings.items()},
+        )
+        # One log line per request would drown the progress output; slow requests are still logged.
+        performance_logger = logging.getLogger('health_app.performance')
+        previous_level = performance_logger.level
+        if options['verbosity'] < 2:
+            performance_logger.setLevel(logging.WARNING)
+        try:
+            # The requests never leave the process, so the host only has to pass Django's check.
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, options['host']], **stub_settings):
+                results = run_load_test(
+                    hospital, scenarios=options['scenarios'], requests=options['requests'],
+                    concurrency=options['concurrency'], worker_jobs=options['worker_jobs'],
+                    worker_concurrency=options['worker_concurrency'], host=options['host'],
+                    log=lambda message: log_stream.write(message),
+                )
+        except LoadTestError as e:
+            raise CommandError(str(e))
+        finally:
+            performance_logger.setLevel(previous_level)
+
+        report = {'meta': meta, **results}
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}."))
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            for line in compare_reports(baseline, report):
+                log_stream.write(line)
@@ -0,0 +1,24 @@
+# health_app/management/commands/rebuild_analytics.py
+from django.core.management.base import BaseCommand
+
+from health_app.analytics import KEY_FIELDS, rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the analytics summary tables from the patient records and assessments. "
+        "Run it once after deploying them, after changing thresholds.MARKERS, or after bulk SQL changes. "
+        "build.sh runs it with --if-empty, which fills the tables after the migration that creates them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hospital', type=int, action='append', dest='hospitals', help="Only rebuild this hospital (by id). Can be repeated.")
+        parser.add_argument('--if-empty', action='store_true', help="Do nothing if the summary tables already have rows.")
+
+    def handle(self, *args, **options):
+        if options['if_empty'] and any(model.objects.exists() for model in KEY_FIELDS):
+            self.stdout.write("The analytics summary is already populated.")
+            return
+        rows = rebuild(options['hospitals'])
+        scope = f"hospital(s) {', '.join(map(str, options['hospitals']))}" if options['hospitals'] else "all hospitals"
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the analytics summary for {scope}: {rows} row(s)."))
@@ -0,0 +1,13 @@
+# health_app/management/commands/recompute_risk_flags.py
+from django.core.management.base import BaseCommand
+
+from health_app.models import PatientRecord
+from health_app.thresholds import risk_flags_expression
+
+
+class Command(BaseCommand):
+    help = "Recomputes every PatientRecord.risk_flags from the rule table. Run it after changing thresholds.MARKERS."
+
+    def handle(self, *args, **options):
+        updated = PatientRecord.objects.update(risk_flags=risk_flags_expression())
+        self.stdout.write(self.style.SUCCESS(f"Recomputed the risk flags of {updated} record(s)."))
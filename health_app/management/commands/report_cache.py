@@ -0,0 +1,24 @@
+# health_app/management/commands/report_cache.py
+from django.core.management.base import BaseCommand
+
+from health_app.models import ReportCacheEntry
+from health_app.report_cache import cache_summary, evict
+
+
+class Command(BaseCommand):
+    help = "Shows statistics for the generated-report cache, or evicts/clears its entries."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--evict', action='store_true', help="Delete expired entries and trim the cache to AI_REPORT_CACHE_MAX_ENTRIES.")
+        parser.add_argument('--clear', action='store_true', help="Delete every cache entry.")
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            deleted, _ = ReportCacheEntry.objects.all().delete()
+            self.stdout.write(self.style.SUCCESS(f"Cleared {deleted} cache entries."))
+        elif options['evict']:
+            self.stdout.write(self.style.SUCCESS(f"Evicted {evict()} cache entries."))
+
+        summary = cache_summary()
+        self.stdout.write(f"Entries: {summary['entries']}")
+        self.stdout.write(f"Lifetime hits: {summary['lifetime_hits']}")
@@ -0,0 +1,94 @@
+# health_app/management/commands/run_analysis_worker.py
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from health_app.jobs import (
+    claim_jobs, claim_next_job, inference_circuit_open, jobs_per_claim, requeue_stale_jobs, run_analysis_job,
+    run_analysis_jobs_concurrently, run_upload_job,
+)
+from health_app.metrics import serve_worker_metrics
+from health_app.models import UploadJob
+
+
+class Command(BaseCommand):
+    help = "Runs queued CSV imports and AI analysis jobs. Start one or more of these next to the web process."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain the queue once and exit instead of polling forever.")
+        parser.add_argument('--max-jobs', type=int, default=None, help="Exit after running this many jobs.")
+        parser.add_argument('--poll-interval', type=float, default=None, help="Seconds to sleep when the queue is empty (default: AI_JOB_POLL_INTERVAL).")
+        parser.add_argument('--concurrency', type=int, default=None, help="Number of inference calls to run in parallel (default: AI_ANALYSIS_CONCURRENCY).")
+        parser.add_argument('--metrics-port', type=int, default=None, help="Serve this worker's Prometheus metrics on this port.")
+
+    def handle(self, *args, **options):
+        poll_interval = options['poll_interval'] or settings.AI_JOB_POLL_INTERVAL
+        concurrency = max(1, options['concurrency'] or settings.AI_ANALYSIS_CONCURRENCY)
+        max_jobs = options['max_jobs']
+        processed = 0
+        paused = False
+
+        if options['metrics_port']:
+            serve_worker_metrics(options['metrics_port'])
+            self.stdout.write(f"Serving metrics on port {options['metrics_port']}.")
+
+        requeued = requeue_stale_jobs()
+        if requeued:
+            self.stdout.write(self.style.WARNING(f"Re-queued {requeued} stale job(s)."))
+
+        self.stdout.write(f"Analysis worker started (concurrency {concurrency}, poll interval {poll_interval}s).")
+        try:
+            while max_jobs is None or processed < max_jobs:
+                # CSV imports go first: an admin is watching their progress bar.
+                upload_job = claim_next_job(UploadJob)
+                if upload_job is not None:
+                    run_upload_job(upload_job)
+                    processed += 1
+                    style = self.style.SUCCESS if upload_job.status == UploadJob.Status.DONE else self.style.ERROR
+                    self.stdout.write(style(
+                        f"Upload {upload_job.pk} ({upload_job.original_name}): {upload_job.status.lower()}, "
+                        f"{upload_job.rows_inserted} inserted, {upload_job.rows_updated} updated, "
+                        f"{upload_job.rows_unchanged} unchanged, {upload_job.error_count} error(s)"
+                    ))
+                    continue
+
+                # While the circuit breaker is open the model calls would be rejected; leave the jobs queued.
+                if inference_circuit_open():
+                    if not paused:
+                        self.stdout.write(self.style.WARNING("The AI service is failing; analysis jobs wait until the circuit breaker lets a call through."))
+                        paused = True
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+                paused = False
+
+                # Claim a few batches' worth of jobs so the thread pool stays busy.
+                limit = jobs_per_claim(concurrency)
+                if max_jobs is not None:
+                    limit = min(limit, max_jobs - processed)
+                jobs = claim_jobs(limit)
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                if len(jobs) == 1:
+                    run_analysis_job(jobs[0])
+                else:
+                    run_analysis_jobs_concurrently(jobs, max_workers=concurrency)
+                processed += len(jobs)
+
+                for job in jobs:
+                    if job.status == job.Status.QUEUED:
+                        self.stdout.write(self.style.WARNING(f"Job {job.pk} ({job.patient_record.patient_identifier}): deferred, the AI service is unavailable"))
+                    elif job.status == job.Status.DONE:
+                        self.stdout.write(self.style.SUCCESS(f"Job {job.pk} ({job.patient_record.patient_identifier}): done"))
+                    else:
+                        self.stdout.write(self.style.ERROR(f"Job {job.pk} ({job.patient_record.patient_identifier}): failed - {job.error}"))
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(f"Analysis worker stopped after {processed} job(s).")
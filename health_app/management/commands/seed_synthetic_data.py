@@ -0,0 +1,42 @@
+# health_app/management/commands/seed_synthetic_data.py
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from health_app.synthetic import SYNTHETIC_PASSWORD, admin_username, delete_synthetic_data, seed_hospitals
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-generates synthetic hospitals with doctors, patient records and assessments, for load tests "
+        "(see `load_test`). Meant for a development or staging database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hospitals', type=int, default=1, help="Hospitals to create (default: 1).")
+        parser.add_argument('--doctors', type=int, default=10, help="Doctors per hospital (default: 10).")
+        parser.add_argument('--records', type=int, default=10_000, help="Patient records per hospital (default: 10000).")
+        parser.add_argument('--assessed', type=float, default=0.8, help="Fraction of records with an assessment (default: 0.8).")
+        parser.add_argument('--reviewed', type=float, default=0.35, help="Fraction of assessments already reviewed (default: 0.35).")
+        parser.add_argument('--seed', type=int, default=42, help="Random seed, for reproducible data (default: 42).")
+        parser.add_argument('--delete', action='store_true', help="Delete all synthetic hospitals instead of creating any.")
+        parser.add_argument('--force', action='store_true', help="Run even though DEBUG is off.")
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError("This command writes a large dataset. Use --force to run it with DEBUG off.")
+
+        if options['delete']:
+            deleted = delete_synthetic_data()
+            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} synthetic hospital(s)."))
+            return
+
+        hospitals = seed_hospitals(
+            hospitals=options['hospitals'], doctors=options['doctors'], records=options['records'],
+            assessed=options['assessed'], reviewed=options['reviewed'], seed=options['seed'],
+            log=lambda message: self.stdout.write(message),
+        )
+        for hospital in hospitals:
+            number = hospital.name.rsplit(' ', 1)[-1]
+            self.stdout.write(self.style.SUCCESS(
+                f"Created {hospital.name}. Log in as {admin_username(number)} with password '{SYNTHETIC_PASSWORD}'."
+            ))
@@ -0,0 +1,68 @@
+# health_app/management/commands/serve_inference_stub.py
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+from health_app.inference import StubInferenceClient, to_json
+
+
+def make_handler(client):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self.send_error(404)
+                return
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            result = client.chat_completion(
+                payload.get('messages', []), model=payload.get('model'),
+                max_tokens=payload.get('max_tokens'), stream=bool(payload.get('stream')),
+            )
+            if payload.get('stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                for chunk in result:
+                    self.wfile.write(f"data: {json.dumps(to_json(chunk))}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+                return
+            body = json.dumps(to_json(result)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # One line per call would drown the output of a load test
+
+    return StubHandler
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves the stub inference backend as an OpenAI-compatible HTTP endpoint. Point another process "
+        "at it with AI_INFERENCE_BACKEND=http and AI_INFERENCE_URL=http://<host>:<port>/v1."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1).")
+        parser.add_argument('--port', type=int, default=8080, help="Port to listen on (default: 8080).")
+        parser.add_argument('--latency', type=float, default=None, help="Seconds before the first token (default: AI_STUB_LATENCY).")
+        parser.add_argument('--token-latency', type=float, default=None, help="Seconds per generated token (default: AI_STUB_TOKEN_LATENCY).")
+
+    def handle(self, *args, **options):
+        client = StubInferenceClient(latency=options['latency'], token_latency=options['token_latency'])
+        server = ThreadingHTTPServer((options['host'], options['port']), make_handler(client))
+        self.stdout.write(f"Stub inference server listening on http://{options['host']}:{server.server_port}/v1")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
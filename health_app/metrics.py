@@ -0,0 +1,171 @@
+# health_app/metrics.py
+"""
+Prometheus metrics, served in the text format at /metrics.
+
+Each process records into its own registry:
+- inference latency, tokens, errors and responses per model, and how batched
+  prompts split up (from services.py),
+- request latency per URL name (from PerformanceMiddleware).
+The job queue depth (from the database) and the circuit breaker state (from the
+cache) are read when /metrics is scraped, so every process reports the same values.
+
+Multiple processes: gunicorn workers don't share memory, so a scrape would only see
+the worker that answered it. Set PROMETHEUS_MULTIPROC_DIR to an empty directory that
+all the processes can write to. prometheus_client then keeps the values in files
+there, and /metrics adds up every process's values. gunicorn.conf.py empties the
+directory when gunicorn starts and cleans up after workers that exit. An analysis
+worker on the same machine can use the same directory. A worker elsewhere can serve
+its own metrics with `run_analysis_worker --metrics-port`.
+"""
+import os
+
+from django.db.models import Count
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess, start_http_server
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from .models import AnalysisJob, UploadJob
+
+registry = CollectorRegistry()
+
+# Model calls take seconds to minutes.
+INFERENCE_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180)
+
+inference_latency = Histogram(
+    'health_inference_latency_seconds', "Duration of model calls; for streams, until the last token.",
+    ['model', 'mode'], buckets=INFERENCE_BUCKETS, registry=registry,
+)
+inference_tokens = Counter(
+    'health_inference_tokens', "Tokens reported by the inference provider.",
+    ['model', 'kind'], registry=registry,
+)
+inference_errors = Counter(
+    'health_inference_errors', "Failed model calls, by exception type.",
+    ['model', 'error'], registry=registry,
+)
+inference_responses = Counter(
+    'health_inference_responses', "Model responses, by whether they contain the report anchor.",
+    ['model', 'anchor'], registry=registry,
+)
+inference_retries = Counter(
+    'health_inference_retries', "Model calls retried after a retryable error, by exception type.",
+    ['model', 'error'], registry=registry,
+)
+inference_rejected = Counter(
+    'health_inference_rejected', "Model calls rejected without trying because the circuit breaker was open.",
+    ['model'], registry=registry,
+)
+inference_truncated = Counter(
+    'health_inference_truncated', "Responses cut off by max_tokens (finish_reason \"length\").",
+    ['model'], registry=registry,
+)
+batch_reports = Counter(
+    'health_inference_batch_reports', "Reports from batched prompts: parsed from the batch response, or generated singly as a fallback.",
+    ['model', 'outcome'], registry=registry,
+)
+request_latency = Histogram(
+    'health_http_request_duration_seconds', "Request duration per URL name.",
+    ['view', 'method', 'status'], registry=registry,
+)
+
+
+def observe_inference(model, mode, seconds):
+    inference_latency.labels(model=model, mode=mode).observe(seconds)
+
+
+def count_tokens(model, usage):
+    """Counts the prompt and completion tokens of a response's `usage`, if the provider sent one."""
+    if usage is None:
+        return
+    for kind in ('prompt', 'completion'):
+        tokens = getattr(usage, f'{kind}_tokens', None)
+        if tokens:
+            inference_tokens.labels(model=model, kind=kind).inc(tokens)
+
+
+def count_error(model, error):
+    inference_errors.labels(model=model, error=type(error).__name__).inc()
+
+
+def count_response(model, has_anchor):
+    inference_responses.labels(model=model, anchor='present' if has_anchor else 'missing').inc()
+
+
+def count_finish_reason(model, finish_reason):
+    """Counts responses that ran out of max_tokens (see services.max_tokens_for); other reasons are ignored."""
+    if finish_reason == 'length':
+        inference_truncated.labels(model=model).inc()
+
+
+def count_retry(model, error):
+    inference_retries.labels(model=model, error=type(error).__name__).inc()
+
+
+def count_rejected(model):
+    inference_rejected.labels(model=model).inc()
+
+
+def count_batch_reports(model, parsed, fallback):
+    if parsed:
+        batch_reports.labels(model=model, outcome='parsed').inc(parsed)
+    if fallback:
+        batch_reports.labels(model=model, outcome='fallback').inc(fallback)
+
+
+def observe_request(view, method, status, seconds):
+    # Unmatched URLs share one label, so random paths can't grow the number of series.
+    request_latency.labels(view=view or 'unmatched', method=method, status=str(status)).observe(seconds)
+
+
+class JobQueueCollector:
+    """The number of queued and running jobs per queue, counted when /metrics is scraped."""
+
+    def collect(self):
+        depth = GaugeMetricFamily('health_job_queue_depth', "Jobs waiting or running, per queue.", labels=['queue', 'status'])
+        for queue, model in (('analysis', AnalysisJob), ('upload', UploadJob)):
+            statuses = [model.Status.QUEUED, model.Status.RUNNING]
+            counts = dict(
+                model.objects.filter(status__in=statuses).values_list('status').annotate(count=Count('pk')).order_by()
+            )
+            for status in statuses:
+                depth.add_metric([queue, status.lower()], counts.get(status, 0))
+        yield depth
+
+
+class CircuitBreakerCollector:
+    """The inference circuit breaker's state (see resilience.py), read from the cache when /metrics is scraped."""
+
+    def collect(self):
+        from .resilience import CircuitBreaker, inference_breaker
+
+        breaker = inference_breaker()
+        state = breaker.state()
+        gauge = GaugeMetricFamily('health_inference_circuit_state', "1 for the circuit breaker's current state.", labels=['breaker', 'state'])
+        for candidate in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN):
+            gauge.add_metric([breaker.name, candidate], 1 if candidate == state else 0)
+        yield gauge
+
+
+queue_registry = CollectorRegistry()
+queue_registry.register(JobQueueCollector())
+queue_registry.register(CircuitBreakerCollector())
+
+
+def _process_metrics():
+    """The registry to expose: this process's own, or every process's in multiprocess mode."""
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return registry
+    combined = CollectorRegistry()
+    multiprocess.MultiProcessCollector(combined)
+    return combined
+
+
+def render_metrics():
+    """The /metrics response body and content type."""
+    return generate_latest(_process_metrics()) + generate_latest(queue_registry), CONTENT_TYPE_LATEST
+
+
+def serve_worker_metrics(port):
+    """Serves the process metrics over HTTP from a background thread (for the analysis worker)."""
+    start_http_server(port, registry=_process_metrics())
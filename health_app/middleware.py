@@ -0,0 +1,138 @@
+# health_app/middleware.py
+import json
+import logging
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from . import metrics
+from .instrumentation import RequestTimings, activate, deactivate
+
+logger = logging.getLogger('health_app.performance')
+
+
+class PerformanceMiddleware:
+    """
+    Times each request (see instrumentation.py) and reports the breakdown twice:
+    - as a Server-Timing header, so it shows up in the browser's network panel,
+    - as one JSON log line on the 'health_app.performance' logger,
+    and adds the total to the request latency metric (see metrics.py).
+
+    Requests slower than PERFORMANCE_SLOW_REQUEST_MS also log their SQL (without the
+    parameters, which hold patient data). A streamed response's header only covers the
+    time until streaming starts; its log line is written when the stream ends and
+    includes the queries and model time spent producing the body.
+
+    It runs natively under both WSGI and ASGI, so an ASGI worker doesn't need a thread
+    per request to get through the middleware stack.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.PERFORMANCE_INSTRUMENTATION:
+            return self.get_response(request)
+
+        timings = RequestTimings(max_queries_kept=settings.PERFORMANCE_SLOW_REQUEST_MAX_QUERIES)
+        token = activate(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            deactivate(token)
+        return self._finish(request, response, timings)
+
+    async def __acall__(self, request):
+        if not settings.PERFORMANCE_INSTRUMENTATION:
+            return await self.get_response(request)
+
+        timings = RequestTimings(max_queries_kept=settings.PERFORMANCE_SLOW_REQUEST_MAX_QUERIES)
+        token = activate(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            deactivate(token)
+        return self._finish(request, response, timings)
+
+    def _finish(self, request, response, timings):
+        if settings.PERFORMANCE_SERVER_TIMING:
+            response['Server-Timing'] = timings.server_timing()
+        if response.streaming:
+            stream = self._astream if response.is_async else self._stream
+            response.streaming_content = stream(response.streaming_content, timings, request, response)
+        else:
+            timings.finish()
+            self._log(request, response, timings)
+        return response
+
+    def _stream(self, content, timings, request, response):
+        # The body is produced after __call__ has returned, so time it again while it's consumed.
+        token = activate(timings)
+        try:
+            yield from content
+        finally:
+            deactivate(token)
+            timings.finish()
+            self._log(request, response, timings)
+
+    async def _astream(self, content, timings, request, response):
+        token = activate(timings)
+        try:
+            async for part in content:
+                yield part
+        finally:
+            deactivate(token)
+            timings.finish()
+            self._log(request, response, timings)
+
+    def _log(self, request, response, timings):
+        match = request.resolver_match
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            **timings.as_dict(),
+        }
+        logger.info(json.dumps(fields), extra={'performance': fields})
+        metrics.observe_request(fields['view'], request.method, response.status_code, timings.total)
+
+        if fields['total_ms'] >= settings.PERFORMANCE_SLOW_REQUEST_MS:
+            queries = [{'sql': sql, 'ms': round(seconds * 1000, 2)} for sql, seconds in timings.queries]
+            slow = {**fields, 'slow': True, 'sql': queries, 'sql_truncated': fields['queries'] > len(queries)}
+            logger.warning(json.dumps(slow), extra={'performance': slow})
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise, also usable as async middleware. WhiteNoise's own middleware is sync-only,
+    which under ASGI makes Django run every request through a thread just to pass it on.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)  # Looks at the file system
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0002_analysisjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='SHA-256 of the normalized markers, model name and prompt version.', max_length=64, unique=True)),
+                ('report', models.TextField()),
+                ('model_name', models.CharField(max_length=200)),
+                ('prompt_version', models.PositiveIntegerField()),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_used_at'], name='reportcache_last_used')],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0003_reportcacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('csv_file', models.FileField(blank=True, help_text='The spooled upload; deleted once the import finishes.', upload_to='csv_uploads/')),
+                ('original_name', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='QUEUED', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('rows_parsed', models.PositiveIntegerField(default=0)),
+                ('rows_validated', models.PositiveIntegerField(default=0)),
+                ('rows_inserted', models.PositiveIntegerField(default=0)),
+                ('error_count', models.PositiveIntegerField(default=0)),
+                ('errors', models.JSONField(blank=True, default=list, help_text="Per-row errors: [{'row': 3, 'patient_identifier': 'P2', 'message': '...'}]")),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_jobs', to='health_app.hospital')),
+                ('uploaded_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='patientrecord',
+            name='upload_job',
+            field=models.ForeignKey(blank=True, help_text='The CSV import that created this record, if any.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='records', to='health_app.uploadjob'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadjob',
+            index=models.Index(fields=['status', 'created_at'], name='uploadjob_status_created'),
+        ),
+    ]
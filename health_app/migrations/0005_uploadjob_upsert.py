@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0004_uploadjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadjob',
+            name='rows_unchanged',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='uploadjob',
+            name='rows_updated',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='uploadjob',
+            name='upsert',
+            field=models.BooleanField(default=False, help_text='Update the markers of existing patients instead of rejecting the file.'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0005_uploadjob_upsert'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='riskassessment',
+            index=models.Index(fields=['status', 'reviewed_at', 'id'], name='assessment_status_reviewed'),
+        ),
+    ]
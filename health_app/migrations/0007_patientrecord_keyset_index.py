@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0006_riskassessment_reviewed_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patientrecord',
+            index=models.Index(fields=['hospital', '-created_at', '-id'], name='patient_hospital_created'),
+        ),
+    ]
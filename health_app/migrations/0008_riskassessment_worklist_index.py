@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0007_patientrecord_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='riskassessment',
+            index=models.Index(fields=['status', 'assigned_doctor', 'patient_record'], name='assessment_status_doctor'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0008_riskassessment_worklist_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='riskassessment',
+            name='html_report',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='riskassessment',
+            name='html_report_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text='REPORT_RENDERER_VERSION that produced html_report; 0 if not rendered yet.'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:23
+
+from functools import reduce
+
+from django.db import migrations, models
+from django.db.models import Case, IntegerField, Q, Value, When
+
+# thresholds.MARKERS as of this migration: (field, the lookups that make it abnormal), in bit
+# order. Frozen here so that later rule changes don't change what this migration computes;
+# `manage.py recompute_risk_flags` applies those.
+RISK_RULES = (
+    ('glucose', (('gte', 126),)),
+    ('hba1c', (('gte', 6.5), ('gte', 5.7))),
+    ('total_cholesterol', (('gt', 200),)),
+    ('ldl', (('gt', 130),)),
+    ('hdl', (('lt', 40),)),
+    ('triglycerides', (('gt', 150),)),
+    ('alt', (('gt', 40),)),
+    ('ast', (('gt', 35),)),
+    ('creatinine', (('gt', 1.3),)),
+    ('urea', (('gt', 50),)),
+    ('crp', (('gt', 3),)),
+    ('wbc', (('gt', 11),)),
+)
+
+
+def compute_risk_flags(apps, schema_editor):
+    # One UPDATE with a CASE per marker, like thresholds.risk_flags_expression() at the time.
+    PatientRecord = apps.get_model('health_app', 'PatientRecord')
+    bits = []
+    for i, (field, lookups) in enumerate(RISK_RULES):
+        abnormal = reduce(lambda a, b: a | b, (Q(**{f"{field}__{lookup}": threshold}) for lookup, threshold in lookups))
+        bits.append(Case(When(abnormal, then=Value(1 << i)), default=Value(0), output_field=IntegerField()))
+    PatientRecord.objects.update(risk_flags=sum(bits[1:], bits[0]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0009_riskassessment_html_report'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientrecord',
+            name='risk_flags',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='patientrecord',
+            index=models.Index(fields=['patient_identifier'], name='patient_identifier_prefix', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunPython(compute_risk_flags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:29
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_created_at(apps, schema_editor):
+    # Existing reports have no generation time; the record's upload time is the closest known one.
+    RiskAssessment = apps.get_model('health_app', 'RiskAssessment')
+    PatientRecord = apps.get_model('health_app', 'PatientRecord')
+    RiskAssessment.objects.update(created_at=Subquery(
+        PatientRecord.objects.filter(pk=OuterRef('patient_record_id')).values('created_at')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0010_patientrecord_risk_flags'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='riskassessment',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_created_at, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='BacklogDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='backlog_counts', to='health_app.hospital')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('hospital', 'day'), name='backlogdaily_unique_key')],
+            },
+        ),
+        migrations.CreateModel(
+            name='MarkerBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('marker', models.CharField(help_text="A PatientRecord marker field, e.g. 'glucose'.", max_length=50)),
+                ('bucket', models.PositiveIntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('value_sum', models.FloatField(default=0)),
+                ('abnormal_count', models.IntegerField(default=0, help_text='Values in this bucket that match a threshold rule.')),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='marker_buckets', to='health_app.hospital')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('hospital', 'marker', 'bucket'), name='markerbucket_unique_key')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ReviewDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('count', models.IntegerField(default=0)),
+                ('doctor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='review_counts', to=settings.AUTH_USER_MODEL)),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='review_counts', to='health_app.hospital')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('hospital', 'doctor', 'day'), name='reviewdaily_unique_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0011_analytics_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='riskassessment',
+            name='prompt_version',
+            field=models.PositiveSmallIntegerField(blank=True, editable=False, help_text='services.PROMPT_VERSION of the prompt that produced the report; empty for templated reports and reports from before it was recorded.', null=True),
+        ),
+    ]
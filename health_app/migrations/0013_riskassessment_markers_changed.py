@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0012_riskassessment_prompt_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='riskassessment',
+            name='markers_changed',
+            field=models.BooleanField(default=False, editable=False, help_text="An upload updated the record's markers after the report was generated, so the report describes the old values."),
+        ),
+    ]
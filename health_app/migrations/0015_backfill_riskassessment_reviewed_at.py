@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:36
+
+from django.db import migrations
+from django.db.models import F
+
+
+def backfill_reviewed_at(apps, schema_editor):
+    # The reviewed reports export skips reviewed rows without a reviewed_at (they have no place in
+    # its (reviewed_at, id) order). Older rows reviewed without one get their creation time, the
+    # closest known time, so they stay in full exports. Incremental syncs whose cursor is already
+    # past that time won't see them; a full export will.
+    RiskAssessment = apps.get_model('health_app', 'RiskAssessment')
+    RiskAssessment.objects.filter(status='REVIEWED', reviewed_at__isnull=True).update(reviewed_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0014_shared_cache_table'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_reviewed_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:37
+
+from django.db import migrations, models
+
+
+def fail_duplicate_active_jobs(apps, schema_editor):
+    # Before the constraint, concurrent requests could queue a record twice. Keep its oldest
+    # active job and mark the others failed, so the constraint can be added.
+    AnalysisJob = apps.get_model('health_app', 'AnalysisJob')
+    kept = set()
+    duplicates = []
+    active = AnalysisJob.objects.filter(status__in=['QUEUED', 'RUNNING']).order_by('created_at', 'pk')
+    for pk, record_id in active.values_list('pk', 'patient_record_id'):
+        if record_id in kept:
+            duplicates.append(pk)
+        kept.add(record_id)
+    AnalysisJob.objects.filter(pk__in=duplicates).update(status='FAILED', error="Error: A duplicate of an earlier job for this record.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0015_backfill_riskassessment_reviewed_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(fail_duplicate_active_jobs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='analysisjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['QUEUED', 'RUNNING'])), fields=('patient_record',), name='analysisjob_one_active_per_record'),
+        ),
+    ]
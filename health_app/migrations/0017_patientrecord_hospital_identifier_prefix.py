@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('health_app', '0016_analysisjob_one_active_per_record'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='patientrecord',
+            name='patient_identifier_prefix',
+        ),
+        migrations.AddIndex(
+            model_name='patientrecord',
+            index=models.Index(fields=['hospital', 'patient_identifier'], name='patient_hospital_id_prefix', opclasses=['', 'varchar_pattern_ops']),
+        ),
+    ]
@@ -2,6 +2,10 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
+from django.utils import timezone
+
+from .rendering import REPORT_RENDERER_VERSION, render_report_html
+from .thresholds import MARKER_FIELDS, risk_flags
 
 # --- MODEL ORDER: DEFINE PARENTS BEFORE CHILDREN ---
 
@@ -33,12 +37,58 @@ class User(AbstractUser):
     hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE, null=True, blank=True, related_name='users')
 
 
-# 3. Patient Record Model
-# This depends on `Hospital` and `User`.
+# 3. Upload Job Model
+# This depends on `Hospital` and `User`. A CSV upload is spooled to disk and
+# imported by the `run_analysis_worker` process, which reports its progress here.
+class UploadJob(models.Model):
+    class Status(models.TextChoices):
+        QUEUED = "QUEUED", "Queued"
+        RUNNING = "RUNNING", "Running"
+        DONE = "DONE", "Done"
+        FAILED = "FAILED", "Failed"
+
+    hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name="upload_jobs")
+    uploaded_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name="upload_jobs")
+    csv_file = models.FileField(upload_to='csv_uploads/', blank=True, help_text="The spooled upload; deleted once the import finishes.")
+    original_name = models.CharField(max_length=255)
+    upsert = models.BooleanField(default=False, help_text="Update the markers of existing patients instead of rejecting the file.")
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+
+    # Progress counters, updated after every batch
+    rows_parsed = models.PositiveIntegerField(default=0)
+    rows_validated = models.PositiveIntegerField(default=0)
+    rows_inserted = models.PositiveIntegerField(default=0)
+    rows_updated = models.PositiveIntegerField(default=0)
+    rows_unchanged = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True, help_text="Per-row errors: [{'row': 3, 'patient_identifier': 'P2', 'message': '...'}]")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='uploadjob_status_created'),
+        ]
+
+    def __str__(self):
+        return f"Upload {self.original_name} for {self.hospital.name} - {self.status}"
+
+    @property
+    def is_active(self):
+        return self.status in (self.Status.QUEUED, self.Status.RUNNING)
+
+
+# 4. Patient Record Model
+# This depends on `Hospital`, `User` and `UploadJob`.
 class PatientRecord(models.Model):
     patient_identifier = models.CharField(max_length=100, help_text="A unique ID for the patient (e.g., P001, MRN-456)")
     hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name="patient_records")
     uploaded_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name="uploaded_records")
+    upload_job = models.ForeignKey(UploadJob, on_delete=models.SET_NULL, null=True, blank=True, related_name="records", help_text="The CSV import that created this record, if any.")
 
     # Blood Test Markers
     glucose = models.FloatField(null=True, blank=True)
@@ -54,18 +104,49 @@ class PatientRecord(models.Model):
     crp = models.FloatField(null=True, blank=True)
     wbc = models.FloatField(null=True, blank=True)
 
+    # Bit i is set when marker i of thresholds.MARKERS is abnormal; lets cohort searches
+    # ("flagged for HbA1c and LDL") test one integer instead of every threshold.
+    risk_flags = models.PositiveIntegerField(default=0, editable=False)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('hospital', 'patient_identifier')
         ordering = ['-created_at'] # Good practice to have a default order
+        indexes = [
+            # The patient list's keyset pagination seeks on (created_at, id) within a hospital.
+            models.Index(fields=['hospital', '-created_at', '-id'], name='patient_hospital_created'),
+            # Identifier prefix search (hospital = ... AND LIKE 'P00%'). On PostgreSQL the pattern
+            # operator class is what lets LIKE use the index under a non-C collation; the unique
+            # (hospital, patient_identifier) index can't serve the LIKE part.
+            models.Index(
+                fields=['hospital', 'patient_identifier'], name='patient_hospital_id_prefix',
+                opclasses=['', 'varchar_pattern_ops'],
+            ),
+        ]
 
     def __str__(self):
         return f"Record for {self.patient_identifier} at {self.hospital.name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The markers as loaded, so the analytics summary can subtract them when they change (see analytics.py).
+        if all(field in instance.__dict__ for field in MARKER_FIELDS):
+            instance._loaded_markers = tuple(instance.__dict__[field] for field in MARKER_FIELDS)
+        return instance
+
+    def save(self, *args, **kwargs):
+        # bulk_create callers set risk_flags themselves, see csv_import.py.
+        self.risk_flags = risk_flags(self)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(update_fields) & set(MARKER_FIELDS):
+            kwargs['update_fields'] = {*update_fields, 'risk_flags'}
+        super().save(*args, **kwargs)
 
-# 4. Risk Assessment Model
+
+# 5. Risk Assessment Model
 # This depends on `PatientRecord` and `User`.
 class RiskAssessment(models.Model):
     class Status(models.TextChoices):
@@ -75,10 +156,17 @@ class RiskAssessment(models.Model):
 
     patient_record = models.OneToOneField(PatientRecord, on_delete=models.CASCADE, related_name="assessment")
     ai_generated_report = models.TextField(help_text="The risk assessment report generated by the AI.")
+    # The report rendered to HTML when it is saved, so page views do no markdown parsing.
+    html_report = models.TextField(blank=True, default='', editable=False)
+    html_report_version = models.PositiveSmallIntegerField(default=0, editable=False, help_text="REPORT_RENDERER_VERSION that produced html_report; 0 if not rendered yet.")
+    prompt_version = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, help_text="services.PROMPT_VERSION of the prompt that produced the report; empty for templated reports and reports from before it was recorded.")
+    markers_changed = models.BooleanField(default=False, editable=False, help_text="An upload updated the record's markers after the report was generated, so the report describes the old values.")
     doctor_comments = models.TextField(blank=True, null=True, help_text="Comments and final assessment by the doctor.")
     status = models.CharField(max_length=50, choices=Status.choices, default=Status.PENDING_REVIEW)
     reviewed_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name="reviewed_assessments")
     reviewed_at = models.DateTimeField(null=True, blank=True)
+    # When the report was generated; the start of its wait in the review backlog.
+    created_at = models.DateTimeField(default=timezone.now)
 
     # --- CONSOLIDATED DEFINITION for assigned_doctor ---
     assigned_doctor = models.ForeignKey(
@@ -91,5 +179,163 @@ class RiskAssessment(models.Model):
         help_text="The doctor assigned to review this assessment."
     )
 
+    class Meta:
+        indexes = [
+            # Serves the reviewed reports export and its (reviewed_at, id) watermark.
+            models.Index(fields=['status', 'reviewed_at', 'id'], name='assessment_status_reviewed'),
+            # The doctor worklist: pending reports assigned to one doctor, or unassigned (assigned_doctor IS NULL).
+            models.Index(fields=['status', 'assigned_doctor', 'patient_record'], name='assessment_status_doctor'),
+        ]
+
+    def __str__(self):
+        return f"Assessment for {self.patient_record.patient_identifier} - {self.status}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the report as loaded, so save() only re-renders when it has changed.
+        # A deferred html_report_version (e.g. `.only()` in backfill_report_html) is not fetched for this.
+        loaded = instance.__dict__
+        instance._rendered_report = loaded.get('ai_generated_report') if loaded.get('html_report_version') == REPORT_RENDERER_VERSION else None
+        # The review state as loaded, for the analytics summary (see analytics.py).
+        if all(field in instance.__dict__ for field in ('status', 'reviewed_by_id', 'reviewed_at', 'created_at')):
+            instance._loaded_review_state = (instance.status, instance.reviewed_by_id, instance.reviewed_at, instance.created_at)
+        return instance
+
+    def render_html(self):
+        """Renders ai_generated_report into html_report. Call this before bulk_create, which skips save()."""
+        self.html_report = render_report_html(self.ai_generated_report)
+        self.html_report_version = REPORT_RENDERER_VERSION
+        self._rendered_report = self.ai_generated_report
+
+    def ensure_html_report(self):
+        """Lazily renders rows stored before html_report existed, or by an older renderer version."""
+        if self.html_report_version != REPORT_RENDERER_VERSION:
+            self.render_html()
+            self.save(update_fields=['html_report', 'html_report_version'])
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'ai_generated_report' in update_fields:
+            if self.ai_generated_report != getattr(self, '_rendered_report', None):
+                self.render_html()
+                if update_fields is not None:
+                    kwargs['update_fields'] = {*update_fields, 'html_report', 'html_report_version'}
+        super().save(*args, **kwargs)
+
+# 6. Analysis Job Model
+# Depends on `PatientRecord` and `User`. Jobs are queued by the web process and
+# executed by the `run_analysis_worker` management command.
+class AnalysisJob(models.Model):
+    class Status(models.TextChoices):
+        QUEUED = "QUEUED", "Queued"
+        RUNNING = "RUNNING", "Running"
+        DONE = "DONE", "Done"
+        FAILED = "FAILED", "Failed"
+
+    patient_record = models.ForeignKey(PatientRecord, on_delete=models.CASCADE, related_name="analysis_jobs")
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name="requested_analysis_jobs")
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, help_text="The error message if the job failed.")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']  # Oldest first, so the worker drains the queue in FIFO order
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='analysisjob_status_created'),
+        ]
+        constraints = [
+            # Two concurrent "Analyze" clicks must not queue (and bill) the same record twice.
+            models.UniqueConstraint(
+                fields=['patient_record'], condition=models.Q(status__in=['QUEUED', 'RUNNING']),
+                name='analysisjob_one_active_per_record',
+            ),
+        ]
+
+    def __str__(self):
+        return f"Analysis job {self.pk} for {self.patient_record.patient_identifier} - {self.status}"
+
+    @property
+    def is_active(self):
+        return self.status in (self.Status.QUEUED, self.Status.RUNNING)
+
+
+# 7. Report Cache Model
+# Standalone. Stores generated reports keyed by a hash of the marker values,
+# model name and prompt version, so identical panels never pay for a second LLM call.
+class ReportCacheEntry(models.Model):
+    key = models.CharField(max_length=64, unique=True, help_text="SHA-256 of the normalized markers, model name and prompt version.")
+    report = models.TextField()
+    model_name = models.CharField(max_length=200)
+    prompt_version = models.PositiveIntegerField()
+    hit_count = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_used_at'], name='reportcache_last_used'),
+        ]
+
+    def __str__(self):
+        return f"Cached report {self.key[:12]} ({self.model_name}, prompt v{self.prompt_version})"
+
+
+# 8-10. Analytics Summary Models
+# Per-hospital aggregates behind the analytics dashboard. They are kept up to date
+# incrementally as records and assessments are saved or deleted (see analytics.py),
+# and can be recomputed from scratch with `manage.py rebuild_analytics`.
+
+class MarkerBucket(models.Model):
+    """A histogram bucket of one marker's values: [bucket * width, (bucket + 1) * width)."""
+    hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name='marker_buckets')
+    marker = models.CharField(max_length=50, help_text="A PatientRecord marker field, e.g. 'glucose'.")
+    bucket = models.PositiveIntegerField()
+    count = models.IntegerField(default=0)
+    value_sum = models.FloatField(default=0)
+    abnormal_count = models.IntegerField(default=0, help_text="Values in this bucket that match a threshold rule.")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['hospital', 'marker', 'bucket'], name='markerbucket_unique_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.marker} bucket {self.bucket} at hospital {self.hospital_id}: {self.count}"
+
+
+class ReviewDaily(models.Model):
+    """Reviews submitted by one doctor on one day."""
+    hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name='review_counts')
+    # Kept (as NULL) when the doctor's account is deleted, so the hospital's totals don't change.
+    doctor = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name='review_counts')
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['hospital', 'doctor', 'day'], name='reviewdaily_unique_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.count} review(s) by doctor {self.doctor_id} on {self.day}"
+
+
+class BacklogDaily(models.Model):
+    """Assessments still pending review, by the day their report was generated."""
+    hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name='backlog_counts')
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['hospital', 'day'], name='backlogdaily_unique_key'),
+        ]
+
     def __str__(self):
-        return f"Assessment for {self.patient_record.patient_identifier} - {self.status}"
\ No newline at end of file
+        return f"{self.count} pending from {self.day} at hospital {self.hospital_id}"
@@ -0,0 +1,188 @@
+# health_app/pagination.py
+"""
+Keyset (cursor) pagination for the patient list and the doctor worklist.
+
+Django's Paginator runs a COUNT(*) on every page and fetches deep pages with
+OFFSET, which scans and discards every earlier row. Here a page is fetched by
+seeking past the ordering key of the last row shown:
+
+    WHERE (created_at, id) < (:last_created_at, :last_id) ORDER BY created_at DESC, id DESC LIMIT n
+
+so every page costs the same, however deep it is. The position is passed
+between requests as an opaque `?cursor=` token. A total count is optional
+and capped (see `capped_count`).
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from functools import reduce
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+
+def _encode_value(value):
+    # JSON has no datetime type, so tag them to decode them back exactly.
+    return {'dt': value.isoformat()} if isinstance(value, datetime) else value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        parsed = parse_datetime(value['dt'])
+        if parsed is None:
+            raise ValueError("Invalid datetime in cursor.")
+        return parsed
+    return value
+
+
+def encode_cursor(direction, values):
+    """An opaque, URL-safe token for 'the page after (direction "n") or before ("p") this key'."""
+    payload = json.dumps({'d': direction, 'v': [_encode_value(v) for v in values]}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, key_length):
+    """Returns (direction, values). Raises ValueError for a malformed or foreign token."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        direction, values = payload['d'], [_decode_value(v) for v in payload['v']]
+    except (binascii.Error, TypeError, KeyError, AttributeError) as e:
+        raise ValueError("Invalid cursor.") from e
+    if direction not in ('n', 'p') or len(values) != key_length:
+        raise ValueError("Invalid cursor.")
+    return direction, values
+
+
+def capped_count(queryset, cap=None):
+    """
+    Counts at most cap + 1 rows, so the cost is bounded however large the table is.
+    Returns (count, is_exact); above the cap the count is reported as "cap+".
+    """
+    cap = cap or settings.PAGINATION_COUNT_CAP
+    count = queryset.order_by()[:cap + 1].count()
+    return min(count, cap), count <= cap
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    Pages through `queryset` in the order given by `ordering`, a list of field names
+    (optionally prefixed with '-') that must end in a unique column such as 'pk',
+    and whose fields must not be NULL.
+    """
+
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = list(ordering)
+        self.fields = [field.lstrip('-') for field in self.ordering]
+        self.descending = [field.startswith('-') for field in self.ordering]
+
+    def _key(self, obj):
+        """The ordering key of a row, read through any select_related joins."""
+        values = []
+        for field in self.fields:
+            value = obj
+            for attr in field.split('__'):
+                value = getattr(value, attr)
+            values.append(value)
+        return values
+
+    def _seek(self, values, forward):
+        """
+        Matches the rows strictly after (forward) or before the key, in lexicographic order:
+        (a > x) OR (a = x AND b > y) OR ...; each field compares by its own direction.
+        """
+        conditions = []
+        for i, (field, value, descending) in enumerate(zip(self.fields, values, self.descending)):
+            lookup = 'lt' if descending == forward else 'gt'
+            equal_prefix = {f: v for f, v in zip(self.fields[:i], values[:i])}
+            conditions.append(Q(**equal_prefix, **{f"{field}__{lookup}": value}))
+        return reduce(lambda a, b: a | b, conditions)
+
+    def page(self, cursor=None):
+        if cursor:
+            try:
+                direction, values = decode_cursor(cursor, len(self.fields))
+            except ValueError:
+                raise Http404("Invalid page.")
+        else:
+            direction, values = 'n', None
+
+        forward = direction == 'n'
+        ordering = self.ordering if forward else [
+            field[1:] if field.startswith('-') else f"-{field}" for field in self.ordering
+        ]
+        queryset = self.queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self._seek(values, forward))
+
+        # One extra row tells whether there is another page in this direction.
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if not forward:
+            rows.reverse()
+
+        has_next = has_more if forward else True
+        has_previous = values is not None if forward else has_more
+        if not rows:
+            return KeysetPage(rows, None, None)
+        return KeysetPage(
+            rows,
+            encode_cursor('n', self._key(rows[-1])) if has_next else None,
+            encode_cursor('p', self._key(rows[0])) if has_previous else None,
+        )
+
+
+class KeysetPaginationMixin:
+    """
+    Replaces ListView's OFFSET pagination with keyset pagination.
+    Set `keyset_ordering`; the page is chosen by the `?cursor=` parameter. The context gets
+    `next_page_url` / `previous_page_url`, and with `?count=1` a capped `total_count` / `total_count_exact`.
+    """
+    keyset_ordering = ['-created_at', '-pk']
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, page_size, self.keyset_ordering)
+        page = paginator.page(self.request.GET.get('cursor'))
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def _page_url(self, cursor):
+        # Keep the other query parameters (e.g. ?count=1) when moving between pages.
+        params = self.request.GET.copy()
+        params['cursor'] = cursor
+        return f"?{params.urlencode()}"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        page = context['page_obj']
+        context['next_page_url'] = self._page_url(page.next_cursor) if page.has_next() else None
+        context['previous_page_url'] = self._page_url(page.previous_cursor) if page.has_previous() else None
+        if self.request.GET.get('count'):
+            context['total_count'], context['total_count_exact'] = capped_count(self.object_list)
+        return context
@@ -0,0 +1,21 @@
+# health_app/rendering.py
+"""
+Markdown-to-HTML rendering of AI reports.
+
+Reports are rendered once, when they are stored, and the HTML is saved on the
+RiskAssessment together with REPORT_RENDERER_VERSION. Bump the version whenever
+the output of `render_report_html` changes (e.g. new markdown extensions); rows
+rendered by an older version are re-rendered lazily on their next view, or all at
+once by `manage.py backfill_report_html`.
+"""
+from .instrumentation import timed
+
+REPORT_RENDERER_VERSION = 1
+
+
+def render_report_html(report):
+    # Imported here: only report saves and backfills render, so processes start without it.
+    import markdown
+
+    with timed('render'):
+        return markdown.markdown(report, extensions=['extra', 'nl2br'])
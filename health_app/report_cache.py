@@ -0,0 +1,140 @@
+# health_app/report_cache.py
+"""
+Content-addressed cache for generated risk reports.
+
+The cache key is a SHA-256 of the normalized 12-marker vector plus the model
+name and prompt version, so the same blood panel (a re-test, test data, or a
+patient re-entered under a new identifier) reuses the stored report instead of
+calling the model again. Changing MODEL_NAME or PROMPT_VERSION changes every key.
+
+Entries live in the `ReportCacheEntry` table, so they survive restarts and are
+shared by the web and worker processes. Entries older than AI_REPORT_CACHE_MAX_AGE_DAYS
+expire, and the least recently used entries are evicted beyond AI_REPORT_CACHE_MAX_ENTRIES.
+"""
+import hashlib
+import json
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import ReportCacheEntry
+from .thresholds import MARKER_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+class CacheStats:
+    """Hit/miss counters for this process. Thread-safe, since the analysis worker uses a thread pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+stats = CacheStats()
+
+
+def normalize_markers(patient_record):
+    """The marker vector in a canonical form: fixed field order, values rounded, missing values as None."""
+    return [
+        None if value is None else round(float(value), 4)
+        for value in (getattr(patient_record, field) for field in MARKER_FIELDS)
+    ]
+
+
+def cache_key(patient_record, model_name, prompt_version):
+    payload = json.dumps({
+        'markers': normalize_markers(patient_record),
+        'model': model_name,
+        'prompt_version': prompt_version,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_cached_report(patient_record, model_name, prompt_version):
+    """
+    Returns the cached report for this panel, or None on a miss.
+    The cache is best-effort: a database error is treated as a miss.
+    """
+    if not settings.AI_REPORT_CACHE_ENABLED:
+        return None
+
+    key = cache_key(patient_record, model_name, prompt_version)
+    min_created_at = timezone.now() - timedelta(days=settings.AI_REPORT_CACHE_MAX_AGE_DAYS)
+    try:
+        report = ReportCacheEntry.objects.filter(key=key, created_at__gte=min_created_at).values_list('report', flat=True).first()
+        if report is not None:
+            ReportCacheEntry.objects.filter(key=key).update(hit_count=F('hit_count') + 1, last_used_at=timezone.now())
+    except DatabaseError:
+        logger.exception("Report cache lookup failed")
+        report = None
+
+    stats.record(hit=report is not None)
+    return report
+
+
+def store_report(patient_record, model_name, prompt_version, report):
+    """Caches a successfully generated report, then evicts entries beyond the configured limits."""
+    if not settings.AI_REPORT_CACHE_ENABLED:
+        return
+
+    key = cache_key(patient_record, model_name, prompt_version)
+    try:
+        ReportCacheEntry.objects.update_or_create(
+            key=key,
+            defaults={
+                'report': report,
+                'model_name': model_name,
+                'prompt_version': prompt_version,
+                'created_at': timezone.now(),
+                'last_used_at': timezone.now(),
+            },
+        )
+        evict()
+    except DatabaseError:
+        # Failing to cache must never fail the analysis itself.
+        logger.exception("Report cache store failed")
+
+
+def evict():
+    """
+    Deletes expired entries, then the least recently used ones above the size limit.
+    Returns the number of entries deleted.
+    """
+    cutoff = timezone.now() - timedelta(days=settings.AI_REPORT_CACHE_MAX_AGE_DAYS)
+    deleted, _ = ReportCacheEntry.objects.filter(created_at__lt=cutoff).delete()
+
+    overflow = ReportCacheEntry.objects.count() - settings.AI_REPORT_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        oldest_ids = list(ReportCacheEntry.objects.order_by('last_used_at').values_list('pk', flat=True)[:overflow])
+        deleted += ReportCacheEntry.objects.filter(pk__in=oldest_ids).delete()[0]
+    return deleted
+
+
+def cache_summary():
+    """Entry count and lifetime hits from the table, plus this process's hit/miss counters."""
+    totals = ReportCacheEntry.objects.aggregate(lifetime_hits=Sum('hit_count'))
+    return {
+        'entries': ReportCacheEntry.objects.count(),
+        'lifetime_hits': totals['lifetime_hits'] or 0,
+        'process_hits': stats.hits,
+        'process_misses': stats.misses,
+    }
@@ -0,0 +1,203 @@
+# health_app/resilience.py
+"""
+Timeouts, retries and a circuit breaker for model calls.
+
+`check_circuit` rejects a call up front while the circuit is open, and
+`call_with_retries` runs one model call and retries it when the provider had trouble:
+- timeouts,
+- connection errors,
+- HTTP 429 or 5xx responses.
+Between attempts it waits a jittered, exponentially growing delay. It only starts
+another attempt if that attempt, given AI_INFERENCE_TIMEOUT, still fits in
+AI_INFERENCE_BUDGET. Other errors, e.g. a rejected request, are raised at once.
+
+`CircuitBreaker` counts calls that still failed after their retries. After
+AI_BREAKER_FAILURE_THRESHOLD consecutive failures the circuit opens. Calls are then
+rejected with `InferenceUnavailable` without reaching the provider, so a click or a
+queued job doesn't wait out a full timeout. After AI_BREAKER_RESET_TIMEOUT seconds
+a single trial call is let through. If it succeeds the circuit closes again; if it
+fails the circuit stays open for another period.
+
+The breaker's state is kept in the 'shared' cache (a database cache by default), so
+every web and worker process sees the same circuit.
+
+`acheck_circuit` and `acall_with_retries` are the same for the async views; they wait
+with `asyncio.sleep`, and reach the cache from a thread.
+"""
+import asyncio
+import random
+import time
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.connection import ConnectionProxy
+
+from . import metrics
+
+
+cache = ConnectionProxy(caches, 'shared')
+
+
+class InferenceUnavailable(Exception):
+    """The circuit is open: the inference provider is failing, so the call was not attempted."""
+
+    def __init__(self, retry_at=None):
+        self.retry_at = retry_at
+        super().__init__("The AI service is temporarily unavailable after repeated failures.")
+
+
+def is_retryable(error):
+    """Whether `error` means the provider had trouble (so another attempt may succeed)."""
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is None:
+        status = getattr(error, 'status', None)  # aiohttp.ClientResponseError
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    # By name, so requests/huggingface_hub/aiohttp don't have to be imported: requests.Timeout,
+    # requests.ConnectionError, huggingface_hub's InferenceTimeoutError (a TimeoutError) and
+    # aiohttp.ClientConnectionError.
+    names = {cls.__name__ for cls in type(error).__mro__}
+    return bool(names & {'TimeoutError', 'Timeout', 'ConnectionError', 'ClientConnectionError'})
+
+
+def backoff_delay(attempt):
+    """The wait before retry number `attempt` (1, 2, ...): "full jitter" over an exponentially growing cap."""
+    cap = min(settings.AI_RETRY_MAX_DELAY, settings.AI_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return random.uniform(0, cap)
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name):
+        self.name = name
+
+    def _key(self, part):
+        return f"circuit:{self.name}:{part}"
+
+    def retry_at(self):
+        """When an open circuit lets a trial call through (a Unix timestamp), or None if it isn't open."""
+        return cache.get(self._key('open_until'))
+
+    def state(self):
+        open_until = self.retry_at()
+        if open_until is None:
+            return self.CLOSED
+        return self.OPEN if time.time() < open_until else self.HALF_OPEN
+
+    def allow(self):
+        """Whether a call may go ahead. In the half-open state only one caller, in any process, gets True."""
+        state = self.state()
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        # The trial marker expires, so a trial whose process died doesn't block the circuit forever.
+        return cache.add(self._key('trial'), True, timeout=settings.AI_INFERENCE_TIMEOUT + 5)
+
+    def release_trial(self):
+        """Lets another caller make the half-open trial call, leaving the circuit as it is."""
+        self._clear('trial')
+
+    def record_success(self):
+        self._clear('failures', 'open_until', 'trial')
+
+    def record_failure(self):
+        """
+        Counts a failed call, and opens the circuit at the threshold.
+        The count is a read-modify-write on most cache backends (the database cache included), so
+        failures in several processes at once may be counted as one. The circuit then opens a few
+        failures late; it never opens early.
+        """
+        if self.state() != self.CLOSED:
+            self._open()  # The trial call failed
+            return
+        cache.add(self._key('failures'), 0, timeout=None)
+        if cache.incr(self._key('failures')) >= settings.AI_BREAKER_FAILURE_THRESHOLD:
+            self._open()
+
+    def _clear(self, *parts):
+        # Successful calls are the hot path: read first, so a closed, healthy circuit costs no
+        # write (on the database cache, a DELETE that takes SQLite's write lock).
+        present = cache.get_many([self._key(part) for part in parts])
+        if present:
+            cache.delete_many(list(present))
+
+    def _open(self):
+        cache.set(self._key('open_until'), time.time() + settings.AI_BREAKER_RESET_TIMEOUT, timeout=None)
+        cache.delete_many([self._key('failures'), self._key('trial')])
+
+
+def inference_breaker():
+    """The circuit breaker of the configured inference backend."""
+    return CircuitBreaker(f"inference:{settings.AI_INFERENCE_BACKEND}")
+
+
+def check_circuit(model):
+    """Returns the inference breaker if it lets a call through; raises InferenceUnavailable otherwise."""
+    breaker = inference_breaker()
+    if not breaker.allow():
+        metrics.count_rejected(model)
+        raise InferenceUnavailable(breaker.retry_at())
+    return breaker
+
+
+def call_with_retries(call, model, breaker):
+    """
+    Runs `call()` under the retry policy, records the outcome on `breaker` (from
+    `check_circuit`), and returns the result. Raises the last error when the attempts
+    or the time budget run out.
+    """
+    started = time.monotonic()
+    attempt = 1
+    while True:
+        try:
+            result = call()
+        except Exception as e:
+            if not is_retryable(e):
+                # Not a sign of provider trouble (e.g. a rejected request), but not of recovery
+                # either: don't retry, and leave the circuit as it is.
+                breaker.release_trial()
+                raise
+            delay = backoff_delay(attempt)
+            next_attempt_ends = time.monotonic() - started + delay + settings.AI_INFERENCE_TIMEOUT
+            if attempt >= settings.AI_RETRY_ATTEMPTS or next_attempt_ends > settings.AI_INFERENCE_BUDGET:
+                breaker.record_failure()
+                raise
+            metrics.count_retry(model, e)
+            time.sleep(delay)
+            attempt += 1
+        else:
+            breaker.record_success()
+            return result
+
+
+async def acheck_circuit(model):
+    """`check_circuit` for async callers."""
+    return await sync_to_async(check_circuit)(model)
+
+
+async def acall_with_retries(call, model, breaker):
+    """`call_with_retries` for async callers: `call()` returns an awaitable."""
+    started = time.monotonic()
+    attempt = 1
+    while True:
+        try:
+            result = await call()
+        except Exception as e:
+            if not is_retryable(e):
+                await sync_to_async(breaker.release_trial)()
+                raise
+            delay = backoff_delay(attempt)
+            next_attempt_ends = time.monotonic() - started + delay + settings.AI_INFERENCE_TIMEOUT
+            if attempt >= settings.AI_RETRY_ATTEMPTS or next_attempt_ends > settings.AI_INFERENCE_BUDGET:
+                await sync_to_async(breaker.record_failure)()
+                raise
+            metrics.count_retry(model, e)
+            await asyncio.sleep(delay)
+            attempt += 1
+        else:
+            await sync_to_async(breaker.record_success)()
+            return result
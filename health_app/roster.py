@@ -0,0 +1,58 @@
+# health_app/roster.py
+"""
+Per-hospital cache of the doctor roster.
+
+The roster (id and full name of every doctor in a hospital) is read on every
+patient list render, every assignment and the admin dashboard, but changes only
+when a doctor joins, leaves or is renamed. It is kept in Django's cache framework
+and invalidated by the User signals in `signals.py`.
+
+Without a shared CACHES backend each process has its own copy and only the
+process that saved the user drops its entry; DOCTOR_ROSTER_CACHE_TIMEOUT bounds
+how long the other processes can serve a stale roster. That is fine for display,
+but an assignment must not trust it: `AssignDoctorView` re-checks the chosen doctor
+against the database before saving.
+"""
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import User
+
+
+class RosterEntry(NamedTuple):
+    id: int
+    full_name: str
+
+
+def roster_cache_key(hospital_id):
+    return f"health_app:doctor-roster:{hospital_id}"
+
+
+def get_doctor_roster(hospital_id):
+    """The hospital's doctors as RosterEntry tuples, ordered by name. Served from the cache when possible."""
+    key = roster_cache_key(hospital_id)
+    roster = cache.get(key)
+    if roster is None:
+        roster = [
+            RosterEntry(pk, f"{first_name} {last_name}".strip())
+            for pk, first_name, last_name in User.objects.filter(
+                hospital_id=hospital_id, role=User.Role.DOCTOR
+            ).order_by('first_name', 'last_name', 'pk').values_list('pk', 'first_name', 'last_name')
+        ]
+        cache.set(key, roster, settings.DOCTOR_ROSTER_CACHE_TIMEOUT)
+    return roster
+
+
+def find_doctor(hospital_id, doctor_id):
+    """The roster entry for doctor_id if that user is a doctor of this hospital, else None."""
+    try:
+        doctor_id = int(doctor_id)
+    except (TypeError, ValueError):
+        return None
+    return next((entry for entry in get_doctor_roster(hospital_id) if entry.id == doctor_id), None)
+
+
+def invalidate_doctor_roster(*hospital_ids):
+    cache.delete_many([roster_cache_key(hospital_id) for hospital_id in hospital_ids if hospital_id is not None])
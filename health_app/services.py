@@ -1,111 +1,443 @@
 # health_app/services.py
-import os
-from huggingface_hub import InferenceClient
-from .models import PatientRecord
+import logging
+import re
+import time
 
-# Load environment variables from .env file
-from dotenv import load_dotenv
-load_dotenv()
+from asgiref.sync import sync_to_async
+from django.conf import settings
 
-# Get the API key from environment variables
-api_key = os.getenv("HUGGING_FACE_API_KEY")
-if not api_key:
-    raise ValueError("HUGGING_FACE_API_KEY not found in environment variables.")
+from . import metrics
+from .inference import get_async_inference_client, get_inference_client
+from .instrumentation import timed, timed_aiter, timed_iter
+from .models import PatientRecord
+from .resilience import (
+    InferenceUnavailable, acall_with_retries, acheck_circuit, call_with_retries, check_circuit, is_retryable
+)
+from .report_cache import get_cached_report, store_report
+from .thresholds import (
+    MARKERS, evaluate_record, findings_for_prompt, present_markers, templated_normal_report, thresholds_for_prompt
+)
 
-# --- THIS IS THE CORRECTED PART ---
-# The token is passed during the client's initialization.
-client = InferenceClient(token=api_key)
-# --- END OF CORRECTION ---
+logger = logging.getLogger(__name__)
 
 # This is the model we will use. It's powerful and popular.
 MODEL_NAME = "MiniMaxAI/MiniMax-M2.7"
 
-def generate_risk_assessment_for_record(patient_record: PatientRecord) -> str:
-    """
-    Takes a PatientRecord model instance, sends its data to the Hugging Face API,
-    and returns the generated text report.
+# Bump this whenever the prompt text changes; it is part of the report cache key,
+# so reports generated from an older prompt are not reused.
+PROMPT_VERSION = 3
+
+# Every report starts with this heading; anything the model writes before it is dropped.
+REPORT_ANCHOR = "### Overall Risk Summary"
+
+# What a record gets instead of a report when the model call failed. Callers recognise it by its "Error:" prefix.
+ERROR_REPORT = "Error: Could not generate the AI assessment. Please try again later. Details: {error}"
+
+
+ROLE_AND_GOAL = """    **ROLE AND GOAL:**
+    You are an AI clinical decision support assistant. Your purpose is to analyze patient blood test results and provide a clear, concise risk assessment based ONLY on the provided thresholds. You must identify markers that are outside the normal range and explain the potential risks associated with them. Do not provide a medical diagnosis. The output must be in well-structured Markdown format."""
+
+REPORT_SECTIONS = """    ### Overall Risk Summary
+    (A brief, one-paragraph summary of the key findings and most significant risks based on the data.)
+
+    ### Markers of Concern
+    (A bulleted list. For EACH marker listed in the pre-computed findings, state its value, the threshold, and the specific NCDs/risks it indicates.)
+
+    ### Recommendations for Reviewer
+    (A bulleted list of general next steps a clinician might consider based on the findings. For example: 'Elevated glucose and HbA1c may warrant formal diabetes screening.' or 'High LDL and Total Cholesterol suggest a review of the patient's cardiovascular risk profile.')"""
+
+# Separates the patients of a batched prompt, and their reports in the response.
+BATCH_PATIENT_HEADER = "=== PATIENT {number} ==="
+BATCH_REPORT_HEADER = "=== REPORT {number} ==="
+BATCH_REPORT_PATTERN = re.compile(r"^\s*=== REPORT (\d+) ===\s*$", re.MULTILINE)
+
+
+def patient_data_for_prompt(patient_record: PatientRecord) -> str:
+    """One line per marker the record has a value for; absent markers are left out of the prompt."""
+    values = ((marker, getattr(patient_record, marker.field)) for marker in MARKERS)
+    return "\n    ".join(f"- {marker.name}: {value:g} {marker.unit}" for marker, value in values if value is not None)
+
+
+def max_tokens_for(evaluation) -> int:
     """
-    patient_data_string = f"""
-    - Glucose: {patient_record.glucose} mg/dL
-    - HbA1c: {patient_record.hba1c} %
-    - Total Cholesterol: {patient_record.total_cholesterol} mg/dL
-    - LDL: {patient_record.ldl} mg/dL
-    - HDL: {patient_record.hdl} mg/dL
-    - Triglycerides: {patient_record.triglycerides} mg/dL
-    - ALT: {patient_record.alt} U/L
-    - AST: {patient_record.ast} U/L
-    - Creatinine: {patient_record.creatinine} mg/dL
-    - Urea: {patient_record.urea} mg/dL
-    - CRP: {patient_record.crp} mg/L
-    - WBC: {patient_record.wbc} x10^9/L
+    The completion budget for one report: AI_MAX_TOKENS_BASE for the summary and
+    recommendations, plus AI_MAX_TOKENS_PER_FINDING per marker of concern, capped at
+    AI_MAX_TOKENS. A short panel doesn't reserve (or pay for) room it can't use.
     """
+    budget = settings.AI_MAX_TOKENS_BASE + settings.AI_MAX_TOKENS_PER_FINDING * len(evaluation.findings)
+    return min(budget, settings.AI_MAX_TOKENS)
 
+
+def report_prompt_version(patient_record: PatientRecord):
+    """The PROMPT_VERSION to store with the record's report; None for templated reports, which use no prompt."""
+    return None if evaluate_record(patient_record).risk_level == 0 else PROMPT_VERSION
+
+
+def build_prompt(patient_record: PatientRecord, evaluation) -> str:
+    """Builds the instruction prompt for one record and its pre-computed threshold evaluation."""
     prompt = f"""<s>[INST]
-    **ROLE AND GOAL:**
-    You are an AI clinical decision support assistant. Your purpose is to analyze patient blood test results and provide a clear, concise risk assessment based ONLY on the provided thresholds. You must identify markers that are outside the normal range and explain the potential risks associated with them. Do not provide a medical diagnosis. The output must be in well-structured Markdown format.
+{ROLE_AND_GOAL}
 
     **RISK THRESHOLDS (Strictly Adhere to These):**
-    - **Glucose:** High if >= 126 mg/dL (Indicates risk for Type 2 Diabetes, Metabolic Syndrome).
-    - **HbA1c:** Pre-diabetes if 5.7-6.4%, Diabetes if >= 6.5%.
-    - **Total Cholesterol:** High if > 200 mg/dL (Indicates risk for Cardiovascular Disease).
-    - **LDL:** High if > 130 mg/dL (Indicates risk for Heart disease, Stroke).
-    - **HDL:** Low (high risk) if < 40 mg/dL (Low HDL increases CVD risk).
-    - **Triglycerides:** High if > 150 mg/dL (Indicates risk for CVD, Pancreatitis).
-    - **ALT:** High if > 40 U/L (Indicates risk for Liver disease, Fatty liver, Cirrhosis).
-    - **AST:** High if > 35 U/L (Indicates risk for Liver disease, Fatty liver, Cirrhosis).
-    - **Creatinine:** High if > 1.3 mg/dL (Indicates risk for Kidney disease).
-    - **Urea:** High if > 50 mg/dL (Indicates risk for Kidney disease).
-    - **CRP:** High risk if > 3 mg/L (Indicates risk for Chronic inflammation, CVD, Cancer).
-    - **WBC:** High if > 11 x10^9/L (Indicates risk for Chronic infections, Inflammation, Cancer).
+    {thresholds_for_prompt(present_markers(evaluation))}
 
     **PATIENT DATA TO ANALYZE:**
-    {patient_data_string}
+    {patient_data_for_prompt(patient_record)}
+
+    **PRE-COMPUTED FINDINGS (already checked against the thresholds; use them as-is and do not re-evaluate):**
+    {findings_for_prompt(evaluation)}
 
     **REQUIRED OUTPUT FORMAT:**
     Generate a report with the following markdown sections exactly as specified:
 
-    ### Overall Risk Summary
-    (A brief, one-paragraph summary of the key findings and most significant risks based on the data.)
+{REPORT_SECTIONS}
+    [/INST]"""
+    return prompt
 
-    ### Markers of Concern
-    (A bulleted list. For EACH marker outside the normal range, state its value, the threshold, and the specific NCDs/risks it indicates. If all markers are normal, state "All markers are within the normal range.")
 
-    ### Recommendations for Reviewer
-    (A bulleted list of general next steps a clinician might consider based on the findings. For example: 'Elevated glucose and HbA1c may warrant formal diabetes screening.' or 'High LDL and Total Cholesterol suggest a review of the patient's cardiovascular risk profile.')
+def build_batch_prompt(records_and_evaluations) -> str:
+    """
+    Builds one prompt for several (record, evaluation) pairs. The role and thresholds are sent
+    once; each patient is numbered from 1, and the model is asked to head each report with
+    BATCH_REPORT_HEADER, so `split_batch_response` can take the response apart.
+    """
+    patients = "\n".join(
+        f"""
+    {BATCH_PATIENT_HEADER.format(number=number)}
+    **PATIENT DATA:**
+    {patient_data_for_prompt(record)}
+    **PRE-COMPUTED FINDINGS (already checked against the thresholds; use them as-is and do not re-evaluate):**
+    {findings_for_prompt(evaluation)}
+"""
+        for number, (record, evaluation) in enumerate(records_and_evaluations, start=1)
+    )
+    count = len(records_and_evaluations)
+    # The thresholds of every marker that at least one of the patients has.
+    markers = [m for m in MARKERS if any(m not in evaluation.missing for _, evaluation in records_and_evaluations)]
+    return f"""<s>[INST]
+{ROLE_AND_GOAL}
+    You will analyze {count} patients, each independently of the others.
+
+    **RISK THRESHOLDS (Strictly Adhere to These):**
+    {thresholds_for_prompt(markers)}
+
+    **PATIENTS TO ANALYZE:**
+{patients}
+    **REQUIRED OUTPUT FORMAT:**
+    Write one report per patient, in order, for all {count} patients. Start each report with a line containing only
+    "{BATCH_REPORT_HEADER.format(number='N')}", where N is the patient's number, followed by these markdown sections exactly as specified:
+
+{REPORT_SECTIONS}
     [/INST]"""
 
-    try:
-        # --- START OF NEW, MORE ROBUST CLEANING LOGIC ---
 
+def split_batch_response(raw_response: str, count: int) -> dict:
+    """
+    Splits a batched response into {patient number: raw report}. Reports that are missing,
+    repeated or lack the REPORT_ANCHOR are left out, so the caller can redo just those.
+    """
+    parts = BATCH_REPORT_PATTERN.split(raw_response)
+    # parts = [preamble, number, report, number, report, ...]
+    reports, seen = {}, set()
+    for number, report in zip(parts[1::2], parts[2::2]):
+        number = int(number)
+        if number in seen:
+            reports.pop(number, None)
+            continue
+        seen.add(number)
+        if 1 <= number <= count and REPORT_ANCHOR in report:
+            reports[number] = report
+    return reports
+
+
+def clean_report(raw_report: str) -> str:
+    """
+    Trims the model output down to the report itself: everything from the
+    "### Overall Risk Summary" anchor onwards, without stray code fences.
+    """
+    # 1. Define the known start of our real content.
+    anchor = REPORT_ANCHOR
+
+    # 2. Find the position of this anchor in the report.
+    anchor_position = raw_report.find(anchor)
+
+    if anchor_position != -1:
+        # 3. If the anchor is found, slice the string from that point.
+        cleaned_report = raw_report[anchor_position:]
+    else:
+        # 4. If, for some reason, the anchor is missing, use the raw report but strip it.
+        # This makes the function resilient to unexpected AI outputs.
+        cleaned_report = raw_report.strip()
+
+    # 5. Finally, remove any trailing backticks just in case.
+    return cleaned_report.replace("```", "").strip()
+
+
+def generate_risk_assessment_for_record(patient_record: PatientRecord) -> str:
+    """
+    Takes a PatientRecord model instance, sends its data to the configured inference
+    backend (see inference.py), and returns the generated text report.
+    Records with no abnormal markers get a templated report without calling the API.
+    The call is retried and guarded by the circuit breaker (see resilience.py); while the
+    circuit is open, this raises InferenceUnavailable instead of returning an error report.
+    """
+    # The markers are flagged deterministically first; the model only writes the narrative.
+    evaluation = evaluate_record(patient_record)
+    if evaluation.risk_level == 0:
+        return templated_normal_report(evaluation)
+
+    # Identical panels produce identical prompts; reuse the stored report if we have one.
+    cached_report = get_cached_report(patient_record, MODEL_NAME, PROMPT_VERSION)
+    if cached_report is not None:
+        return cached_report
+
+    prompt = build_prompt(patient_record, evaluation)
+
+    try:
         messages = [{"role": "user", "content": prompt}]
-        response = client.chat_completion(
-            messages=messages,
-            model=MODEL_NAME,
-            max_tokens=2048,
-        )
-        
+        breaker = check_circuit(MODEL_NAME)
+        started = time.perf_counter()
+        try:
+            with timed('inference'):
+                response = call_with_retries(lambda: get_inference_client().chat_completion(
+                    messages=messages,
+                    model=MODEL_NAME,
+                    max_tokens=max_tokens_for(evaluation),
+                ), MODEL_NAME, breaker)
+        finally:
+            metrics.observe_inference(MODEL_NAME, 'complete', time.perf_counter() - started)
+        metrics.count_tokens(MODEL_NAME, getattr(response, 'usage', None))
+
         raw_report = response.choices[0].message.content
+        metrics.count_response(MODEL_NAME, REPORT_ANCHOR in raw_report)
+        metrics.count_finish_reason(MODEL_NAME, response.choices[0].finish_reason)
+        final_report = clean_report(raw_report)
+        store_report(patient_record, MODEL_NAME, PROMPT_VERSION, final_report)
+        return final_report
+    except InferenceUnavailable:
+        raise
+    except Exception as e:
+        metrics.count_error(MODEL_NAME, e)
+        logger.exception("Error calling the inference API")
+        return ERROR_REPORT.format(error=e)
 
-        # 1. Define the known start of our real content.
-        anchor = "### Overall Risk Summary"
-        
-        # 2. Find the position of this anchor in the report.
-        anchor_position = raw_report.find(anchor)
-        
-        if anchor_position != -1:
-            # 3. If the anchor is found, slice the string from that point.
-            cleaned_report = raw_report[anchor_position:]
-        else:
-            # 4. If, for some reason, the anchor is missing, use the raw report but strip it.
-            # This makes the function resilient to unexpected AI outputs.
-            cleaned_report = raw_report.strip()
-
-        # 5. Finally, remove any trailing backticks just in case.
-        final_report = cleaned_report.replace("```", "").strip()
 
-        return final_report
+def generate_risk_assessments_for_records(patient_records, batch_size=None) -> dict:
+    """
+    Batched variant of `generate_risk_assessment_for_record`: returns {record pk: report}.
+
+    Templated and cached reports are filled in first. The remaining records are sent
+    `batch_size` at a time (default AI_BATCH_PROMPT_SIZE) in one prompt each (see
+    `build_batch_prompt`), so the role, thresholds and output format are paid for once
+    per batch instead of once per record. Reports that can't be told apart in the
+    response, and every record of a batch the provider rejected, are generated one by one.
+    A batch that still failed after its retries gets error reports instead: a call per
+    record would only multiply the load on a provider that is having trouble.
+    Raises InferenceUnavailable while the circuit breaker is open.
+    """
+    batch_size = batch_size or settings.AI_BATCH_PROMPT_SIZE
+    reports, pending = {}, []
+    for record in patient_records:
+        evaluation = evaluate_record(record)
+        if evaluation.risk_level == 0:
+            reports[record.pk] = templated_normal_report(evaluation)
+            continue
+        cached_report = get_cached_report(record, MODEL_NAME, PROMPT_VERSION)
+        if cached_report is not None:
+            reports[record.pk] = cached_report
+            continue
+        pending.append((record, evaluation))
+
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        if len(batch) == 1:
+            record, _ = batch[0]
+            reports[record.pk] = generate_risk_assessment_for_record(record)
+            continue
+
+        try:
+            parsed = _generate_batch(batch)
+        except InferenceUnavailable:
+            raise
+        except Exception as e:
+            for record, _ in batch:
+                reports[record.pk] = ERROR_REPORT.format(error=e)
+            continue
+        for number, (record, _) in enumerate(batch, start=1):
+            if number in parsed:
+                reports[record.pk] = parsed[number]
+            else:
+                reports[record.pk] = generate_risk_assessment_for_record(record)
+        metrics.count_batch_reports(MODEL_NAME, parsed=len(parsed), fallback=len(batch) - len(parsed))
+    return reports
 
-        # --- END OF NEW, MORE ROBUST CLEANING LOGIC ---
+
+def _generate_batch(batch) -> dict:
+    """
+    One model call for a batch of (record, evaluation) pairs; returns {patient number: cleaned report}.
+    Errors the provider may get over (see resilience.is_retryable) are raised; after others
+    it returns no reports, so the records are generated one by one.
+    """
+    prompt = build_batch_prompt(batch)
+    try:
+        messages = [{"role": "user", "content": prompt}]
+        breaker = check_circuit(MODEL_NAME)
+        started = time.perf_counter()
+        try:
+            with timed('inference'):
+                response = call_with_retries(lambda: get_inference_client().chat_completion(
+                    messages=messages,
+                    model=MODEL_NAME,
+                    # The same room per report as single calls, plus the report headers.
+                    max_tokens=min(sum(max_tokens_for(evaluation) + 16 for _, evaluation in batch), settings.AI_BATCH_MAX_TOKENS),
+                ), MODEL_NAME, breaker)
+        finally:
+            metrics.observe_inference(MODEL_NAME, 'batch', time.perf_counter() - started)
+        metrics.count_tokens(MODEL_NAME, getattr(response, 'usage', None))
+        metrics.count_finish_reason(MODEL_NAME, response.choices[0].finish_reason)
+    except InferenceUnavailable:
+        raise
     except Exception as e:
-        print(f"Error calling Hugging Face API: {e}")
-        return f"Error: Could not generate AI assessment with Hugging Face. Please try again later. Details: {e}"
\ No newline at end of file
+        metrics.count_error(MODEL_NAME, e)
+        logger.exception("Error calling the inference API for a batch of %d records", len(batch))
+        if is_retryable(e):
+            raise
+        # E.g. a request the provider rejected; the records are retried one by one.
+        return {}
+
+    parsed = {}
+    for number, raw_report in split_batch_response(response.choices[0].message.content, len(batch)).items():
+        record, _ = batch[number - 1]
+        metrics.count_response(MODEL_NAME, True)
+        parsed[number] = clean_report(raw_report)
+        store_report(record, MODEL_NAME, PROMPT_VERSION, parsed[number])
+    return parsed
+
+
+def stream_risk_assessment_for_record(patient_record: PatientRecord):
+    """
+    Streaming variant of `generate_risk_assessment_for_record`.
+
+    Yields ("delta", text) events as the model produces tokens, then exactly one
+    ("done", final_report) event with the cleaned report, or ("error", message).
+    Templated and cached reports are yielded as a single delta.
+    Raises InferenceUnavailable, before yielding anything, while the circuit breaker is open.
+    """
+    ready_report, request = _prepare_stream(patient_record)
+    if ready_report is not None:
+        yield "delta", ready_report
+        yield "done", ready_report
+        return
+
+    try:
+        breaker = check_circuit(MODEL_NAME)
+        started = time.perf_counter()
+        # Only opening the stream is retried; once tokens have been sent, a retry would repeat them.
+        with timed('inference'):
+            stream = call_with_retries(lambda: get_inference_client().chat_completion(**request), MODEL_NAME, breaker)
+
+        raw_parts = []
+        try:
+            for chunk in timed_iter(stream, 'inference'):
+                if text := _chunk_text(chunk):
+                    raw_parts.append(text)
+                    yield "delta", text
+        except Exception as e:
+            if is_retryable(e):
+                breaker.record_failure()  # The connection broke mid-stream
+            raise
+        finally:
+            # Includes the time the client took to read each delta.
+            metrics.observe_inference(MODEL_NAME, 'stream', time.perf_counter() - started)
+
+        yield "done", _finish_stream(patient_record, raw_parts)
+    except InferenceUnavailable:
+        raise
+    except Exception as e:
+        yield "error", _stream_error(e)
+
+
+async def astream_risk_assessment_for_record(patient_record: PatientRecord):
+    """
+    `stream_risk_assessment_for_record` for async views: the same events, from an async
+    generator. The model is called with the async client (see inference.py), so waiting
+    for tokens holds no thread; the report cache and the circuit breaker are reached
+    from a thread.
+    """
+    ready_report, request = await sync_to_async(_prepare_stream)(patient_record)
+    if ready_report is not None:
+        yield "delta", ready_report
+        yield "done", ready_report
+        return
+
+    try:
+        breaker = await acheck_circuit(MODEL_NAME)
+        started = time.perf_counter()
+        with timed('inference'):
+            stream = await acall_with_retries(lambda: get_async_inference_client().chat_completion(**request), MODEL_NAME, breaker)
+
+        raw_parts = []
+        try:
+            async for chunk in timed_aiter(stream, 'inference'):
+                if text := _chunk_text(chunk):
+                    raw_parts.append(text)
+                    yield "delta", text
+        except Exception as e:
+            if is_retryable(e):
+                await sync_to_async(breaker.record_failure)()
+            raise
+        finally:
+            metrics.observe_inference(MODEL_NAME, 'stream', time.perf_counter() - started)
+
+        yield "done", await sync_to_async(_finish_stream)(patient_record, raw_parts)
+    except InferenceUnavailable:
+        raise
+    except Exception as e:
+        yield "error", _stream_error(e)
+
+
+# The steps the sync and async streams share; only their transport loops differ.
+
+def _prepare_stream(patient_record):
+    """
+    Returns (report, None) when the record's report is templated or cached, and
+    (None, the chat_completion arguments) when the model has to write it.
+    """
+    evaluation = evaluate_record(patient_record)
+    if evaluation.risk_level == 0:
+        return templated_normal_report(evaluation), None
+    cached_report = get_cached_report(patient_record, MODEL_NAME, PROMPT_VERSION)
+    if cached_report is not None:
+        return cached_report, None
+    return None, {
+        'messages': [{"role": "user", "content": build_prompt(patient_record, evaluation)}],
+        'model': MODEL_NAME,
+        'max_tokens': max_tokens_for(evaluation),
+        'stream': True,
+    }
+
+
+def _chunk_text(chunk) -> str:
+    """Records a streamed chunk's metrics and returns its text ("" if it has none)."""
+    # Providers that report usage for streams send it with the last chunk.
+    metrics.count_tokens(MODEL_NAME, getattr(chunk, 'usage', None))
+    if not chunk.choices:
+        return ""
+    metrics.count_finish_reason(MODEL_NAME, chunk.choices[0].finish_reason)
+    return chunk.choices[0].delta.content or ""
+
+
+def _finish_stream(patient_record, raw_parts) -> str:
+    """Cleans and caches the streamed report; returns it."""
+    raw_report = "".join(raw_parts)
+    metrics.count_response(MODEL_NAME, REPORT_ANCHOR in raw_report)
+    final_report = clean_report(raw_report)
+    store_report(patient_record, MODEL_NAME, PROMPT_VERSION, final_report)
+    return final_report
+
+
+def _stream_error(error) -> str:
+    """Records a failed stream (call it from the `except` block) and returns the error message to send."""
+    metrics.count_error(MODEL_NAME, error)
+    logger.exception("Error calling the inference API")
+    return ERROR_REPORT.format(error=error)
@@ -0,0 +1,86 @@
+# health_app/signals.py
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import analytics
+from .models import PatientRecord, RiskAssessment, User
+from .roster import invalidate_doctor_roster
+
+# The User fields that appear in (or decide membership of) the doctor roster.
+ROSTER_FIELDS = {'hospital', 'hospital_id', 'role', 'first_name', 'last_name'}
+
+
+def _affects_roster(update_fields):
+    # e.g. the last_login update on every login does not touch the roster.
+    return update_fields is None or bool(ROSTER_FIELDS & set(update_fields))
+
+
+@receiver(pre_save, sender=User)
+def remember_previous_hospital(sender, instance, update_fields=None, **kwargs):
+    """A user moved to another hospital must also disappear from the old hospital's roster."""
+    instance._previous_hospital_id = None
+    if instance.pk and _affects_roster(update_fields):
+        instance._previous_hospital_id = User.objects.filter(pk=instance.pk).values_list('hospital_id', flat=True).first()
+
+
+# Rosters are dropped once the change is committed: dropped earlier, a concurrent request
+# could cache the old roster again before the change is visible to it.
+
+@receiver(post_save, sender=User)
+def invalidate_roster_on_save(sender, instance, update_fields=None, **kwargs):
+    if _affects_roster(update_fields):
+        hospital_ids = (instance.hospital_id, getattr(instance, '_previous_hospital_id', None))
+        transaction.on_commit(lambda: invalidate_doctor_roster(*hospital_ids))
+
+
+@receiver(post_delete, sender=User)
+def invalidate_roster_on_delete(sender, instance, **kwargs):
+    hospital_id = instance.hospital_id
+    transaction.on_commit(lambda: invalidate_doctor_roster(hospital_id))
+
+
+# --- Analytics summary (see analytics.py) ---
+
+def _affects_analytics(update_fields, fields):
+    # e.g. saving only the rendered report HTML or the assigned doctor changes no aggregate.
+    return update_fields is None or bool(set(fields) & set(update_fields))
+
+
+ANALYTICS_RECORD_FIELDS = set(analytics.MARKER_FIELDS)
+ANALYTICS_ASSESSMENT_FIELDS = {'status', 'reviewed_by', 'reviewed_by_id', 'reviewed_at', 'created_at'}
+
+
+@receiver(pre_save, sender=PatientRecord)
+@receiver(pre_save, sender=RiskAssessment)
+def remember_analytics_state(sender, instance, update_fields=None, **kwargs):
+    fields = ANALYTICS_RECORD_FIELDS if sender is PatientRecord else ANALYTICS_ASSESSMENT_FIELDS
+    if not instance._state.adding and _affects_analytics(update_fields, fields):
+        analytics.load_previous_state(instance)
+
+
+@receiver(post_save, sender=PatientRecord)
+def update_analytics_on_record_save(sender, instance, created, update_fields=None, **kwargs):
+    if _affects_analytics(update_fields, ANALYTICS_RECORD_FIELDS):
+        analytics.record_saved(instance, created)
+
+
+@receiver(pre_delete, sender=PatientRecord)
+def remember_deleted_record_hospital(sender, instance, **kwargs):
+    analytics.record_deleting(instance)
+
+
+@receiver(post_delete, sender=PatientRecord)
+def update_analytics_on_record_delete(sender, instance, **kwargs):
+    analytics.record_deleted(instance)
+
+
+@receiver(post_save, sender=RiskAssessment)
+def update_analytics_on_assessment_save(sender, instance, created, update_fields=None, **kwargs):
+    if _affects_analytics(update_fields, ANALYTICS_ASSESSMENT_FIELDS):
+        analytics.assessment_saved(instance, created)
+
+
+@receiver(post_delete, sender=RiskAssessment)
+def update_analytics_on_assessment_delete(sender, instance, **kwargs):
+    analytics.assessment_deleted(instance)
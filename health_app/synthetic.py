@@ -0,0 +1,155 @@
+# health_app/synthetic.py
+"""
+Synthetic hospitals for load tests and benchmarks.
+
+`seed_hospitals` bulk-generates hospitals, each with an admin, doctors, patient
+records and assessments (pending, assigned and reviewed), with the same row
+shapes the application writes itself. Everything it creates is recognizable by
+the SYNTHETIC_PREFIX hospital name, so `delete_synthetic_data` can remove it again.
+
+Marker values are drawn around each marker's first threshold, so roughly a third of
+the values are abnormal and about one panel in ten is all-normal, like a screening cohort.
+All users share SYNTHETIC_PASSWORD, hashed once, so seeding doesn't spend its time in PBKDF2.
+"""
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+
+from . import analytics
+from .models import Hospital, PatientRecord, RiskAssessment, User
+from .roster import invalidate_doctor_roster
+from .thresholds import MARKERS, evaluate_record, risk_flags, templated_normal_report
+
+SYNTHETIC_PREFIX = "Synthetic Hospital"
+SYNTHETIC_PASSWORD = "synthetic-password"
+BATCH_SIZE = 2000
+
+
+def synthetic_hospitals():
+    return Hospital.objects.filter(name__startswith=SYNTHETIC_PREFIX)
+
+
+def admin_username(hospital_number):
+    return f"synthetic-admin-{hospital_number}@example.com"
+
+
+def doctor_username(hospital_number, doctor_number):
+    return f"synthetic-doctor-{hospital_number}-{doctor_number}@example.com"
+
+
+def synthetic_markers(rng):
+    """One panel of marker values, drawn around each marker's first threshold; about 1 in 10 values is missing."""
+    markers = {}
+    for marker in MARKERS:
+        if rng.random() < 0.1:
+            markers[marker.field] = None
+            continue
+        threshold = marker.rules[0].threshold
+        markers[marker.field] = round(max(0.0, rng.gauss(threshold * 0.85, threshold * 0.3)), 2)
+    return markers
+
+
+def unsaved_records(count, seed=0):
+    """`count` synthetic records that are never saved, for offline benchmarks; pks are set so they can be told apart."""
+    rng = random.Random(seed)
+    return [PatientRecord(pk=i, patient_identifier=f"BENCH-{i:07}", **synthetic_markers(rng)) for i in range(1, count + 1)]
+
+
+def synthetic_report(record):
+    """A report shaped like the model's, without calling it; all-normal panels get the templated report."""
+    evaluation = evaluate_record(record)
+    if evaluation.risk_level == 0:
+        return templated_normal_report(evaluation)
+    concerns = "\n".join(
+        f"- {f.marker.name}: {f.value:g} {f.marker.unit} ({f.rule.label}; risk for {f.marker.risks})"
+        for f in evaluation.findings
+    )
+    return (
+        "### Overall Risk Summary\n"
+        f"Synthetic report: {len(evaluation.findings)} marker(s) outside the normal range.\n\n"
+        "### Markers of Concern\n"
+        f"{concerns}\n\n"
+        "### Recommendations for Reviewer\n"
+        "- Synthetic data; no recommendation."
+    )
+
+
+def seed_hospitals(hospitals=1, doctors=10, records=10_000, assessed=0.8, reviewed=0.35, assigned=0.3, seed=42, log=None):
+    """
+    Creates `hospitals` synthetic hospitals with `doctors` doctors and `records` patient records each.
+    A fraction `assessed` of the records get an assessment; of those, `reviewed` are reviewed and
+    `assigned` of the pending ones are assigned to a doctor. Returns the new hospitals.
+    """
+    rng = random.Random(seed)
+    password = make_password(SYNTHETIC_PASSWORD)
+    first_number = synthetic_hospitals().count() + 1
+    created = []
+
+    for number in range(first_number, first_number + hospitals):
+        with transaction.atomic():
+            hospital = Hospital.objects.create(name=f"{SYNTHETIC_PREFIX} {number}")
+            User.objects.bulk_create(
+                [User(username=admin_username(number), email=admin_username(number), first_name="Synthetic",
+                      last_name=f"Admin {number}", role=User.Role.HOSPITAL_ADMIN, hospital=hospital, password=password)]
+                + [User(username=doctor_username(number, i), email=doctor_username(number, i), first_name="Synthetic",
+                        last_name=f"Doctor {i}", role=User.Role.DOCTOR, hospital=hospital, password=password)
+                   for i in range(doctors)]
+            )
+        doctor_ids = list(User.objects.filter(hospital=hospital, role=User.Role.DOCTOR).values_list('pk', flat=True))
+
+        for start in range(0, records, BATCH_SIZE):
+            batch = [
+                PatientRecord(hospital=hospital, patient_identifier=f"SYN{number:03}-{i:07}", **synthetic_markers(rng))
+                for i in range(start, min(start + BATCH_SIZE, records))
+            ]
+            for record in batch:
+                record.risk_flags = risk_flags(record)  # bulk_create skips PatientRecord.save()
+
+            assessments = []
+            now = timezone.now()
+            for record in batch:
+                if rng.random() >= assessed:
+                    continue
+                # Reports generated over the last 60 days; reviews up to two days later.
+                generated_at = now - timedelta(minutes=rng.randrange(60 * 24 * 60))
+                is_reviewed = rng.random() < reviewed
+                assessment = RiskAssessment(
+                    patient_record=record, ai_generated_report=synthetic_report(record), created_at=generated_at,
+                    status=RiskAssessment.Status.REVIEWED if is_reviewed else RiskAssessment.Status.PENDING_REVIEW,
+                )
+                if is_reviewed and doctor_ids:
+                    assessment.reviewed_by_id = rng.choice(doctor_ids)
+                    assessment.reviewed_at = min(now, generated_at + timedelta(minutes=rng.randrange(60 * 48)))
+                    assessment.doctor_comments = "Reviewed (synthetic)."
+                elif doctor_ids and rng.random() < assigned:
+                    assessment.assigned_doctor_id = rng.choice(doctor_ids)
+                assessment.render_html()  # bulk_create skips save(), which would render it
+                assessments.append(assessment)
+
+            with transaction.atomic():
+                PatientRecord.objects.bulk_create(batch)
+                RiskAssessment.objects.bulk_create(assessments)
+            if log:
+                log(f"{hospital.name}: {min(start + BATCH_SIZE, records)}/{records} records")
+
+        analytics.rebuild([hospital.pk])
+        created.append(hospital)
+
+    invalidate_doctor_roster(*(hospital.pk for hospital in created))
+    return created
+
+
+def delete_synthetic_data():
+    """Deletes every synthetic hospital with its users, records and assessments. Returns the number of hospitals."""
+    hospitals = list(synthetic_hospitals())
+    hospital_ids = [hospital.pk for hospital in hospitals]
+    # One batch, so the cascade doesn't update the analytics summary once per record.
+    with analytics.batch():
+        User.objects.filter(hospital__in=hospitals).delete()
+        for hospital in hospitals:
+            hospital.delete()
+    invalidate_doctor_roster(*hospital_ids)
+    return len(hospital_ids)
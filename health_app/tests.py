@@ -1,3 +1,1428 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import logging
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from http.server import ThreadingHTTPServer
+from django.db import IntegrityError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+
+from . import analytics, metrics, report_cache, resilience, views
+from .csv_import import PatientCSVImporter
+from .exports import decode_cursor
+from .inference import StubInferenceClient, check_inference_backend, get_async_inference_client, get_inference_client
+from .synthetic import SYNTHETIC_PREFIX, seed_hospitals
+from .jobs import analyze_records_concurrently, enqueue_analysis, assess_normal_records, run_pending_jobs, run_pending_uploads
+from .models import (
+    AnalysisJob, BacklogDaily, Hospital, MarkerBucket, PatientRecord, ReportCacheEntry, ReviewDaily, RiskAssessment,
+    UploadJob, User
+)
+from .rendering import REPORT_RENDERER_VERSION
+from .roster import RosterEntry, get_doctor_roster
+from .management.commands.serve_inference_stub import make_handler
+from .services import (
+    PROMPT_VERSION, astream_risk_assessment_for_record, generate_risk_assessment_for_record,
+    generate_risk_assessments_for_records, max_tokens_for, stream_risk_assessment_for_record
+)
+from .thresholds import MARKER_FIELDS, annotate_risk, evaluate_record, marker_bit, risk_flags, templated_normal_report
+
+# Keep the per-request timing lines out of the test output; tests that check them use assertLogs.
+logging.getLogger('health_app.performance').setLevel(logging.WARNING)
+
+
+# For tests that run worker threads; see BulkAnalysisTests.
+IN_MEMORY_CACHES = {
+    **settings.CACHES,
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'health-app-shared'},
+}
+
+
+class HospitalTestMixin:
+    """Creates a hospital with an admin and a doctor, and logs the admin in."""
+
+    def setUp(self):
+        # Cached rosters are keyed by hospital id, which the test database reuses between tests.
+        cache.clear()
+        # The inference circuit breaker lives in the shared cache; clearing it closes the circuit.
+        caches['shared'].clear()
+        # Never call a real provider, whatever AI_INFERENCE_BACKEND the shell running the tests has set.
+        # Simulated provider failures are retried without waiting out a real backoff.
+        self.enterContext(override_settings(AI_INFERENCE_BACKEND="stub", AI_RETRY_BASE_DELAY=0))
+        self.hospital = Hospital.objects.create(name="General Hospital")
+        self.admin = User.objects.create_user(
+            username="admin@hospital.com", email="admin@hospital.com",
+            first_name="Ada", last_name="Admin",
+            role=User.Role.HOSPITAL_ADMIN, hospital=self.hospital,
+        )
+        self.doctor = User.objects.create_user(
+            username="doctor@hospital.com", email="doctor@hospital.com",
+            first_name="Dan", last_name="Doctor",
+            role=User.Role.DOCTOR, hospital=self.hospital,
+        )
+        self.client.force_login(self.admin)
+
+    def make_record(self, identifier="P001", **markers):
+        # Default to one abnormal marker so the record needs the LLM (all-normal panels are templated).
+        markers = markers or {'glucose': 140}
+        return PatientRecord.objects.create(
+            patient_identifier=identifier, hospital=self.hospital, uploaded_by=self.admin, **markers
+        )
+
+
+class AnalysisJobQueueTests(HospitalTestMixin, TestCase):
+    def test_analyze_view_queues_job_without_calling_the_model(self):
+        record = self.make_record(glucose=140)
+        response = self.client.post(reverse('analyze_record', kwargs={'pk': record.pk}))
+
+        self.assertRedirects(response, reverse('admin_dashboard'), fetch_redirect_response=False)
+        job = AnalysisJob.objects.get(patient_record=record)
+        self.assertEqual(job.status, AnalysisJob.Status.QUEUED)
+        self.assertFalse(RiskAssessment.objects.filter(patient_record=record).exists())
+
+    def test_analyze_view_does_not_queue_twice(self):
+        record = self.make_record()
+        url = reverse('analyze_record', kwargs={'pk': record.pk})
+        self.client.post(url)
+        self.client.post(url)
+        self.assertEqual(AnalysisJob.objects.filter(patient_record=record).count(), 1)
+
+    def test_concurrent_requests_queue_one_job(self):
+        record = self.make_record()
+        job = AnalysisJob.objects.create(patient_record=record)
+        # As if this request checked for an active job just before the other request created it.
+        with mock.patch.object(AnalysisJob.objects, 'filter', side_effect=[AnalysisJob.objects.none(), AnalysisJob.objects.filter(pk=job.pk)]):
+            self.assertEqual(enqueue_analysis(record), job)
+        self.assertEqual(AnalysisJob.objects.filter(patient_record=record).count(), 1)
+
+        # Finished jobs don't count: the record can be queued again.
+        AnalysisJob.objects.filter(pk=job.pk).update(status=AnalysisJob.Status.FAILED)
+        self.assertNotEqual(enqueue_analysis(record), job)
+
+    def test_worker_runs_job_with_stub_backend(self):
+        record = self.make_record(glucose=140)
+        self.client.post(reverse('analyze_record', kwargs={'pk': record.pk}))
+
+        self.assertEqual(run_pending_jobs(), 1)
+
+        job = AnalysisJob.objects.get(patient_record=record)
+        self.assertEqual(job.status, AnalysisJob.Status.DONE)
+        self.assertEqual(job.attempts, 1)
+        report = RiskAssessment.objects.get(patient_record=record).ai_generated_report
+        self.assertTrue(report.startswith("### Overall Risk Summary"))
+        self.assertNotIn("```", report)
+
+    def test_status_endpoint_reports_each_state(self):
+        record = self.make_record()
+        self.client.post(reverse('analyze_record', kwargs={'pk': record.pk}))
+        job = AnalysisJob.objects.get(patient_record=record)
+        url = reverse('analysis_job_status', kwargs={'pk': job.pk})
+
+        self.assertEqual(self.client.get(url).json()['status'], 'queued')
+
+        run_pending_jobs()
+        data = self.client.get(url).json()
+        self.assertEqual(data['status'], 'done')
+        self.assertEqual(data['assessment_id'], record.assessment.pk)
+
+    def test_failed_inference_marks_job_failed(self):
+        record = self.make_record()
+        job = AnalysisJob.objects.create(patient_record=record)
+
+        with mock.patch("health_app.inference.StubInferenceClient.chat_completion", side_effect=ConnectionError("provider unavailable")):
+            run_pending_jobs()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.Status.FAILED)
+        self.assertTrue(job.error.startswith("Error:"))
+        data = self.client.get(reverse('analysis_job_status', kwargs={'pk': job.pk})).json()
+        self.assertEqual(data['status'], 'failed')
+
+    def test_status_endpoint_hides_other_hospitals_jobs(self):
+        other = Hospital.objects.create(name="Other Hospital")
+        record = PatientRecord.objects.create(patient_identifier="X1", hospital=other)
+        job = AnalysisJob.objects.create(patient_record=record)
+        response = self.client.get(reverse('analysis_job_status', kwargs={'pk': job.pk}))
+        self.assertEqual(response.status_code, 403)
+
+
+
+# The report cache is disabled and the circuit breaker kept in memory here: worker threads
+# get their own connections, which cannot see (or write around) the uncommitted test
+# transaction on SQLite.
+@override_settings(AI_REPORT_CACHE_ENABLED=False, CACHES=IN_MEMORY_CACHES)
+class BulkAnalysisTests(HospitalTestMixin, TestCase):
+    def test_analyze_all_pending_queues_only_unanalyzed_records(self):
+        analyzed = self.make_record("P001")
+        RiskAssessment.objects.create(patient_record=analyzed, ai_generated_report="### Overall Risk Summary")
+        for i in range(2, 6):
+            self.make_record(f"P00{i}")
+
+        self.client.post(reverse('bulk_analyze'), {'scope': 'all_pending'})
+
+        self.assertEqual(AnalysisJob.objects.count(), 4)
+        self.assertFalse(AnalysisJob.objects.filter(patient_record=analyzed).exists())
+
+    def test_analyze_selected_ignores_other_hospitals(self):
+        mine = self.make_record("P001")
+        self.make_record("P002")
+        other = PatientRecord.objects.create(patient_identifier="X1", hospital=Hospital.objects.create(name="Other"))
+
+        self.client.post(reverse('bulk_analyze'), {'record_ids': [mine.pk, other.pk]})
+
+        self.assertEqual(list(AnalysisJob.objects.values_list('patient_record_id', flat=True)), [mine.pk])
+
+    def test_concurrent_worker_writes_all_reports(self):
+        for i in range(10):
+            self.make_record(f"P{i:03}")
+        self.client.post(reverse('bulk_analyze'), {'scope': 'all_pending'})
+
+        self.assertEqual(run_pending_jobs(concurrency=4), 10)
+
+        self.assertEqual(RiskAssessment.objects.count(), 10)
+        self.assertFalse(AnalysisJob.objects.exclude(status=AnalysisJob.Status.DONE).exists())
+
+    def test_wall_clock_scales_with_concurrency(self):
+        records = [self.make_record(f"P{i:03}") for i in range(8)]
+        real_chat_completion = StubInferenceClient().chat_completion
+
+        def slow_chat_completion(*args, **kwargs):
+            time.sleep(0.2)
+            return real_chat_completion(*args, **kwargs)
+
+        with mock.patch("health_app.inference.StubInferenceClient.chat_completion", side_effect=slow_chat_completion):
+            started = time.monotonic()
+            errors = analyze_records_concurrently(records, max_workers=8, batch_size=3)
+            elapsed = time.monotonic() - started
+
+        self.assertEqual(errors, {record.pk: None for record in records})
+        self.assertEqual(RiskAssessment.objects.count(), 8)
+        # Eight 200ms calls run serially would take 1.6s.
+        self.assertLess(elapsed, 1.0)
+
+
+class ThresholdEngineTests(HospitalTestMixin, TestCase):
+    NORMAL_PANEL = {
+        'glucose': 90, 'hba1c': 5.2, 'total_cholesterol': 180, 'ldl': 100, 'hdl': 55, 'triglycerides': 120,
+        'alt': 25, 'ast': 20, 'creatinine': 0.9, 'urea': 30, 'crp': 1, 'wbc': 7,
+    }
+
+    def test_evaluate_record_flags_and_levels(self):
+        record = self.make_record(**{**self.NORMAL_PANEL, 'hba1c': 6.0, 'hdl': 35, 'crp': None})
+        evaluation = evaluate_record(record)
+
+        self.assertEqual({f.marker.field: f.rule.label for f in evaluation.findings}, {'hba1c': 'Pre-diabetes', 'hdl': 'Low'})
+        self.assertEqual([m.field for m in evaluation.missing], ['crp'])
+        self.assertEqual(evaluation.risk_level, 3)
+
+    def test_boundaries_follow_the_thresholds(self):
+        self.assertEqual(evaluate_record(self.make_record("A", glucose=126)).risk_level, 2)
+        self.assertEqual(evaluate_record(self.make_record("B", glucose=125.9)).risk_level, 0)
+        self.assertEqual(evaluate_record(self.make_record("C", ldl=130)).risk_level, 0)
+        self.assertEqual(evaluate_record(self.make_record("D", hba1c=6.5)).risk_level, 2)
+
+    def test_annotate_risk_matches_python_evaluation(self):
+        self.make_record("P1", **self.NORMAL_PANEL)
+        self.make_record("P2", **{**self.NORMAL_PANEL, 'glucose': 200, 'hba1c': 5.8})
+        self.make_record("P3", alt=80, wbc=None)
+
+        with self.assertNumQueries(1):
+            scored = list(annotate_risk(PatientRecord.objects.filter(hospital=self.hospital)))
+
+        for record in scored:
+            self.assertEqual(record.risk_level, evaluate_record(record).risk_level)
+        by_id = {r.patient_identifier: r for r in scored}
+        self.assertEqual((by_id["P2"].flag_glucose, by_id["P2"].flag_hba1c, by_id["P2"].flag_ldl), (2, 1, 0))
+
+    def test_all_normal_record_is_reported_without_llm_or_queue(self):
+        record = self.make_record(**self.NORMAL_PANEL)
+
+        with mock.patch("health_app.inference.StubInferenceClient.chat_completion") as chat_completion:
+            self.client.post(reverse('analyze_record', kwargs={'pk': record.pk}))
+
+        chat_completion.assert_not_called()
+        self.assertFalse(AnalysisJob.objects.exists())
+        report = RiskAssessment.objects.get(patient_record=record).ai_generated_report
+        self.assertIn("All markers are within the normal range.", report)
+
+    def test_bulk_analysis_reports_normal_records_and_queues_the_rest(self):
+        self.make_record("P1", **self.NORMAL_PANEL)
+        abnormal = self.make_record("P2", glucose=150)
+
+        self.client.post(reverse('bulk_analyze'), {'scope': 'all_pending'})
+
+        self.assertEqual(RiskAssessment.objects.count(), 1)
+        self.assertEqual(list(AnalysisJob.objects.values_list('patient_record_id', flat=True)), [abnormal.pk])
+
+    def test_prompt_contains_precomputed_findings(self):
+        record = self.make_record(**{**self.NORMAL_PANEL, 'ldl': 160})
+
+        with mock.patch("health_app.inference.StubInferenceClient.chat_completion", wraps=StubInferenceClient().chat_completion) as chat_completion:
+            generate_risk_assessment_for_record(record)
+
+        prompt = chat_completion.call_args.kwargs['messages'][0]['content']
+        self.assertIn("- LDL: 160 mg/dL - HIGH (threshold > 130 mg/dL", prompt)
+        self.assertIn("- **Glucose:** High if >= 126 mg/dL", prompt)
+
+
+@override_settings(AI_REPORT_CACHE_ENABLED=True)
+class ReportCacheTests(HospitalTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        report_cache.stats.reset()
+
+    def test_identical_panels_reuse_the_report(self):
+        first = self.make_record("P001", glucose=150, ldl=140)
+        second = self.make_record("P002", glucose=150.0, ldl=140)
+
+        with mock.patch("health_app.inference.StubInferenceClient.chat_completion", wraps=StubInferenceClient().chat_completion) as chat_completion:
+            first_report = generate_risk_assessment_for_record(first)
+            second_report = generate_risk_assessment_for_record(second)
+
+        self.assertEqual(chat_completion.call_count, 1)
+        self.assertEqual(first_report, second_report)
+        self.assertEqual((report_cache.stats.hits, report_cache.stats.misses), (1, 1))
+        self.assertEqual(ReportCacheEntry.objects.get().hit_count, 1)
+
+    def test_key_depends_on_markers_model_and_prompt_version(self):
+        record = self.make_record(glucose=150)
+        key = report_cache.cache_key(record, "model-a", 1)
+
+        self.assertNotEqual(key, report_cache.cache_key(record, "model-b", 1))
+        self.assertNotEqual(key, report_cache.cache_key(record, "model-a", 2))
+        record.glucose = 151
+        self.assertNotEqual(key, report_cache.cache_key(record, "model-a", 1))
+
+    def test_errors_are_not_cached(self):
+        record = self.make_record(glucose=150)
+        with mock.patch("health_app.inference.StubInferenceClient.chat_completion", side_effect=ConnectionError("down")):
+            self.assertTrue(generate_risk_assessment_for_record(record).startswith("Error:"))
+        self.assertFalse(ReportCacheEntry.objects.exists())
+
+    @override_settings(AI_REPORT_CACHE_MAX_ENTRIES=2, AI_REPORT_CACHE_MAX_AGE_DAYS=30)
+    def test_eviction_by_size_and_age(self):
+        for i, glucose in enumerate([130, 140, 150]):
+            generate_risk_assessment_for_record(self.make_record(f"P{i}", glucose=glucose))
+
+        # Only the two most recently used entries survive.
+        self.assertEqual(ReportCacheEntry.objects.count(), 2)
+
+        ReportCacheEntry.objects.update(created_at=timezone.now() - timedelta(days=31))
+        self.assertEqual(report_cache.evict(), 2)
+
+
+@override_settings(AI_REPORT_CACHE_ENABLED=False)
+class StreamingAnalysisTests(HospitalTestMixin, TestCase):
+    def read_events(self, response):
+        body = b"".join(response.streaming_content).decode()
+        events = []
+        for block in body.strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in block.split("\n"))
+            events.append((lines['event'], json.loads(lines['data'])))
+        return events
+
+    def test_stream_sends_deltas_then_saves_cleaned_report(self):
+        record = self.make_record(glucose=150)
+        url = reverse('analyze_record_live', kwargs={'pk': record.pk})
+        self.assertContains(self.client.get(url), 'id="report-stream"')
+
+        response = self.client.post(url)
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = self.read_events(response)
+        kinds = [kind for kind, _ in events]
+        self.assertEqual(kinds[0], 'start')
+        self.assertEqual(kinds[-1], 'done')
+        self.assertGreater(kinds.count('delta'), 10)
+
+        streamed = "".join(data['text'] for kind, data in events if kind == 'delta')
+        self.assertTrue(streamed.startswith("Sure, here is the assessment."))
+        assessment = RiskAssessment.objects.get(patient_record=record)
+        self.assertTrue(assessment.ai_generated_report.startswith("### Overall Risk Summary"))
+        self.assertNotIn("```", assessment.ai_generated_report)
+        self.assertEqual(events[-1][1]['assessment_id'], assessment.pk)
+
+    def test_stream_error_does_not_save_assessment(self):
+        record = self.make_record(glucose=150)
+        with mock.patch("health_app.inference.StubInferenceClient.chat_completion", side_effect=ConnectionError("down")):
+            events = self.read_events(self.client.post(reverse('analyze_record_live', kwargs={'pk': record.pk})))
+
+        self.assertEqual(events[-1][0], 'error')
+        self.assertFalse(RiskAssessment.objects.filter(patient_record=record).exists())
+
+    def test_live_page_redirects_when_already_analyzed(self):
+        record = self.make_record(glucose=150)
+        assessment = RiskAssessment.objects.create(patient_record=record, ai_generated_report="### Overall Risk Summary")
+        response = self.client.get(reverse('analyze_record_live', kwargs={'pk': record.pk}))
+        self.assertRedirects(response, reverse('view_assessment', kwargs={'pk': assessment.pk}), fetch_redirect_response=False)
+        self.assertEqual(self.client.post(reverse('analyze_record_live', kwargs={'pk': record.pk})).status_code, 409)
+
+
+class CSVImportTests(HospitalTestMixin, TestCase):
+    HEADER = "patient_identifier,glucose,hba1c,total_cholesterol,ldl,hdl,triglycerides,alt,ast,creatinine,urea,crp,wbc\n"
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def csv_file(self, content, name="labs.csv"):
+        return SimpleUploadedFile(name, content.encode() if isinstance(content, str) else content)
+
+    def upload_and_run(self, content, upsert=False):
+        data = {'csv_file': self.csv_file(content)}
+        if upsert:
+            data['upsert'] = 'on'
+        response = self.client.post(reverse('upload_csv'), data)
+        self.assertRedirects(response, reverse('admin_dashboard'), fetch_redirect_response=False)
+        self.assertEqual(run_pending_uploads(), 1)
+        return UploadJob.objects.latest('pk')
+
+    def test_import_in_batches_across_chunk_boundaries(self):
+        rows = "".join(f"P{i:04},{100 + i % 50},5.5,,,,,,,,,,\n" for i in range(250))
+        upload = self.csv_file(self.HEADER + rows)
+        upload.DEFAULT_CHUNK_SIZE = 64  # Force lines to straddle chunk boundaries
+        progress = []
+        importer = PatientCSVImporter(self.hospital, self.admin, batch_size=100, on_progress=lambda i: progress.append(i.rows_inserted))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(importer.run(upload))
+
+        self.assertEqual(len(importer.record_ids), 250)
+        self.assertEqual(progress, [0, 0, 0, 100, 200, 250])
+        # A conflict check and bulk INSERT per batch (SQLite may split an INSERT), plus the
+        # analytics summary's insert/lock/update per batch; never a query per row.
+        self.assertLess(len(queries), 25)
+        record = PatientRecord.objects.get(patient_identifier="P0249")
+        self.assertEqual((record.glucose, record.hba1c, record.ldl), (149.0, 5.5, None))
+
+    def test_upload_is_imported_by_the_worker(self):
+        response = self.client.post(reverse('upload_csv'), {'csv_file': self.csv_file(self.HEADER + "P1,100,,,,,,,,,,,\nP2,130,,,,,,,,,,,\n")})
+
+        self.assertRedirects(response, reverse('admin_dashboard'), fetch_redirect_response=False)
+        self.assertFalse(PatientRecord.objects.exists())
+        job = UploadJob.objects.get()
+        self.assertContains(self.client.get(reverse('admin_dashboard')), 'id="upload-progress-card"')
+
+        run_pending_uploads()
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.rows_parsed, job.rows_validated, job.rows_inserted), (UploadJob.Status.DONE, 2, 2, 2))
+        self.assertFalse(job.csv_file)
+        progress = self.client.get(reverse('upload_job_progress', kwargs={'pk': job.pk})).json()
+        self.assertEqual(progress['status'], 'done')
+        dashboard = self.client.get(reverse('admin_dashboard'))
+        self.assertEqual([r.patient_identifier for r in dashboard.context['new_records']], ["P1", "P2"])
+
+    def test_per_row_errors_cancel_the_whole_upload(self):
+        self.make_record("P4")
+        job = self.upload_and_run(
+            self.HEADER
+            + "P1,100,,,,,,,,,,,\n"
+            + ",120,,,,,,,,,,,\n"
+            + "P1,120,,,,,,,,,,,\n"
+            + "P3,abc,,,,,,,,,,,\n"
+            + "P4,100,,,,,,,,,,,\n"
+        )
+
+        self.assertEqual(job.status, UploadJob.Status.FAILED)
+        self.assertEqual((job.rows_parsed, job.rows_validated, job.rows_inserted, job.error_count), (5, 1, 0, 4))
+        self.assertEqual([(e['row'], e['patient_identifier']) for e in job.errors], [(3, None), (4, "P1"), (5, "P3"), (6, "P4")])
+        self.assertIn("already exists", job.errors[-1]['message'])
+        self.assertEqual(PatientRecord.objects.count(), 1)
+        self.assertContains(self.client.get(reverse('admin_dashboard')), "Upload Cancelled")
+
+    def test_failed_insert_removes_partial_records(self):
+        rows = "".join(f"P{i},100,,,,,,,,,,,\n" for i in range(5))
+        importer = PatientCSVImporter(self.hospital, self.admin, batch_size=2)
+        upload = self.csv_file(self.HEADER + rows)
+        self.assertTrue(importer.validate(upload))
+
+        # Another upload adds P4 between the validation and insert passes.
+        self.make_record("P4")
+        with self.assertRaises(IntegrityError):
+            importer.insert(upload)
+        self.assertEqual(list(PatientRecord.objects.values_list('patient_identifier', flat=True)), ["P4"])
+
+    def test_upsert_inserts_new_and_updates_changed_records(self):
+        other_job = UploadJob.objects.create(hospital=self.hospital, original_name="old.csv", status=UploadJob.Status.DONE)
+        changed = PatientRecord.objects.create(hospital=self.hospital, uploaded_by=self.doctor, upload_job=other_job, patient_identifier="P1", glucose=100)
+        unchanged = PatientRecord.objects.create(hospital=self.hospital, patient_identifier="P2", glucose=130)
+        RiskAssessment.objects.create(patient_record=changed, ai_generated_report="Glucose 100.")
+        RiskAssessment.objects.create(patient_record=unchanged, ai_generated_report="Glucose 130.")
+
+        job = self.upload_and_run(self.HEADER + "P1,150,6.0,,,,,,,,,,\nP2,130,,,,,,,,,,,\nP3,90,,,,,,,,,,,\n", upsert=True)
+
+        self.assertEqual(job.status, UploadJob.Status.DONE)
+        self.assertTrue(job.upsert)
+        self.assertEqual((job.rows_inserted, job.rows_updated, job.rows_unchanged, job.error_count), (1, 1, 1, 0))
+        changed.refresh_from_db()
+        self.assertEqual((changed.glucose, changed.hba1c), (150.0, 6.0))
+        # Only the markers change; the record keeps its uploader and upload job.
+        self.assertEqual((changed.uploaded_by, changed.upload_job), (self.doctor, other_job))
+        self.assertEqual(PatientRecord.objects.get(patient_identifier="P3").upload_job, job)
+        # The updated record's report is kept, but flagged as describing the old values.
+        self.assertEqual(dict(RiskAssessment.objects.values_list('patient_record__patient_identifier', 'markers_changed')), {"P1": True, "P2": False})
+        progress = self.client.get(reverse('upload_job_progress', kwargs={'pk': job.pk})).json()
+        self.assertEqual((progress['rows_updated'], progress['rows_unchanged']), (1, 1))
+        self.assertContains(self.client.get(reverse('admin_dashboard')), "1 new, 1 updated, 1 unchanged")
+
+    def test_upsert_publishes_progress_per_committed_batch(self):
+        self.make_record("P1", glucose=100)
+        progress = []
+        importer = PatientCSVImporter(self.hospital, self.admin, upsert=True, batch_size=2, on_progress=lambda i: progress.append(
+            (i.rows_inserted, i.rows_updated, PatientRecord.objects.count())))
+
+        self.assertTrue(importer.run(self.csv_file(self.HEADER + "P1,150,,,,,,,,,,,\nP2,90,,,,,,,,,,,\nP3,90,,,,,,,,,,,\n")))
+
+        # Two validation batches, then one progress report after each upsert batch is written.
+        self.assertEqual(progress[2:], [(1, 1, 2), (2, 1, 3)])
+
+    def test_unreadable_or_empty_file(self):
+        for content in [b"\xff\xfe\x00bad", self.HEADER]:
+            job = self.upload_and_run(content)
+            self.assertEqual(job.status, UploadJob.Status.FAILED)
+            self.assertIn("Error reading file.", job.errors[0]['message'])
+
+    def test_progress_endpoint_hides_other_hospitals_uploads(self):
+        other = Hospital.objects.create(name="Other Hospital")
+        job = UploadJob.objects.create(hospital=other, original_name="x.csv")
+        self.assertEqual(self.client.get(reverse('upload_job_progress', kwargs={'pk': job.pk})).status_code, 403)
+
+
+class ReportExportTests(HospitalTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.doctor.first_name, self.doctor.last_name = "Ada", "Lovelace"
+        self.doctor.save()
+        for i in range(3):
+            RiskAssessment.objects.create(
+                patient_record=self.make_record(f"P{i}", glucose=130 + i),
+                ai_generated_report=f"Report {i}\nwith, a comma",
+                status=RiskAssessment.Status.REVIEWED,
+                reviewed_by=self.doctor if i else None,
+                reviewed_at=timezone.now() - timedelta(hours=3 - i),
+            )
+        RiskAssessment.objects.create(patient_record=self.make_record("P9"), ai_generated_report="Pending")
+
+    def export(self, **params):
+        response = self.client.get(reverse('export_reports_csv'), params)
+        self.assertTrue(response.streaming)
+        return response, b"".join(response.streaming_content)
+
+    def test_csv_export_is_streamed_in_review_order(self):
+        with CaptureQueriesContext(connection) as queries:
+            response, body = self.export()
+
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(io.StringIO(body.decode())))
+        self.assertEqual(rows[0][0], 'Patient Identifier')
+        self.assertEqual([row[0] for row in rows[1:]], ["P0", "P1", "P2"])
+        self.assertEqual(rows[1][13:16], ["Report 0\nwith, a comma", "", "N/A"])
+        self.assertEqual(rows[2][15], "Ada Lovelace")
+        # The watermark lookup plus one query for the rows, whatever the number of assessments and doctors.
+        self.assertEqual(len([q for q in queries if 'health_app_riskassessment' in q['sql']]), 2)
+
+    def test_ndjson_and_gzip_formats(self):
+        response, body = self.export(format='ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([line['patient_identifier'] for line in lines], ["P0", "P1", "P2"])
+        self.assertEqual((lines[1]['glucose'], lines[1]['reviewed_by'], lines[0]['reviewed_by']), (131.0, "Ada Lovelace", None))
+
+        response, body = self.export(format='csv.gz')
+        self.assertIn('.csv.gz"', response['Content-Disposition'])
+        self.assertEqual(gzip.decompress(body), self.export()[1])
+
+    def test_unknown_format_and_doctor_access(self):
+        self.assertEqual(self.client.get(reverse('export_reports_csv'), {'format': 'xml'}).status_code, 400)
+        self.client.force_login(self.doctor)
+        self.assertRedirects(self.client.get(reverse('export_reports_csv')), reverse('dashboard_redirect'), fetch_redirect_response=False)
+
+    def test_incremental_export_with_cursor_and_since(self):
+        response, body = self.export(format='ndjson')
+        cursor = response['X-Next-Cursor']
+        self.assertTrue(cursor)
+
+        # Nothing new: an empty export that hands back the same cursor.
+        response, body = self.export(format='ndjson', cursor=cursor)
+        self.assertEqual((body, response['X-Next-Cursor']), (b"", cursor))
+
+        # A new review sharing the last timestamp is still picked up, thanks to the id tie-breaker.
+        last = RiskAssessment.objects.filter(status=RiskAssessment.Status.REVIEWED).latest('reviewed_at')
+        RiskAssessment.objects.filter(patient_record__patient_identifier="P9").update(
+            status=RiskAssessment.Status.REVIEWED, reviewed_at=last.reviewed_at
+        )
+        response, body = self.export(format='ndjson', cursor=cursor)
+        self.assertEqual([json.loads(line)['patient_identifier'] for line in body.decode().splitlines()], ["P9"])
+        self.assertNotEqual(response['X-Next-Cursor'], cursor)
+
+        since = (timezone.now() - timedelta(hours=2, minutes=30)).isoformat()
+        body = self.export(format='ndjson', since=since)[1]
+        self.assertEqual([json.loads(line)['patient_identifier'] for line in body.decode().splitlines()], ["P1", "P2", "P9"])
+
+        for params in [{'cursor': 'not-a-cursor'}, {'since': 'yesterday'}]:
+            self.assertEqual(self.client.get(reverse('export_reports_csv'), params).status_code, 400)
+
+    def test_reviewed_rows_without_a_timestamp_do_not_become_the_watermark(self):
+        RiskAssessment.objects.create(
+            patient_record=self.make_record("P5"), ai_generated_report="Legacy",
+            status=RiskAssessment.Status.REVIEWED, reviewed_at=None,
+        )
+        response, body = self.export(format='ndjson')
+        self.assertEqual([json.loads(line)['patient_identifier'] for line in body.decode().splitlines()], ["P0", "P1", "P2"])
+        last = RiskAssessment.objects.get(patient_record__patient_identifier="P2")
+        self.assertEqual(decode_cursor(response['X-Next-Cursor']), (last.reviewed_at, last.pk))
+
+
+class QueryBudgetTests(HospitalTestMixin, TestCase):
+    """
+    Per-view query budgets. Each view must load with a fixed number of queries,
+    however many rows the page shows.
+    """
+    # View name -> the most queries a page may take (session, user and hospital lookups included).
+    BUDGETS = {
+        'patient_list': 3,
+        'doctor_dashboard': 3,
+        'admin_dashboard': 4,  # Includes the circuit breaker's state, read from the shared cache
+        'analytics_dashboard': 5,
+    }
+
+    def add_rows(self, start, count):
+        """Adds `count` records covering every row variant: unanalyzed, pending, assigned and reviewed."""
+        for i in range(start, start + count):
+            record = self.make_record(f"Q{i:03}")
+            if i % 4 == 0:
+                continue
+            RiskAssessment.objects.create(
+                patient_record=record, ai_generated_report="Report",
+                status=RiskAssessment.Status.REVIEWED if i % 4 == 3 else RiskAssessment.Status.PENDING_REVIEW,
+                assigned_doctor=self.doctor if i % 4 == 2 else None,
+                reviewed_by=self.doctor if i % 4 == 3 else None,
+            )
+
+    def count_queries(self, view_name, user):
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(view_name))
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries]
+
+    def assertQueryBudget(self, view_name, user):
+        """
+        Checks the view against its budget, with one page of rows and with a full page.
+        The budget is for the hot path, so cached lookups (e.g. the doctor roster) are warmed first.
+        """
+        self.add_rows(0, 4)
+        self.count_queries(view_name, user)
+        small = self.count_queries(view_name, user)
+        self.add_rows(4, 30)
+        full = self.count_queries(view_name, user)
+
+        self.assertEqual(len(small), len(full), f"{view_name} queries grow with the rows shown:\n" + "\n".join(full))
+        self.assertLessEqual(len(full), self.BUDGETS[view_name], f"{view_name} is over its query budget:\n" + "\n".join(full))
+
+    def test_patient_list(self):
+        self.assertQueryBudget('patient_list', self.admin)
+
+    def test_patient_list_for_doctors(self):
+        self.assertQueryBudget('patient_list', self.doctor)
+
+    def test_doctor_dashboard(self):
+        self.assertQueryBudget('doctor_dashboard', self.doctor)
+
+    def test_admin_dashboard(self):
+        self.assertQueryBudget('admin_dashboard', self.admin)
+
+    def test_analytics_dashboard(self):
+        self.assertQueryBudget('analytics_dashboard', self.admin)
+
+
+class KeysetPaginationTests(HospitalTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Give some records the same created_at, so the id tie-breaker matters.
+        now = timezone.now()
+        for i in range(35):
+            record = self.make_record(f"K{i:02}")
+            PatientRecord.objects.filter(pk=record.pk).update(created_at=now - timedelta(minutes=i // 3))
+
+    def identifiers(self, response):
+        return [patient.patient_identifier for patient in response.context['patients']]
+
+    def test_forward_and_backward_through_the_patient_list(self):
+        expected = list(PatientRecord.objects.order_by('-created_at', '-pk').values_list('patient_identifier', flat=True))
+        pages, query = [], ''
+        while query is not None:
+            response = self.client.get(reverse('patient_list') + query)
+            pages.append(self.identifiers(response))
+            query = response.context['next_page_url']
+
+        self.assertEqual([len(page) for page in pages], [15, 15, 5])
+        self.assertEqual(sum(pages, []), expected)
+
+        response = self.client.get(reverse('patient_list') + response.context['previous_page_url'])
+        self.assertEqual(self.identifiers(response), pages[1])
+        self.assertIsNotNone(response.context['previous_page_url'])
+        response = self.client.get(reverse('patient_list') + response.context['previous_page_url'])
+        self.assertEqual(self.identifiers(response), pages[0])
+        self.assertIsNone(response.context['previous_page_url'])
+
+    def test_count_is_optional_and_capped(self):
+        response = self.client.get(reverse('patient_list'))
+        self.assertNotIn('total_count', response.context)
+        self.assertContains(response, "Show total")
+
+        with self.settings(PAGINATION_COUNT_CAP=20):
+            response = self.client.get(reverse('patient_list'), {'count': 1})
+        self.assertEqual((response.context['total_count'], response.context['total_count_exact']), (20, False))
+        self.assertContains(response, "20+ records")
+        self.assertIn('count=1', response.context['next_page_url'])
+
+    def test_invalid_cursor_is_not_found(self):
+        self.assertEqual(self.client.get(reverse('patient_list'), {'cursor': 'garbage'}).status_code, 404)
+
+    def test_doctor_worklist_shows_assigned_reports_first(self):
+        records = list(PatientRecord.objects.order_by('pk'))
+        for record in records[:12]:
+            RiskAssessment.objects.create(patient_record=record, ai_generated_report="Report",
+                                          assigned_doctor=self.doctor if record.patient_identifier == "K00" else None)
+        self.client.force_login(self.doctor)
+
+        first = self.client.get(reverse('doctor_dashboard'))
+        second = self.client.get(reverse('doctor_dashboard') + first.context['next_page_url'])
+        shown = [a.patient_record.patient_identifier for a in list(first.context['pending_assessments']) + list(second.context['pending_assessments'])]
+        self.assertEqual(shown[0], "K00")
+        self.assertEqual(sorted(shown), sorted(r.patient_identifier for r in records[:12]))
+        self.assertIsNone(second.context['next_page_url'])
+
+
+class QueryBenchmarkCommandTests(TestCase):
+    def test_benchmark_runs_and_cleans_up(self):
+        out = io.StringIO()
+        # The index toggle needs DDL outside a transaction, so only the current indexes are measured here.
+        call_command('benchmark_queries', records=30, repeat=1, skip_baseline=True, force=True, stdout=out)
+
+        self.assertIn("Doctor worklist, first page", out.getvalue())
+        self.assertIn("patient_hospital_created", out.getvalue())
+        self.assertFalse(Hospital.objects.exists())
+        self.assertFalse(PatientRecord.objects.exists())
+
+
+class ReportHTMLTests(HospitalTestMixin, TestCase):
+    REPORT = "### Overall Risk Summary\nHigh **glucose**."
+
+    def test_html_is_rendered_when_the_report_is_saved(self):
+        assessment = RiskAssessment.objects.create(patient_record=self.make_record(), ai_generated_report=self.REPORT)
+        self.assertIn("<strong>glucose</strong>", assessment.html_report)
+        self.assertEqual(assessment.html_report_version, REPORT_RENDERER_VERSION)
+
+        assessment = RiskAssessment.objects.get(pk=assessment.pk)
+        with mock.patch('health_app.models.render_report_html', return_value="<p>Revised.</p>") as render:
+            assessment.doctor_comments = "Agreed."
+            assessment.save()
+            render.assert_not_called()
+
+            assessment.ai_generated_report = "Revised."
+            assessment.save(update_fields=['ai_generated_report'])
+            render.assert_called_once_with("Revised.")
+
+    def test_detail_view_does_no_markdown_parsing(self):
+        assessment = RiskAssessment.objects.create(patient_record=self.make_record(), ai_generated_report=self.REPORT)
+        self.client.force_login(self.doctor)
+        with mock.patch('health_app.models.render_report_html', side_effect=AssertionError("rendered on view")):
+            response = self.client.get(reverse('view_assessment', kwargs={'pk': assessment.pk}))
+            self.assertContains(response, "<strong>glucose</strong>")
+            response = self.client.post(reverse('view_assessment', kwargs={'pk': assessment.pk}), {'doctor_comments': "x" * 10})
+            self.assertEqual(response.status_code, 302)
+
+    def test_stale_rows_are_backfilled_lazily_or_by_command(self):
+        records = [self.make_record(f"H{i}") for i in range(3)]
+        RiskAssessment.objects.bulk_create([RiskAssessment(patient_record=r, ai_generated_report=self.REPORT) for r in records])
+        lazy = RiskAssessment.objects.get(patient_record=records[0])
+        self.assertEqual((lazy.html_report, lazy.html_report_version), ("", 0))
+
+        self.client.force_login(self.doctor)
+        self.assertContains(self.client.get(reverse('view_assessment', kwargs={'pk': lazy.pk})), "<strong>glucose</strong>")
+        lazy.refresh_from_db()
+        self.assertEqual(lazy.html_report_version, REPORT_RENDERER_VERSION)
+
+        call_command('backfill_report_html', batch_size=1, stdout=io.StringIO())
+        self.assertFalse(RiskAssessment.objects.exclude(html_report_version=REPORT_RENDERER_VERSION).exists())
+        self.assertFalse(RiskAssessment.objects.filter(html_report="").exists())
+
+    def test_backfill_queries_do_not_grow_with_the_rows(self):
+        records = [self.make_record(f"H{i}") for i in range(5)]
+        RiskAssessment.objects.bulk_create([RiskAssessment(patient_record=r, ai_generated_report=self.REPORT) for r in records])
+
+        # A count, one SELECT and one bulk UPDATE per batch, and the empty last SELECT.
+        with self.assertNumQueries(4):
+            call_command('backfill_report_html', batch_size=50, stdout=io.StringIO())
+        self.assertFalse(RiskAssessment.objects.exclude(html_report_version=REPORT_RENDERER_VERSION).exists())
+
+    def test_bulk_created_templated_reports_are_rendered(self):
+        self.make_record("N1", glucose=90)
+        assess_normal_records(PatientRecord.objects.all())
+        self.assertIn("<h3>Overall Risk Summary</h3>", RiskAssessment.objects.get().html_report)
+
+
+class DoctorRosterTests(HospitalTestMixin, TestCase):
+    def test_roster_is_cached_and_invalidated_by_user_changes(self):
+        self.assertEqual(get_doctor_roster(self.hospital.pk), [RosterEntry(self.doctor.pk, "Dan Doctor")])
+        with self.assertNumQueries(0):
+            get_doctor_roster(self.hospital.pk)
+
+        # Logging in only updates last_login, which leaves the roster alone.
+        self.client.force_login(self.doctor)
+        with self.assertNumQueries(0):
+            get_doctor_roster(self.hospital.pk)
+
+        # Rosters are dropped when the change commits, not before.
+        with self.captureOnCommitCallbacks(execute=True):
+            second = User.objects.create_user(username="zed@hospital.com", first_name="Zed", role=User.Role.DOCTOR, hospital=self.hospital)
+            self.assertEqual([entry.full_name for entry in get_doctor_roster(self.hospital.pk)], ["Dan Doctor"])
+        self.assertEqual([entry.full_name for entry in get_doctor_roster(self.hospital.pk)], ["Dan Doctor", "Zed"])
+
+        other = Hospital.objects.create(name="Other Hospital")
+        get_doctor_roster(other.pk)
+        second.hospital = other
+        with self.captureOnCommitCallbacks(execute=True):
+            second.save()
+        self.assertEqual([entry.id for entry in get_doctor_roster(self.hospital.pk)], [self.doctor.pk])
+        self.assertEqual([entry.id for entry in get_doctor_roster(other.pk)], [second.pk])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.doctor.delete()
+        self.assertEqual(get_doctor_roster(self.hospital.pk), [])
+
+    def test_assignment_is_validated_against_the_roster(self):
+        assessment = RiskAssessment.objects.create(patient_record=self.make_record(), ai_generated_report="Report")
+        outsider = User.objects.create_user(username="out@other.com", role=User.Role.DOCTOR, hospital=Hospital.objects.create(name="Other"))
+        url = reverse('assign_doctor', kwargs={'pk': assessment.pk})
+
+        for doctor_id in [outsider.pk, self.admin.pk, "abc"]:
+            self.client.post(url, {'doctor_id': doctor_id})
+            assessment.refresh_from_db()
+            self.assertIsNone(assessment.assigned_doctor_id)
+
+        # A roster cached before the doctor moved (e.g. by another process) doesn't let the assignment through.
+        get_doctor_roster(self.hospital.pk)
+        User.objects.filter(pk=self.doctor.pk).update(hospital=outsider.hospital)
+        self.client.post(url, {'doctor_id': self.doctor.pk})
+        assessment.refresh_from_db()
+        self.assertIsNone(assessment.assigned_doctor_id)
+
+        User.objects.filter(pk=self.doctor.pk).update(hospital=self.hospital)
+        self.client.post(url, {'doctor_id': self.doctor.pk})
+        assessment.refresh_from_db()
+        self.assertEqual(assessment.assigned_doctor, self.doctor)
+
+
+class PatientSearchTests(HospitalTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.make_record("A100", hba1c=6.8, ldl=150)
+        self.make_record("A101", hba1c=6.8, ldl=120)
+        self.make_record("A200", hba1c=5.9, ldl=140)
+        self.make_record("B100", hba1c=5.0, ldl=90)
+
+    def search(self, **params):
+        response = self.client.get(reverse('patient_list'), params)
+        return sorted(patient.patient_identifier for patient in response.context['patients'])
+
+    def test_risk_flags_follow_the_rule_table(self):
+        record = PatientRecord.objects.get(patient_identifier="A200")
+        self.assertEqual(record.risk_flags, marker_bit('hba1c') | marker_bit('ldl'))  # Pre-diabetes counts as abnormal
+
+        record.ldl = 100
+        record.save(update_fields=['ldl'])
+        record.refresh_from_db()
+        self.assertEqual(record.risk_flags, marker_bit('hba1c'))
+
+        PatientRecord.objects.update(risk_flags=0)
+        call_command('recompute_risk_flags', stdout=io.StringIO())
+        self.assertEqual(
+            dict(PatientRecord.objects.values_list('patient_identifier', 'risk_flags')),
+            {r.patient_identifier: risk_flags(r) for r in PatientRecord.objects.all()},
+        )
+
+    def test_range_prefix_and_flag_searches(self):
+        self.assertEqual(self.search(hba1c__gte=6.5, ldl__gt=130), ["A100"])
+        self.assertEqual(self.search(ldl__lte=120), ["A101", "B100"])
+        self.assertEqual(self.search(q="A1"), ["A100", "A101"])
+        self.assertEqual(self.search(flagged=['hba1c', 'ldl']), ["A100", "A200"])
+        self.assertEqual(self.search(q="A", flagged='ldl', hba1c__lt=6), ["A200"])
+
+    def test_invalid_filters_show_no_results(self):
+        response = self.client.get(reverse('patient_list'), {'hba1c__gte': 'high'})
+        self.assertEqual(list(response.context['patients']), [])
+        self.assertContains(response, "Some search filters are invalid")
+
+    def test_filters_are_kept_across_pages(self):
+        for i in range(20):
+            self.make_record(f"C{i:03}", ldl=200)
+        response = self.client.get(reverse('patient_list'), {'ldl__gte': 199})
+        self.assertEqual(len(response.context['patients']), 15)
+        response = self.client.get(reverse('patient_list') + response.context['next_page_url'])
+        self.assertEqual(len(response.context['patients']), 5)
+
+
+class AnalyticsTests(HospitalTestMixin, TestCase):
+    def summary(self):
+        """The contents of the three summary tables, without ids and empty rows."""
+        return (
+            sorted(MarkerBucket.objects.filter(count__gt=0).values_list('hospital_id', 'marker', 'bucket', 'count', 'value_sum', 'abnormal_count')),
+            sorted(ReviewDaily.objects.filter(count__gt=0).values_list('hospital_id', 'doctor_id', 'day', 'count')),
+            sorted(BacklogDaily.objects.filter(count__gt=0).values_list('hospital_id', 'day', 'count')),
+        )
+
+    def assertSummaryMatchesRebuild(self):
+        incremental = self.summary()
+        call_command('rebuild_analytics', stdout=io.StringIO())
+        self.assertEqual(incremental, self.summary())
+
+    def test_rebuild_if_empty_only_fills_empty_tables(self):
+        self.make_record("P001", glucose=140)
+        MarkerBucket.objects.all().delete()  # As after the migration that adds the tables
+        call_command('rebuild_analytics', if_empty=True, stdout=io.StringIO())
+        self.assertTrue(self.summary()[0])
+
+        with mock.patch('health_app.management.commands.rebuild_analytics.rebuild') as rebuild:
+            call_command('rebuild_analytics', if_empty=True, stdout=io.StringIO())
+        rebuild.assert_not_called()
+
+    def test_saves_and_deletes_update_the_summary_incrementally(self):
+        record = self.make_record("P001", glucose=140, hdl=35)
+        other = self.make_record("P002", glucose=90)
+        assessment = RiskAssessment.objects.create(patient_record=record, ai_generated_report="Report")
+        RiskAssessment.objects.create(patient_record=other, ai_generated_report="Report")
+        self.assertEqual(BacklogDaily.objects.get().count, 2)
+
+        record.glucose = 100
+        record.save()
+        self.client.force_login(self.doctor)
+        self.client.post(reverse('view_assessment', kwargs={'pk': assessment.pk}), {'doctor_comments': "Seen."})
+        self.assertEqual(BacklogDaily.objects.get().count, 1)
+        self.assertEqual(ReviewDaily.objects.get(doctor=self.doctor).count, 1)
+        self.assertSummaryMatchesRebuild()
+
+        other.delete()  # Cascades to its pending assessment
+        self.assertEqual(BacklogDaily.objects.get().count, 0)
+        self.assertSummaryMatchesRebuild()
+
+    def test_bulk_imports_and_assessments_are_counted(self):
+        importer = PatientCSVImporter(self.hospital, self.admin)
+        header = "patient_identifier," + ",".join(MARKER_FIELDS) + "\n"
+        importer.run(SimpleUploadedFile("a.csv", (header + "P1,140,,,,,,,,,,,\nP2,90,,,,,,,,,,,\n").encode()))
+        PatientCSVImporter(self.hospital, self.admin, upsert=True).run(
+            SimpleUploadedFile("b.csv", (header + "P1,95,,,,,,,,,,,\nP3,,7.0,,,,,,,,,,\n").encode())
+        )
+        assess_normal_records(PatientRecord.objects.filter(hospital=self.hospital))
+
+        glucose = analytics.marker_stats(self.hospital.pk)[0]
+        self.assertEqual((glucose.marker.field, glucose.count, glucose.abnormal_count, glucose.mean), ('glucose', 2, 0, 92.5))
+        self.assertEqual(analytics.backlog_age(self.hospital.pk).total, 2)  # P1 and P2 are all-normal now
+        self.assertSummaryMatchesRebuild()
+
+    @override_settings(AI_REPORT_CACHE_ENABLED=False, CACHES=IN_MEMORY_CACHES)  # Worker threads, see BulkAnalysisTests
+    def test_assessments_lost_to_a_concurrent_insert_are_not_counted(self):
+        analyzed_meanwhile = self.make_record("P001")
+        records = [analyzed_meanwhile, self.make_record("P002")]
+        RiskAssessment.objects.create(patient_record=analyzed_meanwhile, ai_generated_report="From the live view")
+
+        analyze_records_concurrently(records, max_workers=2)
+
+        self.assertEqual(RiskAssessment.objects.count(), 2)
+        self.assertEqual(BacklogDaily.objects.get().count, 2)
+        self.assertSummaryMatchesRebuild()
+
+    def test_percentiles_from_buckets(self):
+        # 10 values in bucket 0 and 10 in bucket 4 of width 2: the median is the top of bucket 0.
+        buckets = [(0, 10), (4, 10)]
+        self.assertEqual(analytics.percentile_from_buckets(buckets, 2, 0.5), 2)
+        self.assertEqual(analytics.percentile_from_buckets(buckets, 2, 0.75), 9)
+
+    def test_dashboard_reads_only_the_summary_tables(self):
+        record = self.make_record("P001", glucose=140)
+        RiskAssessment.objects.create(
+            patient_record=record, ai_generated_report="Report", created_at=timezone.now() - timedelta(days=10),
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('analytics_dashboard'))
+
+        self.assertContains(response, "1 report pending review")
+        self.assertEqual(dict(response.context['backlog'].bands)["1-4 weeks"], 1)
+        self.assertEqual(response.context['marker_stats'][0].abnormal_count, 1)
+        tables = " ".join(query['sql'] for query in queries)
+        self.assertNotIn('"health_app_patientrecord"', tables)
+        self.assertNotIn('"health_app_riskassessment"', tables)
+
+
+@override_settings(AI_INFERENCE_BACKEND="stub", PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class LoadTestTests(TestCase):
+    def test_seeded_hospital_serves_every_scenario(self):
+        hospital, = seed_hospitals(hospitals=1, doctors=2, records=60, seed=1)
+        self.assertEqual(hospital.name, f"{SYNTHETIC_PREFIX} 1")
+        self.assertEqual(hospital.users.filter(role=User.Role.DOCTOR).count(), 2)
+        self.assertEqual(hospital.patient_records.count(), 60)
+        assessments = RiskAssessment.objects.count()
+        self.assertTrue(assessments)
+        self.assertEqual(analytics.backlog_age(hospital.pk).total, RiskAssessment.objects.filter(status=RiskAssessment.Status.PENDING_REVIEW).count())
+
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            call_command(
+                'load_test', requests=2, worker_jobs=2, worker_concurrency=1, force=True,
+                output=output.name, stdout=io.StringIO(),
+            )
+            with open(output.name) as f:
+                report = json.load(f)
+
+        self.assertEqual(set(report['scenarios']), {
+            'login', 'admin_dashboard', 'patient_list', 'patient_search', 'doctor_dashboard', 'assessment_detail',
+            'analytics', 'upload', 'analyze', 'analyze_live', 'export',
+        })
+        for name, result in report['scenarios'].items():
+            self.assertEqual(result['errors'], 0, f"{name}: {result['error_samples']}")
+            self.assertEqual(result['requests'], 2)
+            self.assertIsNotNone(result['latency_ms']['p99'])
+        self.assertEqual(report['worker']['jobs'], 2)
+        # What the run wrote is removed again, so the next run sees the same data.
+        self.assertEqual(RiskAssessment.objects.count(), assessments)
+        self.assertFalse(AnalysisJob.objects.exists())
+        self.assertFalse(UploadJob.objects.exists())
+
+    def test_stub_latency_is_configurable(self):
+        messages = [{"role": "user", "content": "prompt"}]
+        with mock.patch('health_app.inference.time.sleep') as sleep, override_settings(AI_STUB_LATENCY=0.5):
+            StubInferenceClient().chat_completion(messages)
+            sleep.assert_called_once_with(0.5)
+            sleep.reset_mock()
+            list(StubInferenceClient(latency=0, token_latency=0.01).chat_completion(messages, stream=True))
+            self.assertTrue(sleep.call_count > 5)
+            self.assertEqual({call.args for call in sleep.call_args_list}, {(0.01,)})
+
+
+class PerformanceInstrumentationTests(HospitalTestMixin, TestCase):
+    def logged(self, records):
+        return [json.loads(record.getMessage()) for record in records]
+
+    def test_server_timing_header_and_log_line(self):
+        self.make_record()
+        with self.assertLogs('health_app.performance', 'INFO') as logs, CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('patient_list'))
+
+        timing = dict(part.split(";", 1) for part in response['Server-Timing'].split(", "))
+        self.assertEqual(set(timing), {'db', 'inference', 'render', 'total'})
+        self.assertIn(f'desc="{len(queries)} queries"', timing['db'])
+        line, = self.logged(logs.records)
+        self.assertEqual((line['view'], line['status'], line['queries']), ('patient_list', 200, len(queries)))
+        self.assertEqual(line['inference_calls'], 0)
+
+    @override_settings(PERFORMANCE_SLOW_REQUEST_MS=0)
+    def test_slow_request_logs_its_sql(self):
+        with self.assertLogs('health_app.performance', 'WARNING') as logs:
+            self.client.get(reverse('patient_list'))
+
+        slow, = self.logged(logs.records)
+        self.assertTrue(slow['slow'])
+        self.assertEqual(len(slow['sql']), slow['queries'])
+        self.assertTrue(any('health_app_patientrecord' in query['sql'] for query in slow['sql']))
+
+    def test_streamed_response_is_logged_when_the_stream_ends(self):
+        record = self.make_record(glucose=150)
+        with self.assertLogs('health_app.performance', 'INFO') as logs:
+            response = self.client.post(reverse('analyze_record_live', kwargs={'pk': record.pk}))
+            self.assertEqual(logs.records, [])
+            b"".join(response.streaming_content)
+
+        line, = self.logged(logs.records)
+        self.assertEqual(line['view'], 'analyze_record_live')
+        self.assertEqual(line['inference_calls'], 1)
+        self.assertGreater(line['render_ms'], 0)
+
+
+class MetricsTests(HospitalTestMixin, TestCase):
+    def sample(self, name, **labels):
+        return metrics.registry.get_sample_value(name, labels) or 0
+
+    def test_inference_metrics(self):
+        labels = {'model': 'MiniMaxAI/MiniMax-M2.7'}
+        before = {
+            'calls': self.sample('health_inference_latency_seconds_count', mode='complete', **labels),
+            'tokens': self.sample('health_inference_tokens_total', kind='completion', **labels),
+            'anchored': self.sample('health_inference_responses_total', anchor='present', **labels),
+            'errors': self.sample('health_inference_errors_total', error='ConnectionError', **labels),
+        }
+
+        generate_risk_assessment_for_record(self.make_record(glucose=150))
+        with mock.patch("health_app.inference.StubInferenceClient.chat_completion", side_effect=ConnectionError("down")):
+            generate_risk_assessment_for_record(self.make_record("P002", glucose=160))
+
+        self.assertEqual(self.sample('health_inference_latency_seconds_count', mode='complete', **labels), before['calls'] + 2)
+        self.assertGreater(self.sample('health_inference_tokens_total', kind='completion', **labels), before['tokens'])
+        self.assertEqual(self.sample('health_inference_responses_total', anchor='present', **labels), before['anchored'] + 1)
+        self.assertEqual(self.sample('health_inference_errors_total', error='ConnectionError', **labels), before['errors'] + 1)
+
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_metrics_endpoint(self):
+        enqueue_analysis(self.make_record(glucose=150))
+        self.client.get(reverse('patient_list'))
+
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('health_job_queue_depth{queue="analysis",status="queued"} 1.0', body)
+        self.assertIn('health_http_request_duration_seconds_count{method="GET",status="200",view="patient_list"}', body)
+
+    def test_metrics_endpoint_is_hidden_without_a_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+
+class InferenceBackendTests(HospitalTestMixin, TestCase):
+    def test_http_backend_against_the_stub_server(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(StubInferenceClient(latency=0, token_latency=0)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with override_settings(AI_INFERENCE_BACKEND='http', AI_INFERENCE_URL=f'http://127.0.0.1:{server.server_port}/v1'):
+            report = generate_risk_assessment_for_record(self.make_record(glucose=150))
+            events = list(stream_risk_assessment_for_record(self.make_record("P002", glucose=160)))
+
+        self.assertTrue(report.startswith("### Overall Risk Summary"), report)
+        self.assertIn("Stub assessment", report)
+        self.assertEqual(events[-1][0], 'done')
+        self.assertTrue("".join(text for kind, text in events if kind == 'delta').startswith("Sure, here is the assessment."))
+        self.assertTrue(events[-1][1].startswith("### Overall Risk Summary"))
+
+    @override_settings(AI_INFERENCE_BACKEND='huggingface', HUGGING_FACE_API_KEY=None)
+    def test_missing_api_key_fails_the_analysis_not_the_import(self):
+        report = generate_risk_assessment_for_record(self.make_record(glucose=150))
+
+        self.assertTrue(report.startswith("Error:"))
+        self.assertIn("HUGGING_FACE_API_KEY", report)
+        self.assertEqual([warning.id for warning in check_inference_backend(None)], ['health_app.W001'])
+
+    @override_settings(AI_INFERENCE_BACKEND='health_app.inference.StubInferenceClient')
+    def test_backend_by_dotted_path_is_built_once(self):
+        client = get_inference_client()
+        self.assertIsInstance(client, StubInferenceClient)
+        self.assertIs(get_inference_client(), client)
+
+
+class ResilienceTests(HospitalTestMixin, TestCase):
+    CHAT_COMPLETION = "health_app.inference.StubInferenceClient.chat_completion"
+
+    def test_retryable_errors_are_retried(self):
+        response = StubInferenceClient().chat_completion([{"role": "user", "content": "prompt"}])
+        with mock.patch(self.CHAT_COMPLETION, side_effect=[ConnectionError("reset"), TimeoutError("slow"), response]) as chat_completion:
+            report = generate_risk_assessment_for_record(self.make_record(glucose=150))
+
+        self.assertEqual(chat_completion.call_count, 3)
+        self.assertTrue(report.startswith("### Overall Risk Summary"))
+        self.assertEqual(resilience.inference_breaker().state(), resilience.CircuitBreaker.CLOSED)
+
+    def test_success_on_a_closed_circuit_writes_nothing(self):
+        with CaptureQueriesContext(connection) as queries:
+            generate_risk_assessment_for_record(self.make_record(glucose=150))
+        cache_writes = [q['sql'] for q in queries if 'health_app_shared_cache' in q['sql'] and not q['sql'].startswith('SELECT')]
+        self.assertEqual(cache_writes, [])
+
+    def test_other_errors_and_the_time_budget_stop_retries(self):
+        with mock.patch(self.CHAT_COMPLETION, side_effect=ValueError("bad request")) as chat_completion:
+            self.assertTrue(generate_risk_assessment_for_record(self.make_record(glucose=150)).startswith("Error:"))
+        self.assertEqual(chat_completion.call_count, 1)
+
+        # A second attempt could run for AI_INFERENCE_TIMEOUT, which doesn't fit in the budget.
+        with override_settings(AI_INFERENCE_TIMEOUT=10, AI_INFERENCE_BUDGET=5), \
+                mock.patch(self.CHAT_COMPLETION, side_effect=ConnectionError("down")) as chat_completion:
+            generate_risk_assessment_for_record(self.make_record("P002", glucose=150))
+        self.assertEqual(chat_completion.call_count, 1)
+
+    def test_stub_times_out_like_a_slow_provider(self):
+        with override_settings(AI_STUB_LATENCY=5, AI_INFERENCE_TIMEOUT=0.01, AI_RETRY_ATTEMPTS=2):
+            report = generate_risk_assessment_for_record(self.make_record(glucose=150))
+        self.assertIn("timed out", report)
+
+    @override_settings(AI_BREAKER_FAILURE_THRESHOLD=2, AI_RETRY_ATTEMPTS=1, AI_BREAKER_RESET_TIMEOUT=60)
+    def test_open_circuit_fails_fast_and_defers_jobs(self):
+        with mock.patch(self.CHAT_COMPLETION, side_effect=ConnectionError("down")) as chat_completion:
+            for identifier in ("P001", "P002"):
+                generate_risk_assessment_for_record(self.make_record(identifier, glucose=150))
+            record = self.make_record("P003", glucose=150)
+            with self.assertRaises(resilience.InferenceUnavailable):
+                generate_risk_assessment_for_record(record)
+        self.assertEqual(chat_completion.call_count, 2)
+        self.assertEqual(resilience.inference_breaker().state(), resilience.CircuitBreaker.OPEN)
+
+        # Queued jobs wait instead of failing, and the admin sees why.
+        job = enqueue_analysis(record)
+        self.assertEqual(run_pending_jobs(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.Status.QUEUED)
+        self.assertContains(self.client.get(reverse('admin_dashboard')), "analyses are paused")
+
+        # The live view doesn't wait for the provider either; it queues the analysis.
+        other = self.make_record("P004", glucose=150)
+        body = b"".join(self.client.post(reverse('analyze_record_live', kwargs={'pk': other.pk})).streaming_content).decode()
+        self.assertIn("has been queued instead", body)
+        self.assertTrue(AnalysisJob.objects.filter(patient_record=other, status=AnalysisJob.Status.QUEUED).exists())
+
+        # After the reset timeout one trial call goes through; its success closes the circuit.
+        with mock.patch('health_app.resilience.time.time', return_value=time.time() + 61):
+            self.assertEqual(resilience.inference_breaker().state(), resilience.CircuitBreaker.HALF_OPEN)
+            self.assertEqual(run_pending_jobs(), 2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.Status.DONE)
+        self.assertEqual(resilience.inference_breaker().state(), resilience.CircuitBreaker.CLOSED)
+
+    @override_settings(AI_BREAKER_FAILURE_THRESHOLD=1, AI_RETRY_ATTEMPTS=1)
+    def test_rejected_trial_call_leaves_the_circuit_half_open(self):
+        with mock.patch(self.CHAT_COMPLETION, side_effect=ConnectionError("down")):
+            generate_risk_assessment_for_record(self.make_record(glucose=150))
+
+        breaker = resilience.inference_breaker()
+        with mock.patch('health_app.resilience.time.time', return_value=time.time() + 61), \
+                mock.patch(self.CHAT_COMPLETION, side_effect=ValueError("bad request")):
+            self.assertTrue(generate_risk_assessment_for_record(self.make_record("P002", glucose=150)).startswith("Error:"))
+            # A rejected request says nothing about the provider: no recovery, and the next caller gets the trial.
+            self.assertEqual(breaker.state(), resilience.CircuitBreaker.HALF_OPEN)
+            self.assertTrue(breaker.allow())
+
+    @override_settings(AI_BREAKER_FAILURE_THRESHOLD=1, AI_RETRY_ATTEMPTS=1, METRICS_TOKEN='scrape-token')
+    def test_breaker_state_is_exported(self):
+        with mock.patch(self.CHAT_COMPLETION, side_effect=ConnectionError("down")):
+            generate_risk_assessment_for_record(self.make_record(glucose=150))
+
+        body = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-token').content.decode()
+        self.assertIn('health_inference_circuit_state{breaker="inference:stub",state="open"} 1.0', body)
+
+
+class BatchedPromptTests(HospitalTestMixin, TestCase):
+    CHAT_COMPLETION = "health_app.inference.StubInferenceClient.chat_completion"
+
+    def test_one_call_for_a_batch_split_into_reports(self):
+        records = [self.make_record(f"P{i:03}", glucose=130 + i) for i in range(3)]
+        normal = self.make_record("P100", glucose=90)
+        stub = StubInferenceClient()
+        with mock.patch(self.CHAT_COMPLETION, side_effect=stub.chat_completion) as chat_completion:
+            reports = generate_risk_assessments_for_records(records + [normal], batch_size=3)
+
+        self.assertEqual(chat_completion.call_count, 1)
+        prompt = chat_completion.call_args.kwargs['messages'][0]['content']
+        self.assertIn("=== PATIENT 3 ===", prompt)
+        self.assertNotIn("P001", prompt)  # Identifiers aren't sent
+        self.assertEqual(reports[normal.pk], templated_normal_report(evaluate_record(normal)))
+        batched = [reports[record.pk] for record in records]
+        self.assertTrue(all(report.startswith("### Overall Risk Summary") for report in batched))
+        self.assertEqual(len(set(batched)), 3)
+        self.assertNotIn("=== REPORT", "".join(batched))
+        # Stored per record, so a single analysis of the same panel is a cache hit.
+        with mock.patch(self.CHAT_COMPLETION) as chat_completion:
+            self.assertEqual(generate_risk_assessment_for_record(records[1]), reports[records[1].pk])
+        chat_completion.assert_not_called()
+
+    def test_unsplittable_reports_fall_back_to_single_calls(self):
+        records = [self.make_record(f"P{i:03}", glucose=130 + i) for i in range(3)]
+        chat = StubInferenceClient().chat_completion
+
+        def drop_second_report(messages, **kwargs):
+            response = chat(messages, **kwargs)
+            content = response.choices[0].message.content
+            if "=== REPORT 2 ===" in content:
+                start, end = content.index("=== REPORT 2 ==="), content.index("=== REPORT 3 ===")
+                response.choices[0].message.content = content[:start] + "=== REPORT 2 ===\nI cannot help.\n\n" + content[end:]
+            return response
+
+        with mock.patch(self.CHAT_COMPLETION, side_effect=drop_second_report) as chat_completion:
+            reports = generate_risk_assessments_for_records(records, batch_size=3)
+
+        self.assertEqual(chat_completion.call_count, 2)
+        self.assertNotIn("=== PATIENT", chat_completion.call_args.kwargs['messages'][0]['content'])
+        self.assertTrue(all(report.startswith("### Overall Risk Summary") for report in reports.values()))
+
+    @override_settings(AI_RETRY_ATTEMPTS=2, AI_BATCH_MAX_TOKENS=1000)
+    def test_failing_provider_is_not_called_once_per_record(self):
+        records = [self.make_record(f"P{i:03}", glucose=130 + i) for i in range(3)]
+        with mock.patch(self.CHAT_COMPLETION, side_effect=ConnectionError("down")) as chat_completion:
+            reports = generate_risk_assessments_for_records(records, batch_size=3)
+
+        # The batch call and its retry, but no single calls after them.
+        self.assertEqual(chat_completion.call_count, 2)
+        self.assertEqual(chat_completion.call_args.kwargs['max_tokens'], 1000)
+        self.assertTrue(all(report.startswith("Error:") for report in reports.values()))
+
+    @override_settings(AI_BATCH_PROMPT_SIZE=4, CACHES=IN_MEMORY_CACHES)  # Worker threads, see BulkAnalysisTests
+    def test_worker_batches_jobs(self):
+        for i in range(5):
+            enqueue_analysis(self.make_record(f"P{i:03}", glucose=130 + i))
+        stub = StubInferenceClient()
+        with mock.patch(self.CHAT_COMPLETION, side_effect=stub.chat_completion) as chat_completion:
+            self.assertEqual(run_pending_jobs(concurrency=2), 5)
+
+        self.assertEqual(chat_completion.call_count, 2)  # A batch of 4 and a single record
+        self.assertEqual(RiskAssessment.objects.count(), 5)
+        self.assertFalse(AnalysisJob.objects.exclude(status=AnalysisJob.Status.DONE).exists())
+
+    @override_settings(AI_BATCH_PROMPT_SIZE=8, CACHES=IN_MEMORY_CACHES)  # Worker threads, see BulkAnalysisTests
+    def test_worker_command_claims_full_batches(self):
+        for i in range(8):
+            enqueue_analysis(self.make_record(f"P{i:03}", glucose=130 + i))
+        stub = StubInferenceClient()
+        with mock.patch(self.CHAT_COMPLETION, side_effect=stub.chat_completion) as chat_completion:
+            call_command('run_analysis_worker', once=True, concurrency=1, stdout=io.StringIO())
+
+        self.assertEqual(chat_completion.call_count, 1)
+        self.assertFalse(AnalysisJob.objects.exclude(status=AnalysisJob.Status.DONE).exists())
+
+
+class PromptBudgetTests(HospitalTestMixin, TestCase):
+    CHAT_COMPLETION = "health_app.inference.StubInferenceClient.chat_completion"
+
+    @override_settings(AI_MAX_TOKENS=1000, AI_MAX_TOKENS_BASE=500, AI_MAX_TOKENS_PER_FINDING=200)
+    def test_prompt_and_budget_cover_only_present_markers(self):
+        record = self.make_record(glucose=150, hdl=55)
+        chat = StubInferenceClient().chat_completion
+        with mock.patch(self.CHAT_COMPLETION, side_effect=chat) as chat_completion:
+            generate_risk_assessment_for_record(record)
+
+        prompt = chat_completion.call_args.kwargs['messages'][0]['content']
+        self.assertIn("- Glucose: 150 mg/dL", prompt)
+        self.assertIn("**HDL:** Low if < 40 mg/dL", prompt)
+        self.assertNotIn("None", prompt)
+        self.assertNotIn("**LDL:**", prompt)
+        self.assertEqual(chat_completion.call_args.kwargs['max_tokens'], 700)
+
+        # Capped at AI_MAX_TOKENS however many markers are abnormal.
+        many = self.make_record("P002", glucose=150, ldl=200, crp=12)
+        self.assertEqual(max_tokens_for(evaluate_record(many)), 1000)
+
+    def test_reports_record_their_prompt_version(self):
+        abnormal, normal = self.make_record(glucose=150), self.make_record("P002", glucose=90)
+        for record in (abnormal, normal):
+            enqueue_analysis(record)
+        run_pending_jobs()
+
+        self.assertEqual(abnormal.assessment.prompt_version, PROMPT_VERSION)
+        self.assertIsNone(normal.assessment.prompt_version)
+
+    def test_token_benchmark(self):
+        out = io.StringIO()
+        call_command('benchmark_prompt_tokens', records=50, batch_size=4, stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['corpus']['records'], 50)
+        self.assertLessEqual(report['max_tokens']['max'], 2048)
+        self.assertLess(report['batched']['prompt_tokens_per_report'], report['prompt_tokens']['mean'])
+
+
+# The URLconf of an ASGI worker (ASYNC_VIEWS), for AsyncViewTests: the async analysis
+# views come first, so they win over the sync ones of health_app.urls.
+urlpatterns = [
+    path('patient/<int:pk>/analyze/', views.AsyncAnalyzePatientRecordView.as_view(), name='analyze_record'),
+    path('patient/<int:pk>/analyze/live/', views.AsyncLiveAnalyzeView.as_view(), name='analyze_record_live'),
+    path('', include('health_app.urls')),
+]
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncViewTests(HospitalTestMixin, TestCase):
+    CHAT_COMPLETION = "health_app.inference.StubInferenceClient.chat_completion"
+
+    async def read_body(self, response):
+        return b"".join([part async for part in response.streaming_content]).decode()
+
+    async def test_live_analysis_streams_from_the_async_client(self):
+        record = await sync_to_async(self.make_record)(glucose=150)
+        await self.async_client.aforce_login(self.admin)
+        url = reverse('analyze_record_live', kwargs={'pk': record.pk})
+
+        response = await self.async_client.get(url)
+        self.assertContains(response, 'id="report-stream"')
+        with mock.patch(self.CHAT_COMPLETION, side_effect=AssertionError("the sync client was called")):
+            response = await self.async_client.post(url)
+            body = await self.read_body(response)
+
+        self.assertTrue(response.is_async)
+        self.assertGreater(body.count("event: delta"), 10)
+        self.assertIn("event: done", body)
+        assessment = await RiskAssessment.objects.aget(patient_record=record)
+        self.assertTrue(assessment.ai_generated_report.startswith("### Overall Risk Summary\nStub assessment"))
+        self.assertEqual(assessment.prompt_version, PROMPT_VERSION)
+        self.assertIn("inference;dur=", response['Server-Timing'])
+
+        response = await self.async_client.post(url)
+        self.assertEqual(response.status_code, 409)
+
+    @override_settings(ASYNC_VIEWS=True)
+    async def test_export_is_streamed_not_buffered(self):
+        record = await sync_to_async(self.make_record)(glucose=150)
+        await RiskAssessment.objects.acreate(
+            patient_record=record, ai_generated_report="Report", status=RiskAssessment.Status.REVIEWED, reviewed_at=timezone.now(),
+        )
+        await self.async_client.aforce_login(self.admin)
+
+        response = await self.async_client.get(reverse('export_reports_csv'))
+
+        # A sync iterator would have been read into a list before the response was sent.
+        self.assertTrue(response.is_async)
+        body = await self.read_body(response)
+        self.assertTrue(body.startswith("Patient Identifier,"), body)
+        self.assertIn(record.patient_identifier, body)
+
+    async def test_analyze_queues_and_checks_the_user(self):
+        record = await sync_to_async(self.make_record)(glucose=150)
+        url = reverse('analyze_record', kwargs={'pk': record.pk})
+
+        response = await self.async_client.post(url)
+        self.assertRedirects(response, f"{reverse('login')}?next={url}", fetch_redirect_response=False)
+        await self.async_client.aforce_login(self.doctor)
+        self.assertEqual((await self.async_client.post(url)).status_code, 403)
+
+        await self.async_client.aforce_login(self.admin)
+        response = await self.async_client.post(url)
+        self.assertRedirects(response, reverse('admin_dashboard'), fetch_redirect_response=False)
+        self.assertTrue(await AnalysisJob.objects.filter(patient_record=record, status=AnalysisJob.Status.QUEUED).aexists())
+
+    @override_settings(AI_BREAKER_FAILURE_THRESHOLD=1, AI_RETRY_ATTEMPTS=1)
+    def test_async_http_backend_and_open_circuit(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(StubInferenceClient(latency=0, token_latency=0)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        async def events(record):
+            try:
+                return [event async for event in astream_risk_assessment_for_record(record)]
+            finally:
+                await get_async_inference_client().aclose()  # Its event loop ends here
+
+        with override_settings(AI_INFERENCE_BACKEND='http', AI_INFERENCE_URL=f'http://127.0.0.1:{server.server_port}/v1'):
+            streamed = async_to_sync(events)(self.make_record(glucose=150))
+        self.assertEqual(streamed[-1][0], 'done')
+        self.assertTrue(streamed[-1][1].startswith("### Overall Risk Summary"))
+
+        # Nothing listens on port 9: the call fails, which opens the circuit for the next one.
+        with override_settings(AI_INFERENCE_BACKEND='http', AI_INFERENCE_URL='http://127.0.0.1:9/v1'):
+            self.assertEqual(async_to_sync(events)(self.make_record("P002", glucose=160))[-1][0], 'error')
+            with self.assertRaises(resilience.InferenceUnavailable):
+                async_to_sync(events)(self.make_record("P003", glucose=170))
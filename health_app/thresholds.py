@@ -0,0 +1,209 @@
+# health_app/thresholds.py
+"""
+The clinical risk thresholds as data.
+
+`MARKERS` is the single source of truth for the thresholds that used to live as
+prose inside the prompt. It is used to:
+- flag markers for a single record in Python (`evaluate_record`),
+- flag a whole queryset in one SQL query (`annotate_risk`),
+- write the thresholds and pre-computed findings into the prompt,
+- build the templated report for all-normal panels, which needs no LLM call,
+- precompute each record's `risk_flags` bitmask for cohort searches.
+"""
+import operator
+from typing import NamedTuple
+
+from functools import reduce
+
+from django.db.models import Case, IntegerField, Q, Value, When
+
+
+class MarkerRule(NamedTuple):
+    label: str         # e.g. "High", "Pre-diabetes"
+    operator: str      # one of '>', '>=', '<', '<='
+    threshold: float
+    severity: int      # contribution of this finding to the record's risk level
+
+
+class Marker(NamedTuple):
+    field: str         # PatientRecord field name
+    name: str          # display name
+    unit: str
+    risks: str         # conditions an abnormal value indicates
+    rules: tuple       # MarkerRule entries, most severe first; the first match wins
+
+
+class Finding(NamedTuple):
+    marker: Marker
+    value: float
+    rule: MarkerRule
+
+
+class Evaluation(NamedTuple):
+    findings: list     # Finding for each abnormal marker
+    normal: list       # Marker entries whose value is within range
+    missing: list      # Marker entries with no value
+    risk_level: int    # sum of the severities of all findings; 0 means all-normal
+
+
+MARKERS = (
+    Marker('glucose', 'Glucose', 'mg/dL', 'Type 2 Diabetes, Metabolic Syndrome',
+           (MarkerRule('High', '>=', 126, 2),)),
+    Marker('hba1c', 'HbA1c', '%', 'Type 2 Diabetes',
+           (MarkerRule('Diabetes', '>=', 6.5, 2), MarkerRule('Pre-diabetes', '>=', 5.7, 1))),
+    Marker('total_cholesterol', 'Total Cholesterol', 'mg/dL', 'Cardiovascular Disease',
+           (MarkerRule('High', '>', 200, 2),)),
+    Marker('ldl', 'LDL', 'mg/dL', 'Heart disease, Stroke',
+           (MarkerRule('High', '>', 130, 2),)),
+    Marker('hdl', 'HDL', 'mg/dL', 'Cardiovascular Disease (low HDL increases CVD risk)',
+           (MarkerRule('Low', '<', 40, 2),)),
+    Marker('triglycerides', 'Triglycerides', 'mg/dL', 'Cardiovascular Disease, Pancreatitis',
+           (MarkerRule('High', '>', 150, 2),)),
+    Marker('alt', 'ALT', 'U/L', 'Liver disease, Fatty liver, Cirrhosis',
+           (MarkerRule('High', '>', 40, 2),)),
+    Marker('ast', 'AST', 'U/L', 'Liver disease, Fatty liver, Cirrhosis',
+           (MarkerRule('High', '>', 35, 2),)),
+    Marker('creatinine', 'Creatinine', 'mg/dL', 'Kidney disease',
+           (MarkerRule('High', '>', 1.3, 2),)),
+    Marker('urea', 'Urea', 'mg/dL', 'Kidney disease',
+           (MarkerRule('High', '>', 50, 2),)),
+    Marker('crp', 'CRP', 'mg/L', 'Chronic inflammation, Cardiovascular Disease, Cancer',
+           (MarkerRule('High risk', '>', 3, 2),)),
+    Marker('wbc', 'WBC', 'x10^9/L', 'Chronic infections, Inflammation, Cancer',
+           (MarkerRule('High', '>', 11, 2),)),
+)
+
+MARKER_FIELDS = [marker.field for marker in MARKERS]
+
+_OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+_LOOKUPS = {'>': 'gt', '>=': 'gte', '<': 'lt', '<=': 'lte'}
+
+
+def match_rule(marker, value):
+    """Returns the first (most severe) rule the value triggers, or None if it is normal or missing."""
+    if value is None:
+        return None
+    for rule in marker.rules:
+        if _OPERATORS[rule.operator](value, rule.threshold):
+            return rule
+    return None
+
+
+def evaluate_record(patient_record):
+    """Flags every marker of a single record against the rule table."""
+    findings, normal, missing = [], [], []
+    for marker in MARKERS:
+        value = getattr(patient_record, marker.field)
+        if value is None:
+            missing.append(marker)
+            continue
+        rule = match_rule(marker, value)
+        if rule:
+            findings.append(Finding(marker, value, rule))
+        else:
+            normal.append(marker)
+    return Evaluation(findings, normal, missing, sum(f.rule.severity for f in findings))
+
+
+def flag_expression(marker):
+    """A SQL CASE expression giving the severity (0 if normal or missing) of one marker."""
+    whens = [
+        When(**{f"{marker.field}__{_LOOKUPS[rule.operator]}": rule.threshold}, then=Value(rule.severity))
+        for rule in marker.rules
+    ]
+    return Case(*whens, default=Value(0), output_field=IntegerField())
+
+
+def annotate_risk(queryset):
+    """
+    Scores a whole PatientRecord queryset in the database.
+    Adds a `flag_<field>` severity for each marker plus their sum as `risk_level`,
+    so thousands of records are evaluated by a single query.
+    """
+    flags = {f"flag_{marker.field}": flag_expression(marker) for marker in MARKERS}
+    risk_level = sum((flag_expression(marker) for marker in MARKERS[1:]), flag_expression(MARKERS[0]))
+    return queryset.annotate(**flags, risk_level=risk_level)
+
+
+def marker_bit(field):
+    """The bit of a marker in PatientRecord.risk_flags, by its position in MARKERS."""
+    return 1 << MARKER_FIELDS.index(field)
+
+
+def risk_flags(patient_record):
+    """The bitmask of the record's abnormal markers (any rule matched), computed in Python."""
+    return sum(
+        1 << i for i, marker in enumerate(MARKERS)
+        if match_rule(marker, getattr(patient_record, marker.field)) is not None
+    )
+
+
+def risk_flags_expression():
+    """The same bitmask as a SQL expression, to recompute `risk_flags` for a queryset in one UPDATE."""
+    bits = []
+    for i, marker in enumerate(MARKERS):
+        abnormal = reduce(lambda a, b: a | b, (
+            Q(**{f"{marker.field}__{_LOOKUPS[rule.operator]}": rule.threshold}) for rule in marker.rules
+        ))
+        bits.append(Case(When(abnormal, then=Value(1 << i)), default=Value(0), output_field=IntegerField()))
+    return sum(bits[1:], bits[0])
+
+
+def describe_rule(marker, rule):
+    return f"{rule.label} if {rule.operator} {rule.threshold:g} {marker.unit}"
+
+
+def present_markers(evaluation):
+    """The markers the record has a value for, in MARKERS order."""
+    return [marker for marker in MARKERS if marker not in evaluation.missing]
+
+
+def thresholds_for_prompt(markers=MARKERS):
+    """The RISK THRESHOLDS block of the prompt for `markers` (all of them by default), generated from the rule table."""
+    lines = []
+    for marker in markers:
+        rules = ", ".join(describe_rule(marker, rule) for rule in marker.rules)
+        lines.append(f"- **{marker.name}:** {rules} (Indicates risk for {marker.risks}).")
+    return "\n    ".join(lines)
+
+
+def findings_for_prompt(evaluation):
+    """The pre-computed findings for one record, so the model only has to write the narrative."""
+    lines = [
+        f"- {f.marker.name}: {f.value:g} {f.marker.unit} - {f.rule.label.upper()} "
+        f"(threshold {f.rule.operator} {f.rule.threshold:g} {f.marker.unit}; risk for {f.marker.risks})"
+        for f in evaluation.findings
+    ]
+    if evaluation.normal:
+        lines.append("- Within normal range: " + ", ".join(m.name for m in evaluation.normal))
+    lines.append(f"- Computed risk level: {evaluation.risk_level}")
+    return "\n    ".join(lines)
+
+
+def templated_normal_report(evaluation):
+    """The report for a record with no abnormal markers. Follows the same sections as the AI report."""
+    missing_names = ", ".join(m.name for m in evaluation.missing)
+
+    if not evaluation.normal:
+        summary = "No marker values were provided for this patient, so no risk could be assessed."
+        concerns = "- No marker values were provided."
+    else:
+        summary = (
+            "All provided markers are within the normal range defined by the risk thresholds. "
+            "No elevated risk was identified from this blood panel."
+        )
+        concerns = "- All markers are within the normal range."
+
+    recommendations = ["- No follow-up is indicated by these results; continue routine screening as appropriate."]
+    if evaluation.missing:
+        concerns += f"\n- Not provided: {missing_names}."
+        recommendations.append(f"- Consider obtaining the missing markers ({missing_names}) for a complete assessment.")
+
+    return (
+        "### Overall Risk Summary\n"
+        f"{summary}\n\n"
+        "### Markers of Concern\n"
+        f"{concerns}\n\n"
+        "### Recommendations for Reviewer\n"
+        + "\n".join(recommendations)
+    )
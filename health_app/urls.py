@@ -1,8 +1,16 @@
 # health_app/urls.py
+from django.conf import settings
 from django.urls import path
 from django.contrib.auth.views import LogoutView
 from . import views
 
+# An ASGI worker (ASYNC_VIEWS) serves the analysis endpoints with async views; a WSGI
+# worker keeps the sync ones, whose streams it can send without buffering them.
+if settings.ASYNC_VIEWS:
+    analyze_view, analyze_live_view = views.AsyncAnalyzePatientRecordView, views.AsyncLiveAnalyzeView
+else:
+    analyze_view, analyze_live_view = views.AnalyzePatientRecordView, views.LiveAnalyzeView
+
 urlpatterns = [
 
     path('', views.CustomLoginView.as_view(), name='home'),
@@ -14,16 +22,24 @@ urlpatterns = [
     # Dashboards
     path('dashboard/', views.DashboardRedirectView.as_view(), name='dashboard_redirect'),
     path('manage/dashboard/', views.AdminDashboardView.as_view(), name='admin_dashboard'),
+    path('manage/analytics/', views.AnalyticsDashboardView.as_view(), name='analytics_dashboard'),
     path('doctor/dashboard/', views.DoctorDashboardView.as_view(), name='doctor_dashboard'),
     path('manage/upload-csv/', views.UploadCSVView.as_view(), name='upload_csv'),
+    path('manage/uploads/<int:pk>/progress/', views.UploadJobProgressView.as_view(), name='upload_job_progress'),
     path('manage/add-patient/', views.AddPatientView.as_view(), name='add_patient'),
     path('patients/', views.PatientListView.as_view(), name='patient_list'),
     path('patients/<int:pk>/delete/', views.DeletePatientView.as_view(), name='delete_patient'),
-    path('patient/<int:pk>/analyze/', views.AnalyzePatientRecordView.as_view(), name='analyze_record'),
+    path('patient/<int:pk>/analyze/', analyze_view.as_view(), name='analyze_record'),
+    path('patient/<int:pk>/analyze/live/', analyze_live_view.as_view(), name='analyze_record_live'),
+    path('patients/analyze/', views.BulkAnalyzeView.as_view(), name='bulk_analyze'),
+    path('jobs/<int:pk>/status/', views.AnalysisJobStatusView.as_view(), name='analysis_job_status'),
     path('assessment/<int:pk>/', views.AssessmentDetailView.as_view(), name='view_assessment'),
     path('manage/export-reports/', views.export_reviewed_reports_csv, name='export_reports_csv'),
     path('assessment/<int:pk>/assign/', views.AssignDoctorView.as_view(), name='assign_doctor'),
 
     # Admin Actions
     path('manage/invite-doctor/', views.InviteDoctorView.as_view(), name='invite_doctor'),
+
+    # Monitoring
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
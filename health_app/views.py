@@ -1,29 +1,49 @@
 # health_app/views.py
-import csv
-import io
+import json
 import random
 import string
-import markdown
-from django.http import HttpResponse
+from itertools import islice
+from datetime import datetime, timezone as dt_timezone
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
-from django.shortcuts import get_object_or_404
+from django.shortcuts import aget_object_or_404, get_object_or_404
+from django.urls import reverse
 from django.views.generic import ListView,DetailView
 from django.shortcuts import render, redirect
 from django.views import View
+from asgiref.sync import sync_to_async
 from django.contrib import messages
 from django.contrib.auth import login
-from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.contrib.auth.mixins import AccessMixin, LoginRequiredMixin, UserPassesTestMixin
+from django.contrib.auth.views import redirect_to_login
+from django.core.exceptions import PermissionDenied
 from django.contrib.auth.views import LoginView
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Case, Exists, IntegerField, OuterRef, Q, Value, When
 
 
-from .models import User, Hospital, PatientRecord,RiskAssessment
-from .services import generate_risk_assessment_for_record
+from . import metrics
+from .models import User, Hospital, PatientRecord,RiskAssessment, AnalysisJob, UploadJob
+from .analytics import backlog_age, marker_stats, review_throughput
+from .exports import (
+    EXPORT_FORMATS, InvalidCursor, bound_to_watermark, decode_cursor, iter_export_rows, parse_since,
+    reviewed_assessments
+)
+from .jobs import assess_normal_records, enqueue_analysis, enqueue_bulk_analysis, enqueue_upload
+from .resilience import InferenceUnavailable, inference_breaker
+from .pagination import KeysetPaginationMixin
+from .roster import find_doctor, get_doctor_roster
+from .services import (
+    astream_risk_assessment_for_record, generate_risk_assessment_for_record, report_prompt_version,
+    stream_risk_assessment_for_record
+)
+from .thresholds import evaluate_record, templated_normal_report
 from .forms import (
     HospitalRegistrationForm, DoctorInvitationForm, CSVUploadForm,
-    ManualPatientForm,DoctorReviewForm
+    ManualPatientForm,DoctorReviewForm, PatientSearchForm
 )
 
 # --- Role Checking Mixins for Security ---
@@ -35,6 +55,20 @@ class DoctorRequiredMixin(LoginRequiredMixin, UserPassesTestMixin):
     def test_func(self):
         return self.request.user.role == User.Role.DOCTOR
 
+class AsyncAdminRequiredMixin(AccessMixin):
+    """
+    AdminRequiredMixin for async views. The user is loaded with `auser()`; reading
+    `request.user` would query the database synchronously, which async code may not do.
+    """
+    async def dispatch(self, request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path(), self.get_login_url(), self.get_redirect_field_name())
+        if user.role != User.Role.HOSPITAL_ADMIN:
+            raise PermissionDenied(self.get_permission_denied_message())
+        request.user = user  # Loaded now, so the view can read it
+        return await super().dispatch(request, *args, **kwargs)
+
 # --- Registration and Login ---
 class HospitalRegistrationView(View):
     def get(self, request):
@@ -84,6 +118,9 @@ class DashboardRedirectView(LoginRequiredMixin, View):
 
 
 class AdminDashboardView(AdminRequiredMixin, View):
+    # At most this many freshly imported records are listed for verification.
+    VERIFICATION_LIMIT = 100
+
     def get(self, request):
         newly_uploaded_ids = request.session.get('newly_uploaded_ids', [])
         new_records = []
@@ -91,14 +128,63 @@ class AdminDashboardView(AdminRequiredMixin, View):
             new_records = PatientRecord.objects.filter(pk__in=newly_uploaded_ids)
             # Clear the session variable after use
             del request.session['newly_uploaded_ids']
-        context = {'new_records': new_records}
+
+        # A CSV import started from this session: show its progress until it finishes,
+        # then its records (for verification) or its errors, once.
+        upload_job = None
+        new_records_total = len(newly_uploaded_ids)
+        upload_job_id = request.session.get('upload_job_id')
+        if upload_job_id:
+            upload_job = UploadJob.objects.filter(pk=upload_job_id, hospital=request.user.hospital).first()
+            if upload_job is None or not upload_job.is_active:
+                del request.session['upload_job_id']
+            if upload_job and upload_job.status == UploadJob.Status.DONE:
+                new_records_total = upload_job.rows_inserted
+                new_records = upload_job.records.order_by('pk')[:self.VERIFICATION_LIMIT]
+
+        # Set while the circuit breaker holds back AI analyses after repeated provider failures.
+        ai_retry_at = inference_breaker().retry_at()
+
+        context = {
+            'new_records': new_records,
+            'new_records_total': new_records_total,
+            'upload_job': upload_job,
+            'doctor_count': len(get_doctor_roster(request.user.hospital_id)),
+            'ai_paused_until': datetime.fromtimestamp(ai_retry_at, tz=dt_timezone.utc) if ai_retry_at else None,
+        }
         return render(request, 'health_app/admin_dashboard.html', context)
 
-class DoctorDashboardView(DoctorRequiredMixin, ListView):
+
+class AnalyticsDashboardView(AdminRequiredMixin, View):
+    """
+    Marker distributions, review throughput and backlog age for the admin's hospital.
+    Reads only the incrementally maintained summary tables (see analytics.py), never the
+    patient records or assessments themselves, so the cost doesn't grow with the hospital.
+    """
+    THROUGHPUT_DAYS = 30
+
+    def get(self, request):
+        hospital_id = request.user.hospital_id
+        doctor_names = {doctor.id: doctor.full_name for doctor in get_doctor_roster(hospital_id)}
+        throughput = [
+            (doctor_names.get(row.doctor_id, "Former staff"), row)
+            for row in review_throughput(hospital_id, days=self.THROUGHPUT_DAYS)
+        ]
+        context = {
+            'marker_stats': marker_stats(hospital_id),
+            'throughput': throughput,
+            'throughput_days': self.THROUGHPUT_DAYS,
+            'backlog': backlog_age(hospital_id),
+        }
+        return render(request, 'health_app/analytics_dashboard.html', context)
+
+class DoctorDashboardView(DoctorRequiredMixin, KeysetPaginationMixin, ListView):
     model = RiskAssessment
     template_name = 'health_app/doctor_dashboard.html'
     context_object_name = 'pending_assessments'
     paginate_by = 10
+    # Assigned first, then newest unassigned; 'pk' breaks ties so every row has a unique position.
+    keyset_ordering = ['is_unassigned', '-patient_record__created_at', '-pk']
 
     def get_queryset(self):
         """
@@ -117,11 +203,15 @@ class DoctorDashboardView(DoctorRequiredMixin, ListView):
         queryset = RiskAssessment.objects.filter(
             (assigned_to_me | unassigned_in_my_hospital),  # The core logic
             status=RiskAssessment.Status.PENDING_REVIEW,
-            patient_record__hospital=user.hospital
+            patient_record__hospital_id=user.hospital_id
         ).select_related(
             'patient_record',
             'assigned_doctor'
-        ).order_by('assigned_doctor', '-patient_record__created_at') # Show assigned first, then newest unassigned
+        ).annotate(
+            # Show assigned first, then newest unassigned. A 0/1 flag rather than ordering on the
+            # nullable assigned_doctor column, so it can be part of the pagination key.
+            is_unassigned=Case(When(assigned_doctor__isnull=True, then=Value(1)), default=Value(0), output_field=IntegerField())
+        )
 
         return queryset
 
@@ -184,73 +274,50 @@ class UploadCSVView(AdminRequiredMixin, View):
         if not form.is_valid():
             return render(request, 'health_app/upload_csv.html', {'form': form})
 
-        csv_file = request.FILES['csv_file']
-        try:
-            decoded_file = csv_file.read().decode('utf-8')
-            io_string = io.StringIO(decoded_file)
-            reader = csv.DictReader(io_string)
-            rows = list(reader)
-            if not rows:
-                raise ValueError("The CSV file is empty.")
-        except Exception:
-            messages.error(request, "Error reading file. Ensure it is a valid UTF-8 encoded CSV.")
-            return render(request, 'health_app/upload_csv.html', {'form': form})
-
-        new_record_ids = []
-        try:
-            with transaction.atomic():
-                # --- START OF ROBUST UNIQUENESS CHECKS ---
-                # 1. Get all patient identifiers from the CSV, checking for missing values.
-                csv_identifiers = []
-                for i, row in enumerate(rows):
-                    identifier = row.get('patient_identifier')
-                    if not identifier or not identifier.strip():
-                        raise ValueError(f"Row {i+2} is missing a patient_identifier.")
-                    csv_identifiers.append(identifier.strip())
-
-                # 2. Check for duplicates WITHIN the CSV file itself.
-                if len(csv_identifiers) != len(set(csv_identifiers)):
-                    raise ValueError("The CSV file contains duplicate patient identifiers. Please correct the file.")
-
-                # 3. Check for duplicates against the DATABASE.
-                existing_identifiers_in_db = set(PatientRecord.objects.filter(
-                    hospital=request.user.hospital,
-                    patient_identifier__in=csv_identifiers
-                ).values_list('patient_identifier', flat=True))
-
-                conflicting_ids = set(csv_identifiers).intersection(existing_identifiers_in_db)
-                if conflicting_ids:
-                    raise ValueError(f"The following patient identifiers already exist in your hospital: {', '.join(conflicting_ids)}")
-                # --- END OF ROBUST UNIQUENESS CHECKS ---
-
-                for row in rows:
-                    patient_identifier_val = row.pop('patient_identifier', None).strip()
-                    cleaned_row = {k.lower().strip(): (float(v) if v and v.strip() else None) for k, v in row.items()}
-                    cleaned_row['patient_identifier'] = patient_identifier_val
-
-                    new_record = PatientRecord.objects.create(
-                        hospital=request.user.hospital, uploaded_by=request.user,
-                        **cleaned_row # Use dictionary unpacking for cleaner code
-                    )
-                    new_record_ids.append(new_record.pk)
-
-        except (ValueError, TypeError) as e:
-            messages.error(request, f"Error processing file: {e}. The upload has been cancelled.")
-            return render(request, 'health_app/upload_csv.html', {'form': form})
-        except Exception as e:
-            messages.error(request, f"An unexpected error occurred: {e}. The upload has been cancelled.")
-            return render(request, 'health_app/upload_csv.html', {'form': form})
-
-        request.session['newly_uploaded_ids'] = new_record_ids
-        messages.success(request, f"Successfully uploaded and created {len(new_record_ids)} patient records for verification.")
+        # The file is spooled to disk and imported by the worker process, so a large
+        # upload can't hit the gunicorn timeout. The dashboard shows the import's progress.
+        job = enqueue_upload(
+            request.FILES['csv_file'], hospital=request.user.hospital, uploaded_by=request.user,
+            upsert=form.cleaned_data['upsert']
+        )
+        request.session['upload_job_id'] = job.pk
+        messages.success(request, f"'{job.original_name}' was uploaded. Your records are being imported.")
         return redirect('admin_dashboard')
 
+class UploadJobProgressView(AdminRequiredMixin, View):
+    """
+    Reports the progress of a CSV import as JSON, for polling from the admin dashboard.
+    """
+    def get(self, request, pk):
+        job = get_object_or_404(UploadJob, pk=pk)
+
+        # Security Check: Ensure the job belongs to the admin's hospital
+        if job.hospital_id != request.user.hospital_id:
+            return JsonResponse({'error': "You are not authorized to view this upload."}, status=403)
+
+        return JsonResponse({
+            'id': job.pk,
+            'file_name': job.original_name,
+            'status': job.status.lower(),
+            'rows_parsed': job.rows_parsed,
+            'rows_validated': job.rows_validated,
+            'rows_inserted': job.rows_inserted,
+            'rows_updated': job.rows_updated,
+            'rows_unchanged': job.rows_unchanged,
+            'upsert': job.upsert,
+            'error_count': job.error_count,
+            'errors': job.errors,
+            'created_at': job.created_at.isoformat(),
+            'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        })
+
 # --- Patient Management Views ---
-class PatientListView(LoginRequiredMixin, ListView):
+class PatientListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = PatientRecord
     template_name = 'health_app/patient_list.html'
     context_object_name = 'patients'
     paginate_by = 15 # Shows 15 patients per page
+    keyset_ordering = ['-created_at', '-pk']  # Newest first
 
     def get_queryset(self):
         """
@@ -260,8 +327,26 @@ class PatientListView(LoginRequiredMixin, ListView):
         user = self.request.user
         # Start with a base queryset
         queryset = super().get_queryset()
-        # Filter by the user's hospital
-        return queryset.filter(hospital=user.hospital).select_related('assessment').order_by('-created_at')
+        # Flag records that already have an analysis job waiting in the queue, in the same query.
+        active_jobs = AnalysisJob.objects.filter(
+            patient_record=OuterRef('pk'),
+            status__in=[AnalysisJob.Status.QUEUED, AnalysisJob.Status.RUNNING],
+        )
+        # Filter by the user's hospital. The row template shows the reviewer and the assigned
+        # doctor, so join them here rather than loading them row by row.
+        queryset = queryset.filter(hospital_id=user.hospital_id).select_related(
+            'assessment__reviewed_by', 'assessment__assigned_doctor'
+        ).annotate(
+            has_active_job=Exists(active_jobs)
+        )
+
+        # Optional cohort search (identifier prefix, abnormal markers, marker ranges).
+        self.search_form = PatientSearchForm(self.request.GET or None)
+        if self.search_form.is_bound:
+            if not self.search_form.is_valid():
+                return queryset.none()
+            queryset = self.search_form.filter(queryset)
+        return queryset
 
     def get_context_data(self, **kwargs):
         """
@@ -269,6 +354,10 @@ class PatientListView(LoginRequiredMixin, ListView):
         """
         context = super().get_context_data(**kwargs)
         context['page_title'] = "Patient Records"
+        context['search_form'] = self.search_form
+        # The "Assign" dropdown is rendered on every pending row; the roster comes from the cache.
+        if self.request.user.role == User.Role.HOSPITAL_ADMIN:
+            context['doctors'] = get_doctor_roster(self.request.user.hospital_id)
         return context
 
 # --- view for deleting records---
@@ -306,24 +395,246 @@ class AnalyzePatientRecordView(AdminRequiredMixin, View):
             messages.warning(request, f"An assessment for patient {patient_record.patient_identifier} already exists.")
             return redirect('admin_dashboard')
 
-        # 4. Call the AI Service
-        ai_report = generate_risk_assessment_for_record(patient_record)
+        # 4. All-normal panels get a templated report straight away; no LLM call is needed.
+        if evaluate_record(patient_record).risk_level == 0:
+            RiskAssessment.objects.create(
+                patient_record=patient_record,
+                ai_generated_report=generate_risk_assessment_for_record(patient_record)
+            )
+            messages.success(request, f"All markers for patient {patient_record.patient_identifier} are within the normal range. The report is now ready for doctor review.")
+            return redirect('admin_dashboard')
+
+        # 5. Queue the analysis. The AI call itself runs in the `run_analysis_worker`
+        # process, so this request returns immediately instead of holding a web worker.
+        job = enqueue_analysis(patient_record, requested_by=request.user)
+
+        messages.success(request, f"AI analysis for patient {patient_record.patient_identifier} has been queued (job #{job.pk}). The report will be ready for doctor review shortly.")
+        return redirect('admin_dashboard')
+
+def _sse_event(event, data):
+    """Formats one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _queued_instead_message(job):
+    return (
+        f"The AI service is temporarily unavailable. The analysis has been queued instead (job #{job.pk}) "
+        "and the report will be ready for doctor review once the service recovers."
+    )
+
+def _streaming_sse_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop reverse proxies from buffering the stream
+    return response
+
+def _streaming_content(iterator, chunk_size=100):
+    """
+    The body of a sync view's StreamingHttpResponse. Under ASGI (ASYNC_VIEWS) Django reads
+    a sync iterator into a list before sending any of it, so there it is handed over as an
+    async iterator that reads `chunk_size` items at a time in the request's thread.
+    """
+    if not settings.ASYNC_VIEWS:
+        return iterator
+    iterator = iter(iterator)
+    read = sync_to_async(lambda: list(islice(iterator, chunk_size)))
+
+    async def content():
+        while items := await read():
+            for item in items:
+                yield item
+    return content()
+
+class LiveAnalyzeView(AdminRequiredMixin, View):
+    """
+    Streaming analysis mode. GET renders a page that POSTs back to this URL and
+    shows the report as the model writes it; POST streams the tokens as
+    Server-Sent Events and saves the cleaned report once the stream completes.
+    """
+    def _get_record(self, request, pk):
+        patient_record = get_object_or_404(PatientRecord, pk=pk)
+        if patient_record.hospital != request.user.hospital:
+            return None
+        return patient_record
+
+    def get(self, request, pk):
+        patient_record = self._get_record(request, pk)
+        if patient_record is None:
+            messages.error(request, "You are not authorized to analyze this record.")
+            return redirect('admin_dashboard')
+
+        assessment = RiskAssessment.objects.filter(patient_record=patient_record).first()
+        if assessment:
+            return redirect('view_assessment', pk=assessment.pk)
+        return render(request, 'health_app/analyze_live.html', {'patient': patient_record})
+
+    def post(self, request, pk):
+        patient_record = self._get_record(request, pk)
+        if patient_record is None:
+            return JsonResponse({'error': "You are not authorized to analyze this record."}, status=403)
+        if RiskAssessment.objects.filter(patient_record=patient_record).exists():
+            return JsonResponse({'error': f"An assessment for patient {patient_record.patient_identifier} already exists."}, status=409)
+
+        def event_stream():
+            # Sent before the model is called, so the browser gets its first byte immediately.
+            yield _sse_event('start', {'patient_identifier': patient_record.patient_identifier})
+
+            try:
+                for kind, payload in stream_risk_assessment_for_record(patient_record):
+                    if kind == 'delta':
+                        yield _sse_event('delta', {'text': payload})
+                    elif kind == 'error':
+                        yield _sse_event('error', {'message': payload})
+                        return
+                    else:
+                        assessment, _ = RiskAssessment.objects.get_or_create(
+                            patient_record=patient_record,
+                            defaults={'ai_generated_report': payload, 'prompt_version': report_prompt_version(patient_record)},
+                        )
+                        yield _sse_event('done', {
+                            'assessment_id': assessment.pk,
+                            'url': reverse('view_assessment', kwargs={'pk': assessment.pk}),
+                        })
+            except InferenceUnavailable:
+                # The circuit breaker is open: don't wait for the provider; the worker runs the job once it recovers.
+                job = enqueue_analysis(patient_record, requested_by=request.user)
+                yield _sse_event('error', {'message': _queued_instead_message(job)})
+
+        return _streaming_sse_response(event_stream())
+
+# --- Async analysis views, used when the app is served over ASGI (see config/asgi.py and urls.py) ---
+class AsyncAnalyzePatientRecordView(AsyncAdminRequiredMixin, View):
+    """AnalyzePatientRecordView for ASGI workers: the same steps, with the database calls awaited."""
+    async def post(self, request, pk):
+        patient_record = await aget_object_or_404(PatientRecord, pk=pk)
+        if patient_record.hospital_id != request.user.hospital_id:
+            messages.error(request, "You are not authorized to analyze this record.")
+            return redirect('admin_dashboard')
 
-        # 5. Check for errors from the API call
-        if ai_report.startswith("Error:"):
-            messages.error(request, ai_report)
+        if await RiskAssessment.objects.filter(patient_record=patient_record).aexists():
+            messages.warning(request, f"An assessment for patient {patient_record.patient_identifier} already exists.")
             return redirect('admin_dashboard')
 
-        # 6. Create the RiskAssessment object in the database
-        RiskAssessment.objects.create(
-            patient_record=patient_record,
-            ai_generated_report=ai_report
-            # The status defaults to PENDING_REVIEW as per your model
-        )
+        evaluation = evaluate_record(patient_record)
+        if evaluation.risk_level == 0:
+            await RiskAssessment.objects.acreate(patient_record=patient_record, ai_generated_report=templated_normal_report(evaluation))
+            messages.success(request, f"All markers for patient {patient_record.patient_identifier} are within the normal range. The report is now ready for doctor review.")
+            return redirect('admin_dashboard')
 
-        messages.success(request, f"AI analysis complete for patient {patient_record.patient_identifier}. The report is now ready for doctor review.")
+        job = await sync_to_async(enqueue_analysis)(patient_record, requested_by=request.user)
+        messages.success(request, f"AI analysis for patient {patient_record.patient_identifier} has been queued (job #{job.pk}). The report will be ready for doctor review shortly.")
         return redirect('admin_dashboard')
 
+class AsyncLiveAnalyzeView(AsyncAdminRequiredMixin, View):
+    """
+    LiveAnalyzeView for ASGI workers. The report is streamed from the async inference
+    client, so a worker process holds one task, not one thread, per in-flight analysis.
+    """
+    async def _get_record(self, request, pk):
+        patient_record = await aget_object_or_404(PatientRecord, pk=pk)
+        if patient_record.hospital_id != request.user.hospital_id:
+            return None
+        return patient_record
+
+    async def get(self, request, pk):
+        patient_record = await self._get_record(request, pk)
+        if patient_record is None:
+            messages.error(request, "You are not authorized to analyze this record.")
+            return redirect('admin_dashboard')
+
+        assessment = await RiskAssessment.objects.filter(patient_record=patient_record).afirst()
+        if assessment:
+            return redirect('view_assessment', pk=assessment.pk)
+        # The templates read the user's relations, which query the database.
+        return await sync_to_async(render)(request, 'health_app/analyze_live.html', {'patient': patient_record})
+
+    async def post(self, request, pk):
+        patient_record = await self._get_record(request, pk)
+        if patient_record is None:
+            return JsonResponse({'error': "You are not authorized to analyze this record."}, status=403)
+        if await RiskAssessment.objects.filter(patient_record=patient_record).aexists():
+            return JsonResponse({'error': f"An assessment for patient {patient_record.patient_identifier} already exists."}, status=409)
+
+        async def event_stream():
+            yield _sse_event('start', {'patient_identifier': patient_record.patient_identifier})
+
+            try:
+                async for kind, payload in astream_risk_assessment_for_record(patient_record):
+                    if kind == 'delta':
+                        yield _sse_event('delta', {'text': payload})
+                    elif kind == 'error':
+                        yield _sse_event('error', {'message': payload})
+                        return
+                    else:
+                        assessment, _ = await RiskAssessment.objects.aget_or_create(
+                            patient_record=patient_record,
+                            defaults={'ai_generated_report': payload, 'prompt_version': report_prompt_version(patient_record)},
+                        )
+                        yield _sse_event('done', {
+                            'assessment_id': assessment.pk,
+                            'url': reverse('view_assessment', kwargs={'pk': assessment.pk}),
+                        })
+            except InferenceUnavailable:
+                job = await sync_to_async(enqueue_analysis)(patient_record, requested_by=request.user)
+                yield _sse_event('error', {'message': _queued_instead_message(job)})
+
+        return _streaming_sse_response(event_stream())
+
+class BulkAnalyzeView(AdminRequiredMixin, View):
+    """
+    Queues analysis for many records at once: the records selected in the patient list,
+    or every record in the hospital that has no assessment yet.
+    The queued jobs are run concurrently by the `run_analysis_worker` process.
+    """
+    def post(self, request):
+        # Security: only ever consider records from the admin's own hospital.
+        records = PatientRecord.objects.filter(hospital=request.user.hospital)
+
+        selected_ids = request.POST.getlist('record_ids')
+        if selected_ids:
+            records = records.filter(pk__in=[pk for pk in selected_ids if pk.isdigit()])
+        elif request.POST.get('scope') != 'all_pending':
+            messages.error(request, "No patient records were selected.")
+            return redirect('patient_list')
+
+        # Records with all-normal markers are scored in SQL and reported immediately;
+        # only the rest need the LLM and go to the queue.
+        normal_count = assess_normal_records(records)
+        queued_count = enqueue_bulk_analysis(records, requested_by=request.user)
+        if normal_count:
+            messages.success(request, f"{normal_count} record(s) had all markers within the normal range and were reported immediately.")
+        if queued_count:
+            messages.success(request, f"Queued AI analysis for {queued_count} patient record(s). Reports will appear as they are completed.")
+        if not normal_count and not queued_count:
+            messages.info(request, "There are no records waiting for analysis.")
+        return redirect('patient_list')
+
+class AnalysisJobStatusView(AdminRequiredMixin, View):
+    """
+    Reports the state of a queued analysis job as JSON, for polling from the browser.
+    """
+    def get(self, request, pk):
+        job = get_object_or_404(AnalysisJob.objects.select_related('patient_record'), pk=pk)
+
+        # Security Check: Ensure the job belongs to the admin's hospital
+        if job.patient_record.hospital_id != request.user.hospital_id:
+            return JsonResponse({'error': "You are not authorized to view this job."}, status=403)
+
+        assessment_id = None
+        if job.status == AnalysisJob.Status.DONE:
+            assessment_id = RiskAssessment.objects.filter(patient_record=job.patient_record).values_list('pk', flat=True).first()
+
+        return JsonResponse({
+            'id': job.pk,
+            'patient_identifier': job.patient_record.patient_identifier,
+            'status': job.status.lower(),
+            'attempts': job.attempts,
+            'error': job.error or None,
+            'assessment_id': assessment_id,
+            'created_at': job.created_at.isoformat(),
+            'started_at': job.started_at.isoformat() if job.started_at else None,
+            'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        })
+
 class DoctorOrAdminRequiredMixin(LoginRequiredMixin, UserPassesTestMixin):
     def test_func(self):
         return self.request.user.role in [User.Role.HOSPITAL_ADMIN, User.Role.DOCTOR]
@@ -355,7 +666,8 @@ class AssessmentDetailView(DoctorOrAdminRequiredMixin, View):
             return redirect('doctor_dashboard')
         # --- END OF NEW CHECK ---
         
-        assessment.html_report = markdown.markdown(assessment.ai_generated_report,extensions=['extra','nl2br'])
+        # The HTML is rendered when the report is saved; this only renders (once) rows from before that.
+        assessment.ensure_html_report()
         
         form = DoctorReviewForm(instance=assessment)
         
@@ -390,7 +702,7 @@ class AssessmentDetailView(DoctorOrAdminRequiredMixin, View):
             return redirect('doctor_dashboard')
         
         # If form is invalid, re-render the page with errors
-        assessment.html_report = markdown.markdown(assessment.ai_generated_report,extensions=['extra','nl2br'])
+        assessment.ensure_html_report()
         context = {
             'assessment': assessment,
             'patient': assessment.patient_record,
@@ -401,7 +713,9 @@ class AssessmentDetailView(DoctorOrAdminRequiredMixin, View):
 @login_required
 def export_reviewed_reports_csv(request):
     """
-    Handles the request to download all reviewed risk assessments as a CSV file.
+    Handles the request to download all reviewed risk assessments.
+    The file is streamed as it is generated; `?format=` selects csv (default), ndjson or csv.gz.
+    `?since=` or `?cursor=` make it incremental, and the X-Next-Cursor header holds the cursor for the next sync.
     This view is restricted to Hospital Admins.
     """
     # 1. Security Check: Ensure the user is a Hospital Admin
@@ -409,57 +723,28 @@ def export_reviewed_reports_csv(request):
         messages.error(request, "You are not authorized to perform this action.")
         return redirect('dashboard_redirect')
 
-    # 2. Prepare the HTTP Response to indicate a CSV download
-    response = HttpResponse(
-        content_type='text/csv',
-        headers={'Content-Disposition': f'attachment; filename="reviewed_reports_{timezone.now().strftime("%Y-%m-%d")}.csv"'},
+    # 2. Pick the output format
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponse(f"Unknown export format. Use one of: {', '.join(EXPORT_FORMATS)}.", status=400)
+    content_type, extension, encode = EXPORT_FORMATS[export_format]
+
+    # 3. Incremental export: only assessments reviewed after `since` or after the position in `cursor`.
+    try:
+        since = parse_since(request.GET['since']) if request.GET.get('since') else None
+        cursor = decode_cursor(request.GET['cursor']) if request.GET.get('cursor') else None
+    except InvalidCursor as e:
+        return HttpResponse(str(e), status=400)
+    assessments, next_cursor = bound_to_watermark(reviewed_assessments(request.user.hospital, since=since, cursor=cursor))
+
+    # 4. Stream the rows: flat tuples are read in chunks, so memory use does not grow with the export.
+    response = StreamingHttpResponse(
+        _streaming_content(encode(iter_export_rows(assessments))),
+        content_type=content_type,
+        headers={'Content-Disposition': f'attachment; filename="reviewed_reports_{timezone.now().strftime("%Y-%m-%d")}.{extension}"'},
     )
-
-    # 3. Create a CSV writer
-    writer = csv.writer(response)
-
-    # 4. Define CSV Header Row
-    # We will include patient data, AI report, and doctor's review details.
-    header = [
-        'Patient Identifier', 'Glucose', 'HbA1c', 'Total Cholesterol', 'LDL', 'HDL',
-        'Triglycerides', 'ALT', 'AST', 'Creatinine', 'Urea', 'CRP', 'WBC',
-        'AI Generated Report', 'Doctor Comments', 'Reviewed By (Doctor)', 'Reviewed At'
-    ]
-    writer.writerow(header)
-
-    # 5. Query the Database for Reviewed Assessments
-    # Fetch all assessments marked as 'REVIEWED' for the admin's hospital.
-    # Use select_related to efficiently join related models in a single database query.
-    reviewed_assessments = RiskAssessment.objects.filter(
-        status=RiskAssessment.Status.REVIEWED,
-        patient_record__hospital=request.user.hospital
-    ).select_related('patient_record', 'reviewed_by').order_by('reviewed_at')
-
-    # 6. Write Data Rows to the CSV
-    for assessment in reviewed_assessments:
-        patient = assessment.patient_record
-        row = [
-            patient.patient_identifier,
-            patient.glucose,
-            patient.hba1c,
-            patient.total_cholesterol,
-            patient.ldl,
-            patient.hdl,
-            patient.triglycerides,
-            patient.alt,
-            patient.ast,
-            patient.creatinine,
-            patient.urea,
-            patient.crp,
-            patient.wbc,
-            assessment.ai_generated_report,
-            assessment.doctor_comments,
-            assessment.reviewed_by.get_full_name() if assessment.reviewed_by else 'N/A',
-            assessment.reviewed_at.strftime("%Y-%m-%d %H:%M") if assessment.reviewed_at else 'N/A'
-        ]
-        writer.writerow(row)
-
-    # 7. Return the response
+    # Pass this back as ?cursor= to get only newer reviews. An empty export keeps the caller's cursor.
+    response['X-Next-Cursor'] = next_cursor or request.GET.get('cursor', '')
     return response
 
 class AssignDoctorView(AdminRequiredMixin, View):
@@ -468,10 +753,10 @@ class AssignDoctorView(AdminRequiredMixin, View):
     """
     def post(self, request, pk):
         # 1. Get the assessment object
-        assessment = get_object_or_404(RiskAssessment, pk=pk)
+        assessment = get_object_or_404(RiskAssessment.objects.select_related('patient_record'), pk=pk)
 
         # 2. Security Check: Ensure the assessment belongs to the admin's hospital
-        if assessment.patient_record.hospital != request.user.hospital:
+        if assessment.patient_record.hospital_id != request.user.hospital_id:
             messages.error(request, "You are not authorized to modify this record.")
             return redirect('patient_list')
 
@@ -481,20 +766,35 @@ class AssignDoctorView(AdminRequiredMixin, View):
             messages.error(request, "No doctor was selected.")
             return redirect('patient_list')
 
-        # 4. Get the doctor user object
-        try:
-            doctor_to_assign = User.objects.get(
-                pk=doctor_id,
-                hospital=request.user.hospital, # Security: Doctor must be in the same hospital
-                role=User.Role.DOCTOR          # Security: User must be a doctor
-            )
-        except User.DoesNotExist:
+        # 4. Look the doctor up in the hospital's (cached) roster.
+        # Security: only doctors of the admin's own hospital are on it. Another process may
+        # still cache a roster from before a doctor moved or left, so check the database too.
+        doctor_to_assign = find_doctor(request.user.hospital_id, doctor_id)
+        if doctor_to_assign is None or not User.objects.filter(
+            pk=doctor_to_assign.id, hospital_id=request.user.hospital_id, role=User.Role.DOCTOR,
+        ).exists():
             messages.error(request, "The selected doctor could not be found or is invalid.")
             return redirect('patient_list')
 
         # 5. Perform the assignment
-        assessment.assigned_doctor = doctor_to_assign
-        assessment.save()
+        assessment.assigned_doctor_id = doctor_to_assign.id
+        assessment.save(update_fields=['assigned_doctor'])
+
+        messages.success(request, f"Report for patient {assessment.patient_record.patient_identifier} has been assigned to Dr. {doctor_to_assign.full_name}.")
+        return redirect('patient_list')
 
-        messages.success(request, f"Report for patient {assessment.patient_record.patient_identifier} has been assigned to Dr. {doctor_to_assign.get_full_name()}.")
-        return redirect('patient_list')
\ No newline at end of file
+
+def metrics_view(request):
+    """
+    Prometheus metrics in the text exposition format (see metrics.py).
+    Scrapers authenticate with `Authorization: Bearer <METRICS_TOKEN>`. Without a token
+    configured, the endpoint is only served when DEBUG is on.
+    """
+    if settings.METRICS_TOKEN:
+        if not constant_time_compare(request.headers.get('Authorization', ''), f"Bearer {settings.METRICS_TOKEN}"):
+            return HttpResponse("Unauthorized", status=401, headers={'WWW-Authenticate': 'Bearer'})
+    elif not settings.DEBUG:
+        raise Http404()
+
+    body, content_type = metrics.render_metrics()
+    return HttpResponse(body, content_type=content_type)